@@ -2,15 +2,19 @@ from pathlib import Path
 
 import numpy as np
 
-from cosmics.io import LoadTriggered, Mask
+from cosmics.io import LoadTriggered, Mask, RunSpec, StagingCache
 
 run_name = "Run_ILC_08172020_Cosmics_48h_Ascii_build"
 run_name = "Run_ILC_08042020_cosmic_it15_Ascii_build"
 tree_name = "ecal"
+server, server_folder = "llrgate01.in2p3.fr", "/data_ilc/flc/ECAL/cosmics/tb2020"
 
 
 raw_path = Path("data/raw") / f"{run_name}.root"
-assert raw_path.exists()
+if not raw_path.exists():
+    # A local copy is kept in the staging cache, and only copied once.
+    run_spec = RunSpec(run_name, server_folder, server)
+    raw_path = StagingCache(Path("data/staged"), max_size="100 GB").stage(run_spec)
 img_path = Path("img") / run_name
 data_folder = Path("data")
 mask_folder = data_folder / "mask" / run_name
@@ -1,10 +1,11 @@
 from pathlib import Path
 from typing import Dict, List, Mapping, Optional, Tuple, Union
 
-import awkward as ak
 import matplotlib.pyplot as plt
 import numpy as np
-import uproot
+
+from cosmics.analysis import slab_statistics
+from cosmics.analysis.slab_quality import default_conditions
 
 from .save import savefig
 
@@ -12,83 +13,52 @@ HistData = Tuple[str, np.ndarray, str]
 HistDataDict = Dict[str, HistData]
 PathLike = Union[str, Path]
 
-
-def _to_np(ak_array: ak.Array) -> np.ndarray:
-    return ak.flatten(ak_array, axis=None).to_numpy()
+_colors = {
+    "standard": "blue",
+    "first3": "red",
+    "first2": "green",
+    "first2last1": "black",
+}
 
 
 def get_slab_data(
     file_name: PathLike,
     folder: PathLike,
     tags: Optional[List[str]] = None,
+    cache_folder: Optional[PathLike] = None,
 ) -> HistDataDict:
-    implemented_tags = ["standard", "first3", "first2", "first2last1"]
+    """Per tag: the label, the #events per #slabs hit (0 to 15) and the color."""
+    implemented_tags = list(default_conditions)
     if tags is None:
         tags = implemented_tags
     else:
         if set(tags) != set(implemented_tags):
             raise NotImplementedError(tags, implemented_tags)
 
-    a = uproot.open(Path(folder) / file_name)["ecal"].arrays()
-    nhit_from_first_four = ak.sum(
-        [
-            ak.any(a.hit_slab == 0, axis=1),
-            ak.any(a.hit_slab == 1, axis=1),
-            ak.any(a.hit_slab == 2, axis=1),
-            ak.any(a.hit_slab == 3, axis=1),
-        ],
-        axis=0,
-    )
-    nhit_from_last_two = ak.sum(
-        [
-            ak.any(a.hit_slab == 13, axis=1),
-            ak.any(a.hit_slab == 14, axis=1),
-        ],
-        axis=0,
-    )
-
-    nslab_info: HistDataDict = {}
-    if "standard" in tags:
-        nslab_info["standard"] = (
-            "no additional condition",
-            _to_np(a.nhit_slab),
-            "blue",
-        )
-    if "first3" in tags:
-        nslab_info["first3"] = (
-            "at least 3 out of 4 first slabs",
-            _to_np(a.nhit_slab[nhit_from_first_four >= 3]),
-            "red",
-        )
-    if "first2" in tags:
-        nslab_info["first2"] = (
-            "at least 2 out of 4 first slabs",
-            _to_np(a.nhit_slab[nhit_from_first_four >= 2]),
-            "green",
-        )
-    if "first2last1" in tags:
-        cond = (nhit_from_first_four >= 2) & (nhit_from_last_two >= 1)
-        nslab_info["first2last1"] = (
-            "at least 2 out of 4 first slabs and\nat least 1 out of last 2 slabs",
-            _to_np(a.nhit_slab[cond]),
-            "black",
-        )
-    return nslab_info
+    statistics = slab_statistics(Path(folder) / file_name, cache_folder=cache_folder)
+    return {
+        tag: (statistics.labels[tag], statistics.nhit_slab[tag], _colors[tag])
+        for tag in tags
+    }
 
 
 def plot_nslabs_conditioned(
     files: Mapping[str, PathLike],
     folder: PathLike,
     img_folder: PathLike = "./img",
+    cache_folder: Optional[PathLike] = None,
 ) -> None:
     bins = np.arange(3.5, 15)
     tags = ["standard", "first3", "first2", "first2last1"]
     for run_id, file_name in files.items():
-        slab_data = get_slab_data(file_name, folder, tags)
+        slab_data = get_slab_data(file_name, folder, tags, cache_folder)
         fig, ax = plt.subplots(figsize=(6, 4))
         for tag in tags:
-            label, x, color = slab_data[tag]
-            ax.hist(x, bins, label=label, histtype="step", color=color)
+            label, counts, color = slab_data[tag]
+            n_slabs = np.arange(len(counts))
+            ax.hist(
+                n_slabs, bins, weights=counts, label=label, histtype="step", color=color
+            )
         ax.set_xlabel("#slabs hit per event")
         ax.set_ylabel("#events")
         ax.legend(title=">= 4 slabs", fontsize=10)
@@ -99,19 +69,23 @@ def plot_nslabs_conditioned(
     print(f"{len(files)} figures created in {file_path.parent.absolute()}.")
 
 
-def plot_nslab_summary(files: Mapping[str, PathLike], folder: PathLike):
+def plot_nslab_summary(
+    files: Mapping[str, PathLike],
+    folder: PathLike,
+    cache_folder: Optional[PathLike] = None,
+):
     bins = np.arange(3.5, 15)
     fig, ax = plt.subplots(figsize=(6, 4))
     for run_id, file_name in files.items():
-        a = (
-            uproot.open(Path(folder) / file_name)["ecal"]["nhit_slab"]
-            .array()
-            .to_numpy()
+        statistics = slab_statistics(
+            Path(folder) / file_name, cache_folder=cache_folder
         )
+        counts = statistics.nhit_slab["standard"]
         ax.hist(
-            a,
+            np.arange(len(counts)),
             bins=bins,
-            label=f"{run_id} ({len(a)} entries)",
+            weights=counts,
+            label=f"{run_id} ({statistics.n_events} entries)",
             histtype="step",
             linewidth=2,
         )
@@ -121,17 +95,23 @@ def plot_nslab_summary(files: Mapping[str, PathLike], folder: PathLike):
     return fig
 
 
-def plot_slab_position(files: Mapping[str, PathLike], folder: PathLike):
+def plot_slab_position(
+    files: Mapping[str, PathLike],
+    folder: PathLike,
+    cache_folder: Optional[PathLike] = None,
+):
     bins = np.arange(-0.5, 15)
     fig, ax = plt.subplots(figsize=(6, 4))
     for run_id, file_name in files.items():
-        a = ak.flatten(
-            uproot.open(Path(folder) / file_name)["ecal"]["hit_slab"].array()
-        ).to_numpy()
+        statistics = slab_statistics(
+            Path(folder) / file_name, cache_folder=cache_folder
+        )
+        counts = statistics.hit_slab
         ax.hist(
-            a,
+            np.arange(len(counts)),
             bins=bins,
-            label=f"{run_id} ({len(a)} entries)",
+            weights=counts,
+            label=f"{run_id} ({counts.sum()} entries)",
             histtype="step",
             linewidth=2,
         )
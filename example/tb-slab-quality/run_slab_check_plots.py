@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+from functools import partial
 from pathlib import Path
 
 from plotting import (
@@ -8,6 +9,9 @@ from plotting import (
     savefig,
 )
 
+from cosmics.analysis import slab_statistics
+from cosmics.io import process_runs
+
 folder = Path.home() / "data/rs"
 files = {
     "050043 - better position": "3GeVMIPscan_run_050043_build3.root",
@@ -21,6 +25,14 @@ files = {
 if __name__ == "__main__":
     img = Path(__file__).parent / "img"
     img.mkdir(exist_ok=True)
-    plot_nslabs_conditioned(files, folder, img_folder=img)
-    savefig(plot_nslab_summary(files, folder), img / "nslabs_summary.png")
-    savefig(plot_slab_position(files, folder), img / "slab_position_summary.png")
+    # All plots of a run share a single pass over its file.
+    cache = Path(__file__).parent / "slab_statistics"
+    process_runs(
+        {run_id: folder / file_name for run_id, file_name in files.items()},
+        partial(slab_statistics, cache_folder=cache),
+    )
+    plot_nslabs_conditioned(files, folder, img_folder=img, cache_folder=cache)
+    fig = plot_nslab_summary(files, folder, cache_folder=cache)
+    savefig(fig, img / "nslabs_summary.png")
+    fig = plot_slab_position(files, folder, cache_folder=cache)
+    savefig(fig, img / "slab_position_summary.png")
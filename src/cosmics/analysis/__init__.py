@@ -0,0 +1,14 @@
+"""Accumulated quantities over the events of (long) runs."""
+from .layer_histograms import LayerHistograms
+from .mip_spectra import MipSpectra
+from .slab_quality import slab_statistics
+from .sum_energy_fit import SumEnergyFit
+from .summaries import event_summaries
+
+__all__ = [
+    "LayerHistograms",
+    "MipSpectra",
+    "SumEnergyFit",
+    "event_summaries",
+    "slab_statistics",
+]
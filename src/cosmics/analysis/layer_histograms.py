@@ -0,0 +1,178 @@
+"""Hit maps of all layers, accumulated over (parts of) a run."""
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import awkward as ak
+import numexpr
+import numpy as np
+import tqdm.auto as tqdm
+
+from ..io.mask_from_build_file import Mask
+from ..io.memory import AdaptiveStepSize, iterate_adaptive
+from ..io.utils import EntryRange, merge_ranges, missing_ranges, write_npz
+
+
+def _bin_indices(values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """The bin of each value, or -1 outside of the edges."""
+    indices = np.searchsorted(edges, values, side="right") - 1
+    indices[(values < edges[0]) | (values >= edges[-1])] = -1
+    return indices
+
+
+class LayerHistograms:
+    """Hit counts per (selection, layer, x, y) cell, filled batch by batch.
+
+    The cells are those of `pos` (bin edges as in `Mask.bins`). A `selection` is
+    a numexpr expression on the hit branches (e.g. `"hit_isHit == 1"`), or None
+    for all hits. All layers and selections are binned with a single bincount.
+    Histograms of disjoint raw entry ranges (e.g. from parallel workers) add up.
+    """
+
+    def __init__(
+        self,
+        pos: Dict[str, np.ndarray],
+        selections: Optional[Dict[str, Optional[str]]] = None,
+    ) -> None:
+        self.edges = {axis: Mask.bins(np.asarray(pos[axis])) for axis in "xyz"}
+        self.selections = selections or {"all": None}
+        n_bins = tuple(len(self.edges[axis]) - 1 for axis in "zxy")
+        self.counts = np.zeros((len(self.selections),) + n_bins, dtype=np.int64)
+        self.entry_ranges: List[EntryRange] = []
+
+    def __getitem__(self, selection: str) -> np.ndarray:
+        """The (layer, x, y) counts of a selection."""
+        return self.counts[list(self.selections).index(selection)]
+
+    @property
+    def n_entries(self) -> int:
+        return sum(stop - start for start, stop in self.entry_ranges)
+
+    def _branches(self) -> List[str]:
+        context = numexpr.necompiler.getContext({})
+        names = {"hit_x", "hit_y", "hit_z"}
+        for selection in self.selections.values():
+            if selection is not None:
+                names |= set(numexpr.necompiler.getExprNames(selection, context)[0])
+        return sorted(names)
+
+    def fill(self, batch: ak.Array, entry_range: Optional[EntryRange] = None) -> None:
+        """Add the hits of a batch of events (covering the raw `entry_range`)."""
+        hits = {name: ak.to_numpy(ak.flatten(batch[name])) for name in self._branches()}
+        i_z, i_x, i_y = [
+            _bin_indices(hits[f"hit_{axis}"], self.edges[axis]) for axis in "zxy"
+        ]
+        in_range = (i_z >= 0) & (i_x >= 0) & (i_y >= 0)
+        cells = np.ravel_multi_index(
+            (i_z[in_range], i_x[in_range], i_y[in_range]), self.counts.shape[1:]
+        )
+        n_cells = np.prod(self.counts.shape[1:])
+        indices = []
+        for i, selection in enumerate(self.selections.values()):
+            if selection is None:
+                indices.append(cells + i * n_cells)
+            else:
+                is_selected = numexpr.evaluate(selection, hits)[in_range]
+                indices.append(cells[is_selected] + i * n_cells)
+        self.counts += np.bincount(
+            np.concatenate(indices), minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        if entry_range is not None:
+            self.entry_ranges = merge_ranges(self.entry_ranges + [entry_range])
+
+    def fill_tree(
+        self,
+        tree,
+        entry_stop: int = -1,
+        step_size: Union[str, int] = "100 MB",
+        file_name: Optional[Union[str, Path]] = None,
+    ) -> None:
+        """Add the raw entries below `entry_stop` that were not yet filled.
+
+        With a `file_name`, the histograms are saved after each batch, so that an
+        interrupted run continues where it stopped.
+        """
+        n_raw = (
+            tree.num_entries if entry_stop < 0 else min(entry_stop, tree.num_entries)
+        )
+        missing = missing_ranges(self.entry_ranges, n_raw)
+        step = AdaptiveStepSize(step_size)
+        with tqdm.tqdm(desc="Events", total=sum(b - a for a, b in missing)) as p_bar:
+            for missing_start, missing_stop in missing:
+                batches = iterate_adaptive(
+                    tree, self._branches(), missing_start, missing_stop, step
+                )
+                for batch, start, stop in batches:
+                    self.fill(batch, (start, stop))
+                    if file_name is not None:
+                        self.save(file_name)
+                    p_bar.update(stop - start)
+
+    def _has_same_binning(self, other: "LayerHistograms") -> bool:
+        return self.selections == other.selections and all(
+            np.array_equal(self.edges[a], other.edges[a]) for a in "xyz"
+        )
+
+    def __add__(self, other: "LayerHistograms") -> "LayerHistograms":
+        if not self._has_same_binning(other):
+            raise ValueError("Only histograms with the same binning can be merged.")
+        ranges = sorted(self.entry_ranges + other.entry_ranges)
+        if any(a[1] > b[0] for a, b in zip(ranges[:-1], ranges[1:])):
+            raise ValueError("The histograms overlap in their raw entries.")
+        merged = LayerHistograms.__new__(LayerHistograms)
+        merged.edges = self.edges
+        merged.selections = self.selections
+        merged.counts = self.counts + other.counts
+        merged.entry_ranges = merge_ranges(ranges)
+        return merged
+
+    def __radd__(self, other: Union[int, "LayerHistograms"]) -> "LayerHistograms":
+        return self if other == 0 else self + other  # Supports `sum(parts)`.
+
+    def save(self, file_name: Union[str, Path]) -> None:
+        file_name = Path(file_name)
+        entry_ranges = np.array(self.entry_ranges, dtype=np.int64).reshape(-1, 2)
+        write_npz(
+            {
+                "counts": self.counts,
+                "entry_ranges": entry_ranges,
+                "selections": np.array(json.dumps(self.selections)),
+                **{f"edges_{axis}": edges for axis, edges in self.edges.items()},
+            },
+            file_name,
+            compressed=True,
+        )
+
+    @classmethod
+    def load(cls, file_name: Union[str, Path]) -> "LayerHistograms":
+        with np.load(file_name) as npz:
+            histograms = cls.__new__(cls)
+            histograms.edges = {axis: npz[f"edges_{axis}"] for axis in "xyz"}
+            histograms.selections = json.loads(str(npz["selections"]))
+            histograms.counts = npz["counts"]
+            histograms.entry_ranges = [(int(a), int(b)) for a, b in npz["entry_ranges"]]
+        return histograms
+
+    @classmethod
+    def from_tree(
+        cls,
+        file_name: Union[str, Path],
+        tree,
+        pos: Dict[str, np.ndarray],
+        selections: Optional[Dict[str, Optional[str]]] = None,
+        entry_stop: int = -1,
+        step_size: Union[str, int] = "100 MB",
+    ) -> "LayerHistograms":
+        """Continue (or start) the histograms stored in `file_name`.
+
+        Stored histograms of other positions or selections are started over.
+        """
+        histograms = cls(pos, selections)
+        if Path(file_name).exists():
+            stored = cls.load(file_name)
+            if stored._has_same_binning(histograms):
+                histograms = stored
+            else:
+                print(f"Other positions or selections, starting over: {file_name}.")
+        histograms.fill_tree(tree, entry_stop, step_size, file_name)
+        return histograms
@@ -0,0 +1,178 @@
+"""Energy spectra of every channel, for the MIP calibration of a run."""
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import awkward as ak
+import numexpr
+import numpy as np
+import tqdm.auto as tqdm
+
+from ..io.mask_from_build_file import _position_indices
+from ..io.utils import write_npz
+from .layer_histograms import _bin_indices
+
+
+class MipSpectra:
+    """A dense (x, y, z, energy bin) histogram of the selected hits' energies.
+
+    The cells are those of `pos`, in the same order as the `Mask` values.
+    Chunks of events are filled one after the other, so that they do not have to
+    be kept in memory. Spectra of different chunks or workers add up.
+    """
+
+    calibration_file_name = "mip_calibration.npz"
+
+    def __init__(
+        self,
+        pos: Dict[str, np.ndarray],
+        energy_edges: Optional[np.ndarray] = None,
+        selection: Optional[str] = "(hit_isHit == 1) & (hit_isMasked == 0)",
+    ) -> None:
+        self.pos = {axis: np.asarray(pos[axis]) for axis in "xyz"}
+        if energy_edges is None:
+            energy_edges = np.linspace(-150, 200, 351)
+        self.energy_edges = np.asarray(energy_edges, dtype=np.float64)
+        self.selection = selection
+        shape = tuple(len(self.pos[axis]) for axis in "xyz")
+        self.counts = np.zeros(shape + (len(self.energy_edges) - 1,), dtype=np.uint32)
+        self.n_events = 0
+
+    @property
+    def energy_centers(self) -> np.ndarray:
+        return (self.energy_edges[1:] + self.energy_edges[:-1]) / 2
+
+    def _branches(self) -> List[str]:
+        names = {"hit_x", "hit_y", "hit_z", "hit_energy"}
+        if self.selection is not None:
+            context = numexpr.necompiler.getContext({})
+            names |= set(numexpr.necompiler.getExprNames(self.selection, context)[0])
+        return sorted(names)
+
+    def fill(self, events: ak.Array) -> None:
+        """Add the selected hits of a chunk of events."""
+        hits = {
+            name: ak.to_numpy(ak.flatten(events[name])) for name in self._branches()
+        }
+        ids = [_position_indices(hits[f"hit_{axis}"], self.pos[axis]) for axis in "xyz"]
+        i_energy = _bin_indices(hits["hit_energy"], self.energy_edges)
+        is_used = np.logical_and.reduce([i >= 0 for i in ids + [i_energy]])
+        if self.selection is not None:
+            is_used &= numexpr.evaluate(self.selection, hits)
+        bins = np.ravel_multi_index(
+            [i[is_used] for i in ids + [i_energy]], self.counts.shape
+        )
+        flat_counts = self.counts.reshape(-1)
+        flat_counts += np.bincount(bins, minlength=self.counts.size).astype(np.uint32)
+        self.n_events += len(events)
+
+    def fill_chunks(self, chunks: Iterable[ak.Array]) -> "MipSpectra":
+        """Fill a stream of chunks, e.g. from `LoadTriggered.iterate`."""
+        for events in tqdm.tqdm(chunks, desc="Chunks"):
+            self.fill(events)
+        return self
+
+    def __add__(self, other: "MipSpectra") -> "MipSpectra":
+        if not np.array_equal(self.energy_edges, other.energy_edges):
+            raise ValueError("Only spectra with the same energy bins can be added.")
+        merged = MipSpectra(self.pos, self.energy_edges, self.selection)
+        merged.counts = self.counts + other.counts
+        merged.n_events = self.n_events + other.n_events
+        return merged
+
+    def __radd__(self, other: Union[int, "MipSpectra"]) -> "MipSpectra":
+        return self if other == 0 else self + other  # Supports `sum(parts)`.
+
+    def fit(
+        self,
+        min_energy: float = 10,
+        half_width: int = 6,
+        min_entries: int = 100,
+    ) -> Dict[str, np.ndarray]:
+        """Fit the MIP peak of every channel at once.
+
+        Per channel, the peak is the maximum of the smoothed spectrum above
+        `min_energy`. A Gaussian, i.e. a parabola in log(counts), is fitted to
+        the `half_width` bins on each side of it by weighted least squares.
+        Returns (x, y, z) arrays of `mpv`, `width`, `n_entries` and `is_valid`.
+        """
+        centers = self.energy_centers
+        counts = self.counts.reshape(-1, len(centers)).astype(np.float64)
+        n_entries = counts.sum(axis=1)
+        cumulative = np.cumsum(np.pad(counts, ((0, 0), (2, 1))), axis=1)
+        smoothed = (cumulative[:, 3:] - cumulative[:, :-3]) / 3
+        smoothed[:, centers < min_energy] = -1
+        peak = smoothed.argmax(axis=1)
+
+        offsets = np.arange(-half_width, half_width + 1)
+        window = np.clip(peak[:, None] + offsets, 0, len(centers) - 1)
+        y = np.take_along_axis(counts, window, axis=1)
+        t = centers[window] - centers[peak][:, None]
+        # Poisson: the variance of log(counts) is about 1 / counts.
+        weights = np.where(
+            (y > 0)
+            & (centers[window] >= min_energy)
+            & (window == peak[:, None] + offsets),
+            y,
+            0,
+        )
+        log_y = np.log(np.where(y > 0, y, 1))
+        powers = np.stack([t ** 2, t, np.ones_like(t)], axis=-1)
+        normal_matrix = np.einsum("cw,cwi,cwj->cij", weights, powers, powers)
+        normal_vector = np.einsum("cw,cwi,cw->ci", weights, powers, log_y)
+        is_solvable = (np.count_nonzero(weights, axis=1) >= 3) & (
+            np.abs(np.linalg.det(normal_matrix)) > 1e-12
+        )
+        params = np.full((len(counts), 3), np.nan)
+        params[is_solvable] = np.linalg.solve(
+            normal_matrix[is_solvable], normal_vector[is_solvable][..., None]
+        )[..., 0]
+        a, b = params[:, 0], params[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mpv = centers[peak] - b / (2 * a)
+            width = np.sqrt(-1 / (2 * a))
+        window_range = half_width * (centers[1] - centers[0])
+        is_valid = (
+            is_solvable
+            & (a < 0)
+            & (n_entries >= min_entries)
+            & (np.abs(mpv - centers[peak]) < window_range)
+        )
+        shape = self.counts.shape[:-1]
+        return {
+            "mpv": np.where(is_valid, mpv, np.nan).reshape(shape),
+            "width": np.where(is_valid, width, np.nan).reshape(shape),
+            "n_entries": n_entries.astype(np.int64).reshape(shape),
+            "is_valid": is_valid.reshape(shape),
+        }
+
+    def save(self, file_name: Union[str, Path]) -> None:
+        file_name = Path(file_name)
+        write_npz(
+            {
+                "counts": self.counts,
+                "energy_edges": self.energy_edges,
+                "n_events": np.array(self.n_events),
+                "selection": np.array(json.dumps(self.selection)),
+                **self.pos,
+            },
+            file_name,
+            compressed=True,
+        )
+
+    @classmethod
+    def load(cls, file_name: Union[str, Path]) -> "MipSpectra":
+        with np.load(file_name) as npz:
+            pos = {axis: npz[axis] for axis in "xyz"}
+            spectra = cls(pos, npz["energy_edges"], json.loads(str(npz["selection"])))
+            spectra.counts = npz["counts"]
+            spectra.n_events = int(npz["n_events"])
+        return spectra
+
+    def save_calibration(self, mask_folder: Union[str, Path], **fit_kwargs) -> Path:
+        """Fit all channels and store the results next to the run's `Mask`."""
+        calibration = self.fit(**fit_kwargs)
+        file_name = Path(mask_folder) / self.calibration_file_name
+        n_events = np.array(self.n_events)
+        write_npz({"n_events": n_events, **self.pos, **calibration}, file_name)
+        return file_name
@@ -0,0 +1,151 @@
+"""Slab statistics for test-beam quality checks, from a single pass per file."""
+import json
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import awkward as ak
+import numpy as np
+import tqdm.auto as tqdm
+import uproot
+
+from ..io.memory import AdaptiveStepSize, iterate_adaptive
+from ..io.trigger_cache import source_fingerprint
+from ..io.utils import write_npz
+
+n_slabs = 15
+_popcount_16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+
+class SlabCondition(NamedTuple):
+    """Each (slab bits, minimum) requires that many of the slabs to be hit."""
+
+    label: str
+    requirements: List[Tuple[int, int]]
+
+
+def first_slabs(n_first: int) -> int:
+    return (1 << n_first) - 1
+
+
+def last_slabs(n_last: int) -> int:
+    return first_slabs(n_last) << (n_slabs - n_last)
+
+
+default_conditions = {
+    "standard": SlabCondition("no additional condition", []),
+    "first3": SlabCondition("at least 3 out of 4 first slabs", [(first_slabs(4), 3)]),
+    "first2": SlabCondition("at least 2 out of 4 first slabs", [(first_slabs(4), 2)]),
+    "first2last1": SlabCondition(
+        "at least 2 out of 4 first slabs and\nat least 1 out of last 2 slabs",
+        [(first_slabs(4), 2), (last_slabs(2), 1)],
+    ),
+}
+
+
+def popcount(bits: np.ndarray) -> np.ndarray:
+    """The number of set bits of each (up to 32-bit) integer."""
+    bits = np.asarray(bits, dtype=np.uint32)
+    return _popcount_16[bits & 0xFFFF] + _popcount_16[bits >> 16]
+
+
+def slab_bitmask(hit_slab: ak.Array) -> np.ndarray:
+    """Per event, the bits of the slabs with at least one hit."""
+    counts = ak.to_numpy(ak.num(hit_slab))
+    event_ids = np.repeat(np.arange(len(counts)), counts)
+    slabs = ak.to_numpy(ak.flatten(hit_slab)).astype(np.int64)
+    # A sum over the distinct slabs of an event is the bitwise or.
+    event_slabs = np.unique(event_ids * 32 + slabs)
+    bits = np.bincount(
+        event_slabs // 32, weights=2.0 ** (event_slabs % 32), minlength=len(counts)
+    )
+    return bits.astype(np.uint32)
+
+
+def passes(bitmask: np.ndarray, condition: SlabCondition) -> np.ndarray:
+    is_passing = np.ones(len(bitmask), dtype=bool)
+    for bits, minimum in condition.requirements:
+        is_passing &= popcount(bitmask & bits) >= minimum
+    return is_passing
+
+
+class SlabStatistics(NamedTuple):
+    """Histograms with one bin per number of slabs (0 to 15) or per slab."""
+
+    n_events: int
+    nhit_slab: Dict[str, np.ndarray]  # Per condition.
+    hit_slab: np.ndarray
+    labels: Dict[str, str]
+
+
+def _compute_slab_statistics(
+    tree,
+    conditions: Dict[str, SlabCondition],
+    step_size: Union[str, int],
+) -> SlabStatistics:
+    nhit_slab = {tag: np.zeros(n_slabs + 1, dtype=np.int64) for tag in conditions}
+    hit_slab = np.zeros(n_slabs, dtype=np.int64)
+    step = AdaptiveStepSize(step_size)
+    batches = iterate_adaptive(
+        tree, ["hit_slab", "nhit_slab"], 0, tree.num_entries, step
+    )
+    with tqdm.tqdm(desc="Slab statistics", total=tree.num_entries) as p_bar:
+        for batch, start, stop in batches:
+            bitmask = slab_bitmask(batch.hit_slab)
+            n_slab_hit = np.clip(ak.to_numpy(batch.nhit_slab), 0, n_slabs)
+            for tag, condition in conditions.items():
+                is_passing = passes(bitmask, condition)
+                nhit_slab[tag] += np.bincount(
+                    n_slab_hit[is_passing], minlength=n_slabs + 1
+                )
+            slabs = ak.to_numpy(ak.flatten(batch.hit_slab))
+            hit_slab += np.bincount(
+                slabs[(slabs >= 0) & (slabs < n_slabs)], minlength=n_slabs
+            )
+            p_bar.update(stop - start)
+    labels = {tag: condition.label for tag, condition in conditions.items()}
+    return SlabStatistics(tree.num_entries, nhit_slab, hit_slab, labels)
+
+
+def slab_statistics(
+    root_file: Union[str, Path],
+    root_tree: str = "ecal",
+    conditions: Optional[Dict[str, SlabCondition]] = None,
+    cache_folder: Optional[Union[str, Path]] = None,
+    step_size: Union[str, int] = "100 MB",
+) -> SlabStatistics:
+    """All slab histograms of a file, from one chunked pass over two branches.
+
+    With a `cache_folder`, the result is stored per file (and source fingerprint)
+    so that all summary plots share the same pass.
+    """
+    conditions = default_conditions if conditions is None else conditions
+    tree = uproot.open(root_file)[root_tree]
+    identity = {
+        "source": source_fingerprint(tree, root_tree),
+        "conditions": {tag: list(c) for tag, c in conditions.items()},
+    }
+    cache_file = None
+    if cache_folder is not None:
+        cache_file = Path(cache_folder) / f"{Path(root_file).stem}_slab_statistics.npz"
+        if cache_file.exists():
+            with np.load(cache_file) as npz:
+                if json.loads(str(npz["identity"])) == json.loads(json.dumps(identity)):
+                    return SlabStatistics(
+                        int(npz["n_events"]),
+                        {tag: npz[f"nhit_slab_{tag}"] for tag in conditions},
+                        npz["hit_slab"],
+                        {tag: c.label for tag, c in conditions.items()},
+                    )
+    statistics = _compute_slab_statistics(tree, conditions, step_size)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        write_npz(
+            {
+                "identity": np.array(json.dumps(identity)),
+                "n_events": np.array(statistics.n_events),
+                "hit_slab": statistics.hit_slab,
+                **{f"nhit_slab_{t}": h for t, h in statistics.nhit_slab.items()},
+            },
+            cache_file,
+        )
+    return statistics
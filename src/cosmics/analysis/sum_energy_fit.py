@@ -0,0 +1,170 @@
+"""Fits of the `sum_energy` distribution: noise around zero plus a signal peak."""
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy.optimize import OptimizeResult, least_squares, minimize
+from scipy.stats import norm
+
+# Parameters: noise fraction, noise mean and width, signal mean and width.
+_bounds = [(1e-6, 1 - 1e-6), (None, None), (1e-6, None), (None, None), (1e-6, None)]
+
+
+def check_fit_result(fit_result: OptimizeResult) -> None:
+    if not fit_result.success:
+        logger = logging.getLogger(__name__)
+        logger.warning(f"Invalid fit result!\n{fit_result}.")
+
+
+def double_gauss(x: np.ndarray, p: np.ndarray) -> np.ndarray:
+    g_noise = norm.pdf(x, loc=p[1], scale=p[2])
+    g_signal = norm.pdf(x, loc=p[3], scale=p[4])
+    return p[0] * g_noise + (1 - p[0]) * g_signal
+
+
+def double_gauss_nll(p: np.ndarray, x: np.ndarray) -> Tuple[float, np.ndarray]:
+    """The unbinned negative log-likelihood per event, and its gradient."""
+    f, loc_1, scale_1, loc_2, scale_2 = p
+    z_1, z_2 = (x - loc_1) / scale_1, (x - loc_2) / scale_2
+    g_1, g_2 = norm.pdf(z_1) / scale_1, norm.pdf(z_2) / scale_2
+    pdf = f * g_1 + (1 - f) * g_2
+    gradient = -np.array(
+        [
+            np.mean((g_1 - g_2) / pdf),
+            np.mean(f * g_1 * z_1 / scale_1 / pdf),
+            np.mean(f * g_1 * (z_1 ** 2 - 1) / scale_1 / pdf),
+            np.mean((1 - f) * g_2 * z_2 / scale_2 / pdf),
+            np.mean((1 - f) * g_2 * (z_2 ** 2 - 1) / scale_2 / pdf),
+        ]
+    )
+    return -np.mean(np.log(pdf)), gradient
+
+
+def _bin_probabilities(edges: np.ndarray, loc: float, scale: float):
+    """Per bin: the Gaussian probability and its derivatives by loc and scale."""
+    z = (edges - loc) / scale
+    phi = norm.pdf(z)
+    probabilities = np.diff(norm.cdf(z))
+    d_loc = -np.diff(phi) / scale
+    d_scale = -np.diff(phi * z) / scale
+    return probabilities, d_loc, d_scale
+
+
+def double_gauss_binned_nll(
+    p: np.ndarray,
+    edges: np.ndarray,
+    counts: np.ndarray,
+) -> Tuple[float, np.ndarray]:
+    """The multinomial negative log-likelihood per event of the histogram counts.
+
+    The probabilities are normalised to the histogram range. The cost depends
+    on the number of bins only, not on the number of events.
+    """
+    f = p[0]
+    q_1, dq_1_loc, dq_1_scale = _bin_probabilities(edges, p[1], p[2])
+    q_2, dq_2_loc, dq_2_scale = _bin_probabilities(edges, p[3], p[4])
+    u = np.maximum(f * q_1 + (1 - f) * q_2, 1e-300)
+    n_total = counts.sum()
+    # Each derivative of u, followed by the one of its sum over all bins (U).
+    du = [
+        q_1 - q_2,
+        f * dq_1_loc,
+        f * dq_1_scale,
+        (1 - f) * dq_2_loc,
+        (1 - f) * dq_2_scale,
+    ]
+    u_total = u.sum()
+    nll = -np.sum(counts * np.log(u)) / n_total + np.log(u_total)
+    gradient = np.array(
+        [-np.sum(counts * d / u) / n_total + d.sum() / u_total for d in du]
+    )
+    return nll, gradient
+
+
+class SumEnergyFit:
+    """The fits of the `sum_energy` distribution, independent of any plotting.
+
+    Events with exactly zero energy are removed. The histogram (`n_bins` between
+    the smallest and largest value) is used for the binned fits.
+    """
+
+    def __init__(self, sum_energy: np.ndarray, n_bins: int = 25) -> None:
+        sum_energy = np.asarray(sum_energy, dtype=np.float64)
+        self.bin_edges = np.linspace(sum_energy.min(), sum_energy.max(), n_bins + 1)
+        self.bin_width = self.bin_edges[1] - self.bin_edges[0]
+        self.bin_centers = (self.bin_edges[1:] + self.bin_edges[:-1]) / 2
+        self.x = sum_energy[sum_energy != 0]
+        self.counts, _ = np.histogram(self.x, bins=self.bin_edges)
+
+    def fit_noise(self) -> float:
+        """The width of the zero-centred noise, from the negative energies.
+
+        The maximum-likelihood estimate is closed-form: the root mean square.
+        """
+        x_neg = self.x[self.x < 0]
+        return float(np.sqrt(np.mean(x_neg ** 2)))
+
+    def noise_counts(self, noise_scale: float) -> np.ndarray:
+        """The expected noise per bin: twice the negative events, mirrored at 0."""
+        n_noise = 2 * np.count_nonzero(self.x < 0)
+        return n_noise * self.bin_width * norm.pdf(self.bin_centers, scale=noise_scale)
+
+    def fit_signal(self, noise_scale: float) -> OptimizeResult:
+        """A binned least squares Gaussian fit to the counts in excess of noise."""
+        signal_counts = self.counts - self.noise_counts(noise_scale)
+        norm_s = signal_counts.sum() * self.bin_width
+        x = self.bin_centers
+
+        def residuals(p):
+            return signal_counts - norm_s * norm.pdf(x, loc=p[0], scale=p[1])
+
+        def jacobian(p):
+            z = (x - p[0]) / p[1]
+            model = norm_s * norm.pdf(z) / p[1]
+            return -np.stack([model * z / p[1], model * (z ** 2 - 1) / p[1]], axis=1)
+
+        init = (x[np.argmax(signal_counts)], noise_scale)
+        res = least_squares(residuals, init, jac=jacobian)
+        check_fit_result(res)
+        return res
+
+    def initial_double_gauss(self) -> np.ndarray:
+        init_p_noise = 2 * np.count_nonzero(self.x < 0) / len(self.x)
+        noise_scale = self.fit_noise()
+        return np.array(
+            [
+                min(max(init_p_noise, 0.01), 0.99),
+                0,
+                noise_scale,
+                self.bin_centers[np.argmax(self.counts)] + noise_scale,
+                noise_scale,
+            ]
+        )
+
+    def fit_double_gauss(
+        self,
+        binned: bool = True,
+        init: Optional[np.ndarray] = None,
+    ) -> OptimizeResult:
+        """A double Gaussian maximum likelihood fit with analytic gradients.
+
+        The binned fit uses the histogram counts, the unbinned fit all events.
+        Energies are divided by their standard deviation during the minimisation,
+        for gradients of similar size.
+        """
+        if init is None:
+            init = self.initial_double_gauss()
+        unit = np.array([1] + 4 * [np.std(self.x)])
+        if binned:
+            args = (self.bin_edges / unit[1], self.counts)
+            nll = double_gauss_binned_nll
+        else:
+            args = (self.x / unit[1],)
+            nll = double_gauss_nll
+        res = minimize(
+            nll, init / unit, args=args, jac=True, method="L-BFGS-B", bounds=_bounds
+        )
+        res.x = res.x * unit
+        res.jac = res.jac / unit
+        check_fit_result(res)
+        return res
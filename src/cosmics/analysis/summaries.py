@@ -0,0 +1,91 @@
+"""Per-event summaries of the hits, stored as fixed-width columns next to a cache."""
+import json
+from pathlib import Path
+from typing import Dict
+
+import awkward as ak
+import numpy as np
+import tqdm.auto as tqdm
+
+from ..io import LoadTriggered
+from ..io.trigger_cache import TriggerCache
+from ..io.utils import write_npz
+from .slab_quality import n_slabs, slab_bitmask
+
+summary_version = 1  # Increase when a definition changes, to recompute them.
+summary_branches = ["hit_slab", "hit_isHit", "hit_isMasked", "hit_energy"]
+
+
+def compute_summaries(events: ak.Array) -> Dict[str, np.ndarray]:
+    """The summaries of each event, from the `summary_branches` of its hits.
+
+    - n_valid: the hits with `hit_isHit == 1` and `hit_isMasked == 0`.
+    - nhit_valid_slab: per slab, the number of valid hits (saturates at 255).
+    - slab_bitmask: bit k is set if slab k has any hit.
+    - sum_energy_positive: the energy sum of the hits with positive energy.
+    """
+    is_valid = (events.hit_isHit == 1) & (events.hit_isMasked == 0)
+    counts = ak.to_numpy(ak.num(events.hit_slab))
+    event_ids = np.repeat(np.arange(len(counts)), counts)
+    slabs = ak.to_numpy(ak.flatten(events.hit_slab)).astype(np.int64)
+    in_slab = ak.to_numpy(ak.flatten(is_valid)) & (slabs >= 0) & (slabs < n_slabs)
+    nhit_valid_slab = np.bincount(
+        event_ids[in_slab] * n_slabs + slabs[in_slab],
+        minlength=len(counts) * n_slabs,
+    ).reshape(len(counts), n_slabs)
+    energy = events.hit_energy
+    sum_energy_positive = ak.to_numpy(ak.sum(energy[energy > 0], axis=1))
+    return {
+        "n_valid": ak.to_numpy(ak.sum(is_valid, axis=1)).astype(np.uint16),
+        "nhit_valid_slab": np.minimum(nhit_valid_slab, 255).astype(np.uint8),
+        "slab_bitmask": slab_bitmask(events.hit_slab).astype(np.uint16),
+        "sum_energy_positive": sum_energy_positive.astype(np.float32),
+    }
+
+
+def _chunk_summaries(cache: TriggerCache, chunk: Dict) -> Dict[str, np.ndarray]:
+    """The summaries of a cache chunk, computed once and stored next to it."""
+    chunk_file = cache.folder / chunk["file"]
+    summary_file = chunk_file.with_name(f"{Path(chunk['file']).stem}.summaries.npz")
+    # Appending to the source keeps the chunk, and so its summaries.
+    identity = {
+        "version": summary_version,
+        "entry_range": [chunk["entry_start"], chunk["entry_stop"]],
+        "hash": chunk.get("hash"),
+    }
+    if summary_file.exists():
+        with np.load(summary_file) as npz:
+            if json.loads(str(npz["identity"])) == json.loads(json.dumps(identity)):
+                return {name: npz[name] for name in npz.files if name != "identity"}
+    events = ak.concatenate(
+        list(cache.iterate_chunk(chunk, chunk["entry_stop"], summary_branches))
+    )
+    summaries = compute_summaries(events)
+    summaries["entry"] = np.load(chunk_file.with_suffix(".npy"))
+    identity_array = np.array(json.dumps(identity))
+    write_npz({"identity": identity_array, **summaries}, summary_file)
+    return summaries
+
+
+def event_summaries(load: LoadTriggered, trigger: str) -> Dict[str, np.ndarray]:
+    """The summaries of all triggered events, in the order of `load(trigger)`.
+
+    They are derived in one pass over the hit branches they need, and stored
+    per chunk of the trigger cache. Later calls (and new chunks of an extended
+    cache) only read or compute what is missing. The raw `entry` of each event
+    is included, to read the events that pass a cut with `load.events_at`.
+    """
+    cache = load.cache(trigger)
+    parts = [
+        _chunk_summaries(cache, chunk)
+        for chunk in tqdm.tqdm(cache.chunks, desc="Event summaries")
+    ]
+    if not parts:
+        return {
+            "n_valid": np.zeros(0, dtype=np.uint16),
+            "nhit_valid_slab": np.zeros((0, n_slabs), dtype=np.uint8),
+            "slab_bitmask": np.zeros(0, dtype=np.uint16),
+            "sum_energy_positive": np.zeros(0, dtype=np.float32),
+            "entry": np.zeros(0, dtype=np.int64),
+        }
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
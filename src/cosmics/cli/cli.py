@@ -1,15 +1,45 @@
 import argparse
 from pathlib import Path
 
-example_path = Path(__file__).parents[2] / "example/cosmics.yaml"
-print(example_path)
-assert example_path.is_file()
+from .pipeline import load_config, run_pipeline, stage_raw_file, stages
 
+example_path = Path(__file__).parents[3] / "example/cosmics.yaml"
 
-def main():
-    parser = argparse.ArgumentParser()
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Run the processing pipeline of a cosmics run."
+    )
     parser.add_argument("config", type=Path, help=f"See {example_path} as an example.")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(stages),
+        help="Only these stages (and those they depend on). Default: as configured.",
+    )
+    parser.add_argument("--n-workers", type=int, help="Stages to run concurrently.")
+    parser.add_argument(
+        "--force", action="store_true", help="Rerun stages that are up to date."
+    )
+    parsed = parser.parse_args(args)
+
+    run, settings = load_config(parsed.config)
+    run = stage_raw_file(run, settings)
+    if not run.raw_file.is_file():
+        parser.error(f"The raw file of run {run.name} is missing: {run.raw_file}.")
+    results = run_pipeline(
+        run,
+        parsed.stages or settings["stages"],
+        parsed.n_workers or settings["n_workers"],
+        parsed.force,
+    )
+    failed = [name for name, result in results.items() if result is None]
+    if failed:
+        print(f"Failed stages: {', '.join(failed)}.")
+        return 1
+    print(f"All {len(results)} stages of {run.name} are up to date.")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,355 @@
+"""A declarative pipeline: trigger selection, mask, histograms and fits of a run.
+
+Each stage writes its outputs to the run's cache folders and a stamp with the
+fingerprint of its inputs. Stages whose stamp is up to date are skipped.
+"""
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import uproot
+import yaml
+
+from ..analysis import (
+    LayerHistograms,
+    MipSpectra,
+    SumEnergyFit,
+    event_summaries,
+    slab_statistics,
+)
+from ..io import LoadTriggered, Mask
+from ..io.staging import RunSpec, StagingCache
+from ..version import __version__
+
+_pos_xy = np.arange(3.8, 87, 5.5)
+default_pos = dict(
+    x=np.concatenate([-_pos_xy[::-1], _pos_xy]).tolist(),
+    y=np.concatenate([-_pos_xy[::-1], _pos_xy]).tolist(),
+    z=list(range(14)),
+)
+default_settings = {
+    "data_folder": "data",
+    "tree": "ecal",
+    "step_size": "100 MB",
+    "n_workers": 1,
+    "trigger": "nhit_slab > 7",
+    "pos": default_pos,
+    "stages": [
+        "triggered",
+        "event_summaries",
+        "mask",
+        "layer_histograms",
+        "mip_spectra",
+        "slab_statistics",
+        "sum_energy_fit",
+    ],
+    "layer_histograms": {"selections": {"all": None, "hit": "hit_isHit == 1"}},
+    "staging": {"max_size": "200 GB", "n_workers": 4},
+}
+
+
+class RunSettings(NamedTuple):
+    """Everything the stages of a run need. Relative folders are resolved."""
+
+    name: str
+    raw_file: Path
+    tree: str
+    step_size: str
+    trigger: str
+    pos: Dict[str, List[float]]
+    folders: Dict[str, Path]  # triggered, mask, analysis, pipeline.
+    stage_options: Dict[str, Dict[str, Any]]
+
+    def pos_arrays(self) -> Dict[str, np.ndarray]:
+        return {axis: np.array(values) for axis, values in self.pos.items()}
+
+
+def load_config(config_file: Union[str, Path]) -> Tuple[RunSettings, Dict[str, Any]]:
+    """The run settings and the pipeline settings of a `cosmics.yaml` file.
+
+    The run is defined by the `cosmics` section (see `example/cosmics.yaml`),
+    the stages by the optional `pipeline` section. The raw file is expected at
+    `{data_folder}/raw/{name}.root`, relative to the config file. Otherwise it is
+    staged from the `server` and `folder` of the run (see `stage_raw_file`).
+    """
+    config_file = Path(config_file)
+    with config_file.open() as f:
+        config = yaml.safe_load(f)
+    name = config["cosmics"]["name"]
+    settings = {**default_settings, **(config.get("pipeline") or {})}
+    data_folder = config_file.parent / settings["data_folder"]
+    run = RunSettings(
+        name=name,
+        raw_file=data_folder / "raw" / f"{name}.root",
+        tree=settings["tree"],
+        step_size=settings["step_size"],
+        trigger=settings["trigger"],
+        pos=settings["pos"],
+        folders={
+            kind: data_folder / kind / name
+            for kind in ["triggered", "mask", "analysis", "pipeline"]
+        },
+        stage_options={s: settings.get(s) or {} for s in stages},
+    )
+    if "folder" in config["cosmics"]:
+        settings["run_spec"] = RunSpec.from_config(config["cosmics"])
+    settings["staging_folder"] = data_folder / "staged"
+    return run, settings
+
+
+def stage_raw_file(run: RunSettings, settings: Dict[str, Any]) -> RunSettings:
+    """Use a staged copy of the run's raw file, unless it is present already."""
+    if run.raw_file.is_file() or "run_spec" not in settings:
+        return run
+    staging = {**default_settings["staging"], **settings["staging"]}
+    cache = StagingCache(
+        settings["staging_folder"], staging["max_size"], n_workers=staging["n_workers"]
+    )
+    return run._replace(raw_file=cache.stage(settings["run_spec"]))
+
+
+def _stage_triggered(run: RunSettings) -> Dict[str, Any]:
+    load = LoadTriggered(
+        run.folders["triggered"], run.raw_file, run.tree, run.step_size
+    )
+    n_triggered = sum(len(chunk) for chunk in load.iterate(run.trigger))
+    return {"n_triggered": n_triggered, "cache_key": load.cache_key(run.trigger)}
+
+
+def _stage_event_summaries(run: RunSettings) -> Dict[str, Any]:
+    load = LoadTriggered(
+        run.folders["triggered"], run.raw_file, run.tree, run.step_size
+    )
+    summaries = event_summaries(load, run.trigger)
+    return {"n_events": len(summaries["entry"])}
+
+
+def _stage_mask(run: RunSettings) -> Dict[str, Any]:
+    mask = Mask.from_build_file(
+        run.folders["mask"], run.raw_file, run.tree, run.pos_arrays(), -1, run.step_size
+    )
+    return {"n_masked": int(np.count_nonzero(mask.values == 1))}
+
+
+def _stage_layer_histograms(run: RunSettings) -> Dict[str, Any]:
+    histograms = LayerHistograms.from_tree(
+        run.folders["analysis"] / "layer_histograms.npz",
+        uproot.open(run.raw_file)[run.tree],
+        run.pos_arrays(),
+        run.stage_options["layer_histograms"].get("selections"),
+        step_size=run.step_size,
+    )
+    return {"n_entries": histograms.n_entries}
+
+
+def _stage_mip_spectra(run: RunSettings) -> Dict[str, Any]:
+    load = LoadTriggered(
+        run.folders["triggered"], run.raw_file, run.tree, run.step_size
+    )
+    spectra = MipSpectra(run.pos_arrays())
+    spectra.fill_chunks(load.iterate(run.trigger, branches=spectra._branches()))
+    spectra.save(run.folders["analysis"] / "mip_spectra.npz")
+    spectra.save_calibration(run.folders["mask"])
+    return {"n_valid": int(np.count_nonzero(spectra.fit()["is_valid"]))}
+
+
+def _stage_slab_statistics(run: RunSettings) -> Dict[str, Any]:
+    statistics = slab_statistics(
+        run.raw_file, run.tree, cache_folder=run.folders["analysis"]
+    )
+    return {"n_events": statistics.n_events}
+
+
+def _stage_sum_energy_fit(run: RunSettings) -> Dict[str, Any]:
+    load = LoadTriggered(
+        run.folders["triggered"], run.raw_file, run.tree, run.step_size
+    )
+    sum_energy = load(run.trigger, branches=["sum_energy"]).sum_energy
+    res = SumEnergyFit(np.asarray(sum_energy)).fit_double_gauss()
+    parameters = [
+        "noise_fraction",
+        "noise_mean",
+        "noise_width",
+        "mip_mean",
+        "mip_width",
+    ]
+    result = {
+        "success": bool(res.success),
+        **{p: float(value) for p, value in zip(parameters, res.x)},
+    }
+    with (run.folders["analysis"] / "sum_energy_fit.json").open("w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+class Stage(NamedTuple):
+    function: Callable[[RunSettings], Dict[str, Any]]
+    depends: Tuple[str, ...]
+    settings: Tuple[str, ...]  # The `RunSettings` fields that affect the outputs.
+    outputs: Tuple[str, ...] = ()  # "{folder}/{file}", removed when outdated.
+
+
+stages = {
+    # The trigger cache and the slab statistics check their source themselves.
+    "triggered": Stage(_stage_triggered, (), ("tree", "trigger")),
+    "event_summaries": Stage(_stage_event_summaries, ("triggered",), ()),
+    "mask": Stage(
+        _stage_mask,
+        (),
+        ("tree", "pos"),
+        ("mask/mask.npz", "mask/mask_history.npz"),
+    ),
+    "layer_histograms": Stage(
+        _stage_layer_histograms,
+        (),
+        ("tree", "pos"),
+        ("analysis/layer_histograms.npz",),
+    ),
+    "mip_spectra": Stage(_stage_mip_spectra, ("triggered", "mask"), ("pos",)),
+    "slab_statistics": Stage(_stage_slab_statistics, (), ("tree",)),
+    "sum_energy_fit": Stage(_stage_sum_energy_fit, ("triggered",), ()),
+}
+
+
+def _with_dependencies(names: List[str]) -> List[str]:
+    """The stages in order of the pipeline, including those they depend on."""
+    needed = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in stages:
+            raise ValueError(f"Unknown stage {name!r}. Choose from {list(stages)}.")
+        if name not in needed:
+            needed.add(name)
+            todo.extend(stages[name].depends)
+    return [name for name in stages if name in needed]
+
+
+def _source_fingerprint(run: RunSettings) -> Dict[str, Any]:
+    stat = run.raw_file.stat()
+    return {
+        "file": str(run.raw_file.resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def stage_fingerprint(
+    run: RunSettings,
+    name: str,
+    dependencies: Dict[str, str],
+) -> str:
+    """A hash of everything a stage's outputs depend on."""
+    identity = {
+        "stage": name,
+        "version": __version__,
+        "source": _source_fingerprint(run),
+        "settings": {field: getattr(run, field) for field in stages[name].settings},
+        "options": run.stage_options.get(name, {}),
+        "depends": {d: dependencies[d] for d in stages[name].depends},
+    }
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def _stamp_file(run: RunSettings, name: str) -> Path:
+    return run.folders["pipeline"] / f"{name}.json"
+
+
+def _is_up_to_date(run: RunSettings, name: str, fingerprint: str) -> bool:
+    stamp_file = _stamp_file(run, name)
+    if not stamp_file.exists():
+        return False
+    with stamp_file.open() as f:
+        return json.load(f)["fingerprint"] == fingerprint
+
+
+def _run_stage(run: RunSettings, name: str, fingerprint: str) -> Dict[str, Any]:
+    """Worker function: Run a stage from scratch and write its stamp."""
+    for folder in run.folders.values():
+        folder.mkdir(parents=True, exist_ok=True)
+    for output in stages[name].outputs:
+        kind, file_name = output.split("/")
+        (run.folders[kind] / file_name).unlink(missing_ok=True)
+    time_start = time.time()
+    result = stages[name].function(run)
+    stamp = {
+        "fingerprint": fingerprint,
+        "result": result,
+        "duration": time.time() - time_start,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    stamp_file = _stamp_file(run, name)
+    tmp_file = stamp_file.with_name(stamp_file.name + ".part")
+    with tmp_file.open("w") as f:
+        json.dump(stamp, f, indent=2)
+    tmp_file.replace(stamp_file)
+    return result
+
+
+def run_pipeline(
+    run: RunSettings,
+    names: Optional[List[str]] = None,
+    n_workers: int = 1,
+    force: bool = False,
+) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Run the stages (and those they depend on), skipping the up-to-date ones.
+
+    Stages run as soon as the stages they depend on are done, up to `n_workers`
+    at a time in separate processes. The result of each stage is returned, with
+    None for failed stages and the stages that depend on them.
+    """
+    names = _with_dependencies(names or list(stages))
+    fingerprints: Dict[str, str] = {}  # Of the stages that are done.
+    pending: Dict[str, str] = {}
+    results: Dict[str, Optional[Dict[str, Any]]] = {}
+    running: Dict[Future, str] = {}
+
+    def ready() -> List[str]:
+        return [
+            name
+            for name in names
+            if name not in results
+            and name not in running.values()
+            and all(d in fingerprints for d in stages[name].depends)
+        ]
+
+    def skip_failed() -> None:
+        for name in names:
+            if name not in results and any(
+                results.get(d, {}) is None for d in stages[name].depends
+            ):
+                print(f"Stage {name} skipped: a stage it depends on failed.")
+                results[name] = None
+
+    with ProcessPoolExecutor(max(n_workers, 1)) as executor:
+        while len(results) < len(names):
+            skip_failed()
+            for name in ready():
+                fingerprint = stage_fingerprint(run, name, fingerprints)
+                if not force and _is_up_to_date(run, name, fingerprint):
+                    with _stamp_file(run, name).open() as f:
+                        results[name] = json.load(f)["result"]
+                    fingerprints[name] = fingerprint
+                    print(f"Stage {name} is up to date.")
+                    continue
+                print(f"Stage {name} started.")
+                future = executor.submit(_run_stage, run, name, fingerprint)
+                running[future] = name
+                pending[name] = fingerprint
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    fingerprints[name] = pending.pop(name)
+                    print(f"Stage {name} done: {results[name]}.")
+                except Exception as e:
+                    print(f"Stage {name} failed: {e!r}.")
+                    results[name] = None
+    return {name: results[name] for name in names}
@@ -1,5 +1,7 @@
 """File reading and writing functionality tailored for the cosmics usecase."""
 from .event_selection import LoadTriggered
 from .mask_from_build_file import Mask
+from .multi_run import process_runs
+from .staging import RunSpec, StagingCache
 
-__all__ = ["LoadTriggered", "Mask"]
+__all__ = ["LoadTriggered", "Mask", "RunSpec", "StagingCache", "process_runs"]
@@ -0,0 +1,122 @@
+"""Find events by their `event` and `bcid` values, without scanning the run."""
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import awkward as ak
+import numpy as np
+
+from .memory import AdaptiveStepSize, iterate_adaptive
+from .utils import EntryRange, merge_ranges, missing_ranges, write_npz
+
+index_branches = ["event", "bcid"]
+
+
+def index_key(source: Dict[str, Any]) -> str:
+    identity = [source["uuid"], source["tree"]]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()[:16]
+
+
+class EventIndex:
+    """The `event` and `bcid` value of every raw entry, sorted for lookups.
+
+    Usually filled as a side product of the trigger pass (the values are read
+    together with the trigger branches). Raw entry ranges that were not seen
+    by a trigger pass are read directly with `fill`, which only needs the two
+    small branches.
+    """
+
+    def __init__(self, source: Dict[str, Any]) -> None:
+        self.source = source
+        num_entries = source["num_entries"]
+        self.values = {
+            name: np.full(num_entries, -1, np.int64) for name in index_branches
+        }
+        self.entry_ranges: List[EntryRange] = []
+        self._order: Optional[np.ndarray] = None
+
+    def add(self, entry_range: EntryRange, values: Dict[str, np.ndarray]) -> None:
+        start, stop = entry_range
+        for name in index_branches:
+            self.values[name][start:stop] = values[name]
+        self.entry_ranges = merge_ranges(self.entry_ranges + [entry_range])
+        self._order = None
+
+    def missing_ranges(self) -> List[EntryRange]:
+        return missing_ranges(self.entry_ranges, self.source["num_entries"])
+
+    def fill(self, tree, step_size: Union[str, int] = "100 MB") -> None:
+        """Read the index branches of the raw entries that are not yet indexed."""
+        step = AdaptiveStepSize(step_size)
+        for missing_start, missing_stop in self.missing_ranges():
+            batches = iterate_adaptive(
+                tree, index_branches, missing_start, missing_stop, step
+            )
+            for batch, start, stop in batches:
+                values = {name: ak.to_numpy(batch[name]) for name in index_branches}
+                self.add((start, stop), values)
+
+    def _sorted(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The raw entries sorted by (event, bcid), and the sorted values."""
+        if self._order is None:
+            entries = np.concatenate(
+                [np.arange(a, b) for a, b in self.entry_ranges]
+                + [np.zeros(0, np.int64)]
+            )
+            event, bcid = (self.values[name][entries] for name in index_branches)
+            self._order = entries[np.lexsort((bcid, event))]
+        return (
+            self._order,
+            self.values["event"][self._order],
+            self.values["bcid"][self._order],
+        )
+
+    def entries(
+        self,
+        event: int,
+        bcid: Optional[int] = None,
+        delta: int = 0,
+    ) -> np.ndarray:
+        """The raw entries with this `event` value (and `bcid` within +-`delta`).
+
+        A lookup is a binary search on the sorted values, no scan of the run.
+        """
+        order, events, bcids = self._sorted()
+        start, stop = np.searchsorted(events, [event, event + 1])
+        if bcid is not None:
+            start, stop = start + np.searchsorted(
+                bcids[start:stop], [bcid - delta, bcid + delta + 1]
+            )
+        return np.sort(order[start:stop])
+
+    def save(self, file_name: Union[str, Path]) -> None:
+        file_name = Path(file_name)
+        file_name.parent.mkdir(parents=True, exist_ok=True)
+        write_npz(
+            {
+                "source": np.array(json.dumps(self.source)),
+                "entry_ranges": np.array(self.entry_ranges, dtype=np.int64).reshape(
+                    -1, 2
+                ),
+                **self.values,
+            },
+            file_name,
+        )
+
+    @classmethod
+    def load(cls, file_name: Union[str, Path], source: Dict[str, Any]) -> "EventIndex":
+        """The stored index, extended if events were appended to the `source`."""
+        index = cls(source)
+        if not Path(file_name).exists():
+            return index
+        with np.load(file_name) as npz:
+            stored_source = json.loads(str(npz["source"]))
+            if stored_source["num_entries"] > source["num_entries"]:
+                print(f"The source changed, the event index is rebuilt: {file_name}.")
+                return index
+            n_stored = stored_source["num_entries"]
+            for name in index_branches:
+                index.values[name][:n_stored] = npz[name]
+            index.entry_ranges = [(int(a), int(b)) for a, b in npz["entry_ranges"]]
+        return index
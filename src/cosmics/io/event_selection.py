@@ -1,36 +1,294 @@
 """Load (or create) only those events passing a trigger/cut."""
+import functools
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import awkward as ak
+import numpy as np
 import psutil
 import tqdm.auto as tqdm
 import uproot
 
+from .event_index import EventIndex, index_branches, index_key
+from .memory import AdaptiveStepSize, iterate_adaptive, memory_size
+from .trigger_cache import (
+    CacheIndex,
+    TriggerCache,
+    cache_key,
+    range_hash,
+    source_fingerprint,
+)
+from .trigger_expression import (
+    Comparison,
+    canonical_trigger,
+    implies,
+    simple_conjunction,
+    trigger_branches,
+)
 
-def _check_step_size_is_reasonable(step_size: Union[str, int, float]) -> None:
-    step_size = str(step_size)
-    number = float(step_size[:-2])
-    if step_size.endswith("GB"):
-        number = float(step_size[:-2]) * 1024 ** 3
-    elif step_size.endswith("MB"):
-        number = float(step_size[:-2]) * 1024 ** 2
-    elif step_size.endswith("kB"):
-        number = float(step_size[:-2]) * 1024 ** 1
-    else:
-        print("The step size should be specified in terms of MB/GB.", step_size)
-        return
-    memory_available = psutil.virtual_memory().available
-    if number > memory_available / 20:
-        # The value is chosen by personal experience with our cosmics files
-        # and might not always be reasonable.
-        print(
-            "The batch size seems too large for this machine's memory: "
-            f"{step_size=} with {memory_available / 1024 ** 3:.2f} GB available."
+
+def _split_step_size(step_size: Union[str, int], n_workers: int) -> Union[str, int]:
+    """Share the memory budget of a single batch among all workers."""
+    if isinstance(step_size, int):  # uproot interprets integers as entries.
+        return max(1, step_size // n_workers)
+    return f"{memory_size(step_size) // n_workers} B"
+
+
+def _entry_ranges(
+    tree,
+    entry_range: Tuple[int, int],
+    n_ranges: int,
+) -> List[Tuple[int, int]]:
+    """Split the `entry_range` into up to `n_ranges` ranges aligned with the baskets."""
+    entry_start, entry_stop = entry_range
+    offsets = np.array(tree.common_entry_offsets())
+    offsets = offsets[(offsets > entry_start) & (offsets < entry_stop)]
+    offsets = np.concatenate([[entry_start], offsets, [entry_stop]])
+    targets = np.linspace(entry_start, entry_stop, n_ranges + 1)
+    boundaries = offsets[np.abs(offsets[:, None] - targets).argmin(axis=0)]
+    boundaries = np.unique(boundaries)
+    return [(int(a), int(b)) for a, b in zip(boundaries[:-1], boundaries[1:])]
+
+
+def _basket_boundaries(tree, branches: Optional[List[str]]) -> np.ndarray:
+    """The entries at which a basket of any of the branches starts (or ends)."""
+    names = tree.keys() if branches is None else branches
+    offsets = [tree[name].entry_offsets for name in names]
+    return np.unique(np.concatenate(offsets))
+
+
+def _common_boundaries(tree, branches: Optional[List[str]]) -> np.ndarray:
+    """The entries at which a basket of every one of the branches starts (or ends).
+
+    A range between these cuts no basket of the branches, even if their baskets
+    are laid out differently (e.g. event-level and hit-level branches).
+    """
+    names = tree.keys() if branches is None else branches
+    offsets = [np.asarray(tree[name].entry_offsets) for name in names]
+    return functools.reduce(np.intersect1d, offsets)
+
+
+def _basket_ranges_with(
+    boundaries: np.ndarray,
+    entries: np.ndarray,
+) -> List[Tuple[int, int]]:
+    """The (merged, if adjacent) basket ranges that contain any of the entries."""
+    if len(entries) == 0:
+        return []
+    i_basket = np.unique(np.searchsorted(boundaries, entries, side="right") - 1)
+    starts, stops = boundaries[i_basket], boundaries[i_basket + 1]
+    is_first = np.concatenate([[True], starts[1:] != stops[:-1]])
+    is_last = np.append(is_first[1:], True)
+    return [(int(a), int(b)) for a, b in zip(starts[is_first], stops[is_last])]
+
+
+def _read_entries(
+    tree,
+    entries: np.ndarray,
+    branches: Optional[List[str]] = None,
+) -> ak.Array:
+    """The events at the (sorted) raw `entries`, reading only their baskets."""
+    boundaries = _basket_boundaries(tree, branches)
+    parts = [tree.arrays(branches, entry_start=0, entry_stop=0)]
+    for start, stop in _basket_ranges_with(boundaries, entries):
+        in_range = entries[(entries >= start) & (entries < stop)]
+        batch = tree.arrays(branches, entry_start=start, entry_stop=stop)
+        parts.append(batch[in_range - start])
+    return ak.packed(ak.concatenate(parts))
+
+
+class _TriggeredBatch(NamedTuple):
+    entry_start: int
+    entry_stop: int
+    events: ak.Array
+    entries: np.ndarray  # The raw entry number of each triggered event.
+    selections: Dict[str, np.ndarray]  # Per trigger, which of the events pass it.
+    index_values: Dict[str, np.ndarray]  # `event` and `bcid` of all raw entries.
+    trigger_values: ak.Array  # The trigger and index branches of all raw entries.
+
+
+def _iterate_triggered(
+    tree,
+    triggers: List[str],
+    entry_start: int,
+    entry_stop: int,
+    step_size: Union[str, int],
+    branches: Optional[List[str]] = None,
+    n_workers: int = 1,
+) -> Iterator[_TriggeredBatch]:
+    """Yield the events that pass any of the `triggers`, batch by batch.
+
+    The triggers are evaluated on their own branches first. The (heavy) output
+    branches are only read for those baskets that contain triggered entries.
+    Batches end where all read branches share a basket boundary, so that no
+    basket is decompressed twice. Without such a boundary, a batch ends at the
+    step size, and the baskets at its ends are read by both neighbouring batches.
+    The batch sizes adapt to the free memory, which is shared among `n_workers`.
+    """
+    step = AdaptiveStepSize(step_size, memory_fraction=1 / 20 / n_workers)
+    # The batch size refers to the memory of reading all output branches.
+    bytes_per_entry = step.target_bytes / step.n_entries(tree, branches)
+    step.expect(bytes_per_entry)
+    # The index branches are small, and come for free with the trigger pass.
+    index_names = [name for name in index_branches if name in tree.keys()]
+    batch_branches = sorted(
+        {b for t in triggers for b in trigger_branches(t)} | set(index_names)
+    )
+    output_branches = tree.keys() if branches is None else branches
+    boundaries = _common_boundaries(tree, batch_branches + list(output_branches))
+    batch_iter = iterate_adaptive(
+        tree,
+        batch_branches,
+        entry_start,
+        entry_stop,
+        step,
+        boundaries,
+        update=False,
+    )
+    for trigger_batch, start, stop in batch_iter:
+        passing = {
+            trigger: np.asarray(ak.numexpr.evaluate(trigger, trigger_batch))
+            for trigger in triggers
+        }
+        is_triggered = np.logical_or.reduce(list(passing.values()))
+        entries = start + np.flatnonzero(is_triggered)
+        selections = {
+            trigger: passes[is_triggered] for trigger, passes in passing.items()
+        }
+        triggered_parts = [tree.arrays(branches, entry_start=start, entry_stop=start)]
+        for basket_start, basket_stop in _basket_ranges_with(boundaries, entries):
+            basket_start, basket_stop = max(basket_start, start), min(basket_stop, stop)
+            in_range = entries[(entries >= basket_start) & (entries < basket_stop)]
+            batch = tree.arrays(
+                branches,
+                entry_start=basket_start,
+                entry_stop=basket_stop,
+            )
+            bytes_per_entry = batch.nbytes / (basket_stop - basket_start)
+            triggered_parts.append(batch[in_range - basket_start])
+        triggered = ak.packed(ak.concatenate(triggered_parts))
+        n_bytes = trigger_batch.nbytes + bytes_per_entry * (stop - start)
+        step.update(stop - start, int(n_bytes))
+        index_values = {name: ak.to_numpy(trigger_batch[name]) for name in index_names}
+        yield _TriggeredBatch(
+            start, stop, triggered, entries, selections, index_values, trigger_batch
         )
 
 
+def _trigger_entry_range(
+    root_file: Path,
+    root_tree: str,
+    triggers: List[str],
+    entry_range: Tuple[int, int],
+    step_size: Union[str, int],
+    branches: Optional[List[str]] = None,
+    n_workers: int = 1,
+) -> _TriggeredBatch:
+    """Worker function: Each process opens the file on its own."""
+    tree = uproot.open(root_file)[root_tree]
+    batches = list(
+        _iterate_triggered(tree, triggers, *entry_range, step_size, branches, n_workers)
+    )
+    return _TriggeredBatch(
+        entry_range[0],
+        entry_range[1],
+        ak.concatenate([batch.events for batch in batches]),
+        np.concatenate([batch.entries for batch in batches]),
+        {
+            trigger: np.concatenate([batch.selections[trigger] for batch in batches])
+            for trigger in triggers
+        },
+        {
+            name: np.concatenate([batch.index_values[name] for batch in batches])
+            for name in batches[0].index_values
+        },
+        ak.concatenate([batch.trigger_values for batch in batches]),
+    )
+
+
+def _split_by_triggers(
+    missing: Dict[str, List[Tuple[int, int]]],
+) -> List[Tuple[Tuple[int, int], List[str]]]:
+    """The raw entry ranges, each with the triggers that have not processed it yet."""
+    edges = sorted({edge for ranges in missing.values() for r in ranges for edge in r})
+    parts: List[Tuple[Tuple[int, int], List[str]]] = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        triggers = [
+            trigger
+            for trigger, ranges in missing.items()
+            if any(a <= start and stop <= b for a, b in ranges)
+        ]
+        if parts and parts[-1][1] == triggers and parts[-1][0][1] == start:
+            parts[-1] = ((parts[-1][0][0], stop), triggers)
+        elif triggers:
+            parts.append(((start, stop), triggers))
+    return parts
+
+
+class _ChunkBuffer:
+    """Regroup the triggered batches into chunks of `chunk_size` events."""
+
+    def __init__(self, chunk_size: Optional[int] = None) -> None:
+        self._chunk_size = chunk_size
+        self._buffer: List[ak.Array] = []
+        self._n_buffered = 0
+        self._n_yielded = 0
+
+    def add(self, triggered: ak.Array) -> Iterator[ak.Array]:
+        if self._chunk_size is None:
+            if len(triggered):
+                self._n_yielded += 1
+                yield triggered
+            else:
+                self._buffer = [triggered]  # Keep the type for `flush`.
+            return
+        self._buffer.append(triggered)
+        self._n_buffered += len(triggered)
+        if self._n_buffered < self._chunk_size:
+            return
+        buffered = ak.concatenate(self._buffer)
+        n_full = len(buffered) - len(buffered) % self._chunk_size
+        for i in range(0, n_full, self._chunk_size):
+            self._n_yielded += 1
+            yield ak.packed(buffered[i : i + self._chunk_size])
+        self._buffer = [ak.packed(buffered[n_full:])]
+        self._n_buffered = len(self._buffer[0])
+
+    def flush(self) -> Iterator[ak.Array]:
+        """The remaining events. At least one (typed) chunk is always provided."""
+        if self._buffer and (self._n_buffered or not self._n_yielded):
+            yield ak.packed(ak.concatenate(self._buffer))
+        self._buffer = []
+        self._n_buffered = 0
+
+
+def _entry_stops(
+    cache: TriggerCache,
+    num_entries: int,
+    entry_stop: int,
+) -> Tuple[int, Optional[int]]:
+    """The raw and triggered entry stop of a query.
+
+    With a complete cache, `entry_stop` refers to the number of triggered events.
+    Otherwise it refers to pre-trigger events.
+    """
+    if entry_stop < 0:
+        return num_entries, None
+    if cache.is_complete(num_entries):
+        return num_entries, entry_stop
+    return min(entry_stop, num_entries), None
+
+
+def _partitions(events: ak.Array) -> List[ak.layout.Content]:
+    layout = events.layout
+    if isinstance(layout, ak.partition.PartitionedArray):
+        return list(layout.partitions)
+    return [layout]
+
+
 class LoadTriggered:
     def __init__(
         self,
@@ -38,91 +296,492 @@ class LoadTriggered:
         root_file: Union[str, Path],
         root_tree: str,
         step_size: str = "100 MB",
+        n_workers: int = 1,
     ) -> None:
+        """With `n_workers > 1`, raw entry ranges are triggered in parallel processes.
+
+        `step_size` stays the combined memory ceiling: each worker reads batches of
+        `step_size / n_workers`.
+        """
         self._triggered_file_folder = Path(triggered_file_folder)
         self._root_file = Path(root_file)
         self._root_tree = root_tree
         self._step_size = step_size
-        self._symbol_name_map = {
-            ">": "_greater_than_",
-            "<": "_smaller_than_",
+        self._n_workers = n_workers
+
+    def cache_key(self, trigger: str) -> str:
+        """The name of the trigger's cache folder within `triggered_file_folder`."""
+        tree = uproot.open(self._root_file)[self._root_tree]
+        return cache_key(
+            canonical_trigger(trigger), source_fingerprint(tree, self._root_tree)
+        )
+
+    def _iterate_triggered_parallel(
+        self,
+        tree,
+        triggers: List[str],
+        missing_ranges: List[Tuple[int, int]],
+        branches: Optional[List[str]] = None,
+    ) -> Iterator[_TriggeredBatch]:
+        """Yield the triggered ranges in order, with at most `n_workers` in flight.
+
+        Thus only the results of a few ranges are held at a time, within the
+        memory ceiling of `step_size` (shared among the workers).
+        """
+        # More ranges than workers, so that a slow range does not stall the pool.
+        n_missing = sum(stop - start for start, stop in missing_ranges)
+        entry_ranges = [
+            entry_range
+            for missing in missing_ranges
+            for entry_range in _entry_ranges(
+                tree,
+                missing,
+                1 + 4 * self._n_workers * (missing[1] - missing[0]) // n_missing,
+            )
+        ]
+        step_size = _split_step_size(self._step_size, self._n_workers)
+        with ProcessPoolExecutor(self._n_workers) as executor:
+            pending: deque = deque()
+            for entry_range in entry_ranges:
+                pending.append(
+                    executor.submit(
+                        _trigger_entry_range,
+                        self._root_file,
+                        self._root_tree,
+                        triggers,
+                        entry_range,
+                        step_size,
+                        branches,
+                        self._n_workers,
+                    )
+                )
+                if len(pending) >= self._n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _iterate_new(
+        self,
+        tree,
+        triggers: List[str],
+        missing_ranges: List[Tuple[int, int]],
+        branches: Optional[List[str]] = None,
+    ) -> Iterator[_TriggeredBatch]:
+        """Trigger the raw entries that are not yet in the caches of the `triggers`."""
+        if self._n_workers > 1:
+            yield from self._iterate_triggered_parallel(
+                tree, triggers, missing_ranges, branches
+            )
+            return
+        for missing_range in missing_ranges:
+            yield from _iterate_triggered(
+                tree, triggers, *missing_range, self._step_size, branches
+            )
+
+    def _open_cache(self, trigger_cleaned: str) -> Tuple[object, str, TriggerCache]:
+        tree = uproot.open(self._root_file)[self._root_tree]
+        source = source_fingerprint(tree, self._root_tree)
+        key = cache_key(trigger_cleaned, source)
+        cache = TriggerCache(
+            self._triggered_file_folder / key, trigger_cleaned, source, tree
+        )
+        return tree, key, cache
+
+    def _event_index_file(self, source: Dict) -> Path:
+        return self._triggered_file_folder / "event_index" / f"{index_key(source)}.npz"
+
+    def _load_event_index(self, tree) -> EventIndex:
+        source = source_fingerprint(tree, self._root_tree)
+        return EventIndex.load(self._event_index_file(source), source)
+
+    def cache(self, trigger: str, entry_stop: int = -1) -> TriggerCache:
+        """The trigger's cache, after triggering the raw entries it is missing."""
+        trigger_cleaned = canonical_trigger(trigger)
+        for _ in self._iterate_events(trigger_cleaned, entry_stop, only_new=True):
+            pass
+        return self._open_cache(trigger_cleaned)[2]
+
+    def event_index(self) -> EventIndex:
+        """The `event`/`bcid` index of the raw entries, completed where necessary.
+
+        It is stored next to the trigger caches, and filled by every trigger pass.
+        """
+        tree = uproot.open(self._root_file)[self._root_tree]
+        event_index = self._load_event_index(tree)
+        if event_index.missing_ranges():
+            event_index.fill(tree, self._step_size)
+            event_index.save(self._event_index_file(event_index.source))
+        return event_index
+
+    def build(self, triggers: List[str], entry_stop: int = -1) -> Dict[str, int]:
+        """Fill the caches of several triggers in a single pass over the raw tree.
+
+        Each batch is read and decompressed once, and all triggers are evaluated
+        on it. Returns the number of cached events per (canonical) trigger.
+        """
+        tree = uproot.open(self._root_file)[self._root_tree]
+        raw_stop = tree.num_entries if entry_stop < 0 else entry_stop
+        raw_stop = min(raw_stop, tree.num_entries)
+        caches = {}
+        for trigger in triggers:
+            trigger_cleaned = canonical_trigger(trigger)
+            caches[trigger_cleaned] = self._open_cache(trigger_cleaned)[1:]
+        missing = {
+            t: cache.missing_ranges(raw_stop) for t, (_, cache) in caches.items()
         }
+        parts = _split_by_triggers(missing)
+        n_missing = sum(stop - start for (start, stop), _ in parts)
+        if parts:
+            print(
+                f"{n_missing} raw events have to be triggered for {len(parts)} part(s)."
+            )
+        event_index = self._load_event_index(tree)
+        time_start_building = time.time()
+        with tqdm.tqdm(desc="Raw events", total=n_missing, disable=not parts) as p_bar:
+            for entry_range, part_triggers in parts:
+                for batch in self._iterate_new(tree, part_triggers, [entry_range]):
+                    for trigger in part_triggers:
+                        selection = batch.selections[trigger]
+                        caches[trigger][1].add_chunk(
+                            (batch.entry_start, batch.entry_stop),
+                            batch.events[selection],
+                            batch.entries[selection],
+                            range_hash(batch.trigger_values),
+                        )
+                    if batch.index_values:
+                        event_index.add(
+                            (batch.entry_start, batch.entry_stop), batch.index_values
+                        )
+                    p_bar.update(batch.entry_stop - batch.entry_start)
+        if parts:
+            building_time = time.time() - time_start_building
+            print(f"Selecting the events took {int(building_time)}s.")
+            index = CacheIndex(self._triggered_file_folder)
+            for trigger, (key, cache) in caches.items():
+                if missing[trigger]:
+                    index.update(key, cache, building_time)
+            event_index.save(self._event_index_file(event_index.source))
+        return {trigger: cache.n_triggered for trigger, (_, cache) in caches.items()}
 
-    def trigger_to_filename(self, trigger: str):
-        """Seems to be necessary for saving as a parquet file."""
-        for k, v in self._symbol_name_map.items():
-            trigger = trigger.replace(k, v)
-        return trigger
-
-    def _load_events(self, filename: Path, entry_stop: int) -> ak.Array:
-        events = ak.from_parquet(filename)
-        if len(events) < entry_stop:
-            print(f"WARNING: {entry_stop} triggered requested, got {len(events)}.")
-        events = events[:entry_stop]
-        return events
+    def bitmap(self, trigger: str) -> np.ndarray:
+        """Per raw entry, whether it passes the `trigger` (from its complete cache).
+
+        Bitmaps of several triggers combine with `&`, `|` and `~`, and
+        `events_at` reads the events of such a combination.
+        """
+        trigger_cleaned = canonical_trigger(trigger)
+        tree, _, cache = self._open_cache(trigger_cleaned)
+        if not cache.is_complete(tree.num_entries):
+            self.build([trigger_cleaned])
+            tree, _, cache = self._open_cache(trigger_cleaned)
+        return cache.bitmap(tree.num_entries)
+
+    def events_at(
+        self,
+        selection: np.ndarray,
+        trigger: Optional[str] = None,
+        branches: Optional[List[str]] = None,
+    ) -> ak.Array:
+        """The events at the raw entries of a `selection` (entry numbers or bitmap).
 
-    def _select_events(
+        With a `trigger`, only its cached events are considered, and they are read
+        from the cache (only the row groups that contain them). This suits subsets,
+        e.g. `bitmap(a) & ~bitmap(b)` with trigger `a`. Otherwise, the events are
+        read from the ROOT file (only the baskets that contain them).
+        """
+        selection = np.asarray(selection)
+        entries = np.flatnonzero(selection) if selection.dtype == bool else selection
+        entries = np.sort(entries)
+        if trigger is None:
+            tree = uproot.open(self._root_file)[self._root_tree]
+            return _read_entries(tree, entries, branches)
+        cache = self.cache(trigger)
+        parts = [
+            cache.read_rows(chunk, rows, branches)
+            for chunk, rows in cache.rows_of(entries)
+        ]
+        if not parts:
+            return next(cache.iterate_chunk(cache.chunks[0], 0, branches))
+        return ak.concatenate(parts)
+
+    def find(
+        self,
+        event: int,
+        bcid: Optional[int] = None,
+        delta: int = 0,
+        trigger: Optional[str] = None,
+        branches: Optional[List[str]] = None,
+    ) -> ak.Array:
+        """The events with this `event` value (and `bcid` within +-`delta`).
+
+        Without a `trigger`, they are read from the ROOT file, else from the
+        trigger's cache (only those that pass the trigger). In both cases, only the
+        baskets or row groups that contain the events are read.
+        """
+        entries = self.event_index().entries(event, bcid, delta)
+        return self.events_at(entries, trigger, branches)
+
+    def _lazy_events(
         self,
         trigger_cleaned: str,
-        filename: Path,
         entry_stop: int,
+        branches: Optional[List[str]] = None,
     ) -> ak.Array:
-        time_start_building = time.time()
-        print(f"No prebuilt file build for trigger: {trigger_cleaned}. Please wait.")
-        if entry_stop != -1:
-            print(
-                f"Only partial reading ({entry_stop} events) was chosen. "
-                "In this setting, the created arrays will not be saved to disk. "
-                "As it is a new query, `entry_stop` refers to pre-trigger events. "
+        # Ensure that the requested raw entries are in the cache.
+        for _ in self._iterate_events(trigger_cleaned, entry_stop, only_new=True):
+            pass
+        tree, _, cache = self._open_cache(trigger_cleaned)
+        raw_stop, triggered_stop = _entry_stops(cache, tree.num_entries, entry_stop)
+        chunk_events = [
+            cache.lazy_chunk(chunk, raw_stop, branches)
+            for chunk in cache.chunks
+            if chunk["entry_start"] < raw_stop
+        ]
+        chunk_events = [events for events in chunk_events if events is not None]
+        if not chunk_events:
+            return next(cache.iterate_chunk(cache.chunks[0], raw_stop, branches))
+        # While `chunk_events` is alive, the new array picks up their lazy caches.
+        partitions = [p for events in chunk_events for p in _partitions(events)]
+        events = ak.Array(ak.partition.IrregularlyPartitionedArray(partitions))
+        if triggered_stop is not None:
+            if len(events) < triggered_stop:
+                print(f"WARNING: {entry_stop} triggered requested, got {len(events)}.")
+            events = events[:triggered_stop]
+        return events
+
+    def _find_superset(
+        self,
+        tree,
+        cache: TriggerCache,
+        comparisons: List[Comparison],
+    ) -> Optional[TriggerCache]:
+        """The smallest cache of the same source with a trigger implied by ours."""
+        source = cache.source or {}
+        candidates = []
+        for key, entry in CacheIndex(self._triggered_file_folder).entries.items():
+            entry_source = entry["source"] or {}
+            if entry_source.get("file") != source.get("file"):
+                continue
+            if entry_source.get("tree") != source.get("tree"):
+                continue
+            if entry["trigger"] == cache.trigger:
+                continue
+            superset_comparisons = simple_conjunction(entry["trigger"])
+            if superset_comparisons is None:
+                continue
+            if implies(comparisons, superset_comparisons):
+                candidates.append((entry["n_triggered"], key, entry["trigger"]))
+        if not candidates:
+            return None
+        _, key, trigger = min(candidates)
+        return TriggerCache(
+            self._triggered_file_folder / key, trigger, cache.source, tree
+        )
+
+    def _derive_from_superset(
+        self,
+        tree,
+        key: str,
+        cache: TriggerCache,
+        raw_stop: int,
+    ) -> None:
+        """Fill the missing chunks by filtering a cached, looser trigger's events.
+
+        This is possible if both triggers are conjunctions of simple comparisons,
+        e.g. `nhit_slab > 10` from the cache of `nhit_slab > 5`.
+        """
+        missing_ranges = cache.missing_ranges(raw_stop)
+        comparisons = simple_conjunction(cache.trigger)
+        if not missing_ranges or comparisons is None:
+            return
+        superset = self._find_superset(tree, cache, comparisons)
+        if superset is None:
+            return
+        chunks = [
+            chunk
+            for chunk in superset.chunks
+            if any(
+                start <= chunk["entry_start"] and chunk["entry_stop"] <= stop
+                for start, stop in missing_ranges
             )
-        root_file_object = uproot.open(self._root_file)
-        tree = root_file_object[self._root_tree]
-
-        triggered_batches = []
-        batch_iter = tree.iterate(entry_stop=entry_stop, step_size=self._step_size)
-        _check_step_size_is_reasonable(self._step_size)
-        swap_baseline = psutil.swap_memory().used
-        n_raw = entry_stop if entry_stop >= 0 else tree.num_entries
-        with tqdm.tqdm(
-            batch_iter,
-            desc="Raw events",
-            total=n_raw,
-            postfix={"n_triggered": 0, "mem [%]": psutil.virtual_memory().percent},
-        ) as p_bar:
-            for batch in batch_iter:
-                triggered_batches.append(
-                    ak.packed(batch[ak.numexpr.evaluate(trigger_cleaned, batch)])
-                )
-                if psutil.swap_memory().used - swap_baseline > 0.25 * 1024 ** 3:
-                    swap_baseline = 1024 ** 5  # Ensures this is printed only once.
-                    p_bar.write(
-                        "Warning: No more free memory. Using swap now. "
-                        "This is much slower."
-                    )
-                p_bar.set_postfix(
-                    {
-                        "n_triggered": len(triggered_batches[-1]),
-                        "mem [%]": psutil.virtual_memory().percent,
-                    }
-                )
-                p_bar.update(len(batch))
-        events = ak.flatten(ak.concatenate(triggered_batches), axis=0)
-        if entry_stop == -1:
-            ak.to_parquet(events, filename)
+        ]
+        if not chunks:
+            return
+        time_start_building = time.time()
+        print(f"Deriving trigger {cache.trigger} from the prebuilt {superset.trigger}.")
+        for chunk in tqdm.tqdm(chunks, desc="Prebuilt chunks"):
+            events, entries = superset.filter_chunk(chunk, cache.trigger, comparisons)
+            entry_range = (chunk["entry_start"], chunk["entry_stop"])
+            cache.add_chunk(entry_range, events, entries, chunk.get("hash"))
         building_time = time.time() - time_start_building
         print(f"Selecting the events took {int(building_time)}s.")
-        return events
+        CacheIndex(self._triggered_file_folder).update(key, cache, building_time)
+
+    def _iterate_events(
+        self,
+        trigger_cleaned: str,
+        entry_stop: int,
+        branches: Optional[List[str]] = None,
+        chunk_size: Optional[int] = None,
+        only_new: bool = False,
+    ) -> Iterator[ak.Array]:
+        """Yield the triggered events, from the cache where possible.
+
+        Raw entry ranges that are missing from the cache are triggered, and the
+        results are added to the cache batch by batch.
+        With `only_new`, the events that were already cached are not yielded.
+        """
+        tree, key, cache = self._open_cache(trigger_cleaned)
+        raw_stop, triggered_stop = _entry_stops(cache, tree.num_entries, entry_stop)
+        self._derive_from_superset(tree, key, cache, raw_stop)
+        missing_ranges = cache.missing_ranges(raw_stop)
+        cached_chunks = [c for c in cache.chunks if c["entry_start"] < raw_stop]
+        if only_new:
+            cached_chunks = []
+        is_cached = branches is None  # Only complete events are added to the cache.
+
+        n_missing = sum(stop - start for start, stop in missing_ranges)
+        time_start_building = time.time()
+        if missing_ranges:
+            if cached_chunks:
+                print(f"Extending the prebuilt files for trigger: {trigger_cleaned}.")
+            else:
+                print(f"No prebuilt file build for trigger: {trigger_cleaned}.")
+            print(f"{n_missing} raw events have to be triggered. Please wait.")
+            if not is_cached:
+                print(
+                    f"Only a subset of the branches ({', '.join(branches)}) was "
+                    "chosen. In this setting, the created arrays will not be saved "
+                    "to disk."
+                )
+
+        def iterate_cached_chunk(chunk):
+            yield from cache.iterate_chunk(chunk, raw_stop, branches)
+
+        def iterate_all() -> Iterator[ak.Array]:
+            """Merge cached and new events in raw entry order."""
+            swap_baseline = psutil.swap_memory().used
+            event_index = None
+            if missing_ranges and is_cached:  # Nothing is written for subsets.
+                event_index = self._load_event_index(tree)
+            with tqdm.tqdm(
+                desc="Raw events",
+                total=n_missing,
+                postfix={"n_triggered": 0, "mem [%]": psutil.virtual_memory().percent},
+                disable=not missing_ranges,
+            ) as p_bar:
+                new_batches = self._iterate_new(
+                    tree, [trigger_cleaned], missing_ranges, branches
+                )
+                for batch in new_batches:
+                    while cached_chunks[:1] and (
+                        cached_chunks[0]["entry_start"] < batch.entry_start
+                    ):
+                        yield from iterate_cached_chunk(cached_chunks.pop(0))
+                    if is_cached:
+                        cache.add_chunk(
+                            (batch.entry_start, batch.entry_stop),
+                            batch.events,
+                            batch.entries,
+                            range_hash(batch.trigger_values),
+                        )
+                    if event_index is not None and batch.index_values:
+                        event_index.add(
+                            (batch.entry_start, batch.entry_stop), batch.index_values
+                        )
+                    yield batch.events
+                    if psutil.swap_memory().used - swap_baseline > 0.25 * 1024 ** 3:
+                        swap_baseline = 1024 ** 5  # Ensures this is printed only once.
+                        p_bar.write(
+                            "Warning: No more free memory. Using swap now. "
+                            "This is much slower."
+                        )
+                    p_bar.set_postfix(
+                        {
+                            "n_triggered": len(batch.events),
+                            "mem [%]": psutil.virtual_memory().percent,
+                        }
+                    )
+                    p_bar.update(batch.entry_stop - batch.entry_start)
+            for chunk in cached_chunks:
+                yield from iterate_cached_chunk(chunk)
+            if missing_ranges:
+                building_time = time.time() - time_start_building
+                print(f"Selecting the events took {int(building_time)}s.")
+                if is_cached:
+                    index = CacheIndex(self._triggered_file_folder)
+                    index.update(key, cache, building_time)
+                if event_index is not None:
+                    event_index.save(self._event_index_file(event_index.source))
+
+        buffer = _ChunkBuffer(chunk_size)
+        n_triggered = 0
+        for events in iterate_all():
+            if triggered_stop is not None:
+                events = events[: triggered_stop - n_triggered]
+            n_triggered += len(events)
+            yield from buffer.add(events)
+            if triggered_stop is not None and n_triggered >= triggered_stop:
+                break
+        yield from buffer.flush()
+        if triggered_stop is not None and n_triggered < triggered_stop:
+            print(f"WARNING: {entry_stop} triggered requested, got {n_triggered}.")
 
     def __call__(
         self,
         trigger: str,
         entry_stop: int = -1,
+        branches: Optional[List[str]] = None,
+        lazy: bool = False,
     ) -> ak.Array:
-        trigger_cleaned = trigger = "".join(trigger.split())  # Remove whitespace.
-        file_stem = f"{self.trigger_to_filename(trigger_cleaned)}.parquet"
-        filename = self._triggered_file_folder / file_stem
-        if filename.exists():
-            events = self._load_events(filename, entry_stop)
-        else:
-            events = self._select_events(trigger_cleaned, filename, entry_stop)
-        return events
+        """Only the `branches` are returned, if specified (default: all branches).
+
+        The trigger is evaluated on the branches it references before any other
+        branch is read, so that non-triggered baskets are never decompressed.
+        The triggered events are cached in chunks of raw entries. An interrupted
+        or partial (`entry_stop`) selection is continued where the cache stops.
+        With a complete cache, `entry_stop` refers to the number of triggered events.
+        Otherwise it refers to pre-trigger events.
+
+        With `lazy`, a virtual array on top of the (memory-mapped) cache is returned.
+        A row group of a column is only read when it is accessed.
+        """
+        trigger_cleaned = canonical_trigger(trigger)
+        if lazy:
+            return self._lazy_events(trigger_cleaned, entry_stop, branches)
+        triggered_chunks = list(
+            self._iterate_events(trigger_cleaned, entry_stop, branches)
+        )
+        return ak.concatenate(triggered_chunks)
+
+    def event_level(
+        self,
+        trigger: str,
+        entry_stop: int = -1,
+        lazy: bool = False,
+    ) -> ak.Array:
+        """The event-level (non-jagged) branches of the triggered events.
+
+        These are stored apart from the hit-level branches in the cache, so that
+        only the small event-level files are read.
+        """
+        cache = self.cache(trigger, entry_stop)
+        return self(trigger, entry_stop, cache.event_branches(), lazy)
+
+    def iterate(
+        self,
+        trigger: str,
+        entry_stop: int = -1,
+        branches: Optional[List[str]] = None,
+        chunk_size: int = 100_000,
+    ) -> Iterator[ak.Array]:
+        """Like `__call__`, but yield the triggered events in chunks.
+
+        At most `chunk_size` events are held per chunk, so that runs which do not
+        fit into memory can be processed. New selections are added to the cache
+        as they are produced.
+        """
+        trigger_cleaned = canonical_trigger(trigger)
+        yield from self._iterate_events(
+            trigger_cleaned, entry_stop, branches, chunk_size
+        )
@@ -1,5 +1,10 @@
+import hashlib
+import json
+import struct
+import time
+import zipfile
 from pathlib import Path
-from typing import Dict, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import awkward as ak
 import matplotlib as mpl
@@ -8,27 +13,50 @@ import numpy as np
 import tqdm.auto as tqdm
 import uproot
 
+from .memory import AdaptiveStepSize, iterate_adaptive
+from .trigger_cache import source_fingerprint
+from .utils import write_npz
+
+
+def _position_indices(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """The index of each value within `positions`, or -1 if it is none of them."""
+    order = np.argsort(positions, kind="stable")
+    i_sorted = np.searchsorted(positions, values, sorter=order)
+    indices = order[np.minimum(i_sorted, len(positions) - 1)]
+    return np.where(positions[indices] == values, indices, -1)
+
+
+def _hit_cells(
+    batch: ak.Array,
+    pos: Dict[str, np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The flat cell index and mask value of the hits at the positions `pos`.
+
+    The boolean array selects these hits from all (flattened) hits of the batch.
+    """
+    shape = (len(pos["x"]), len(pos["y"]), len(pos["z"]))
+    hit_ids = [
+        _position_indices(ak.to_numpy(ak.flatten(batch[f"hit_{axis}"])), pos[axis])
+        for axis in ["x", "y", "z"]
+    ]
+    hit_is_masked = ak.to_numpy(ak.flatten(batch.hit_isMasked))
+    in_pos = np.logical_and.reduce([ids >= 0 for ids in hit_ids])
+    cells = np.ravel_multi_index([ids[in_pos] for ids in hit_ids], shape)
+    return cells, hit_is_masked[in_pos].astype(np.int8), in_pos
+
 
 def fill_batch_is_masked(batch, is_masked, pos, tqdm_bar=None):
-    for (x_id, x) in enumerate(pos["x"]):
-        mask_x = batch.hit_x == x
-        batch_y_1 = batch.hit_y[mask_x]
-        batch_z_1 = batch.hit_z[mask_x]
-        batch_m_1 = batch.hit_isMasked[mask_x]
-        for (y_id, y) in enumerate(pos["y"]):
-            mask_y = batch_y_1 == y
-            batch_z_2 = batch_z_1[mask_y]
-            batch_m_2 = batch_m_1[mask_y]
-            for (z_id, z) in enumerate(pos["z"]):
-                if is_masked[x_id, y_id, z_id] != -1:
-                    continue
-                mask_z = batch_z_2 == z
-                batch_m = batch_m_2[mask_z]
-                is_mask_values = ak.flatten(batch_m)
-                if len(is_mask_values):
-                    is_masked[x_id, y_id, z_id] = is_mask_values[0]
-                    if tqdm_bar:
-                        tqdm_bar.update()
+    """Fill the cells that are still undefined (-1) with their first hit's mask value.
+
+    The hits of the batch are mapped to cell indices all at once.
+    """
+    cells, hit_is_masked, _ = _hit_cells(batch, pos)
+    # np.unique returns the index of the first occurrence of each cell.
+    cells, first_hit = np.unique(cells, return_index=True)
+    is_new = is_masked.flat[cells] == -1
+    is_masked.flat[cells[is_new]] = hit_is_masked[first_hit[is_new]]
+    if tqdm_bar:
+        tqdm_bar.update(np.count_nonzero(is_new))
     return is_masked
 
 
@@ -36,19 +64,174 @@ def get_is_masked(
     tree,
     pos: Dict[str, np.ndarray],
     entry_stop: int = -1,
-    step_size: str = "250 MB",
+    step_size: Union[str, int] = "250 MB",
 ) -> np.ndarray:
-    is_masked = np.full((len(pos["x"]), len(pos["y"]), len(pos["z"])), -1)
+    """The batch size adapts to the free memory, up to `step_size`.
+
+    Reading stops as soon as the mask value of every cell is known.
+    """
+    shape = (len(pos["x"]), len(pos["y"]), len(pos["z"]))
+    is_masked = np.full(shape, -1, dtype=np.int8)
     keys = ["hit_x", "hit_y", "hit_z", "hit_isMasked"]
-    n_raw = entry_stop if entry_stop >= 0 else tree.num_entries
+    n_raw = min(entry_stop, tree.num_entries) if entry_stop >= 0 else tree.num_entries
+    step = AdaptiveStepSize(step_size)
     with tqdm.tqdm(desc="Cells found", total=is_masked.size) as cell_bar:
         with tqdm.tqdm(desc="Events", total=n_raw) as event_bar:
-            for batch in tree.iterate(keys, entry_stop=entry_stop, step_size=step_size):
+            for batch, _, _ in iterate_adaptive(tree, keys, 0, n_raw, step):
                 is_masked = fill_batch_is_masked(batch, is_masked, pos, cell_bar)
                 event_bar.update(len(batch))
+                if np.all(is_masked != -1):
+                    break  # Every cell is known, no need to read further events.
     return is_masked
 
 
+class MaskHistory:
+    """The mask states of each cell over a run, as run-length encoded intervals.
+
+    Interval `i` starts at raw entry `entry_starts[i]` (with `bcid_starts[i]`) and
+    holds `states[i]` for cell `cells[i]` until the cell's next interval starts.
+    Before its first interval, a cell is undefined (-1).
+    The intervals are sorted by cell and entry, so lookups are binary searches.
+    """
+
+    def __init__(
+        self,
+        shape: Tuple[int, int, int],
+        num_entries: int,
+        cells: np.ndarray,
+        entry_starts: np.ndarray,
+        states: np.ndarray,
+        bcid_starts: Optional[np.ndarray] = None,
+    ) -> None:
+        self.shape = tuple(int(n) for n in shape)
+        self.num_entries = int(num_entries)
+        order = np.lexsort((entry_starts, cells))  # Stable for identical keys.
+        self.cells = np.asarray(cells, dtype=np.int64)[order]
+        self.entry_starts = np.asarray(entry_starts, dtype=np.int64)[order]
+        self.states = np.asarray(states, dtype=np.int8)[order]
+        if bcid_starts is None:
+            bcid_starts = np.full(len(order), -1)
+        self.bcid_starts = np.asarray(bcid_starts, dtype=np.int32)[order]
+        self._keys = self.cells * (self.num_entries + 1) + self.entry_starts
+
+    def state(self, cells: np.ndarray, entries: np.ndarray) -> np.ndarray:
+        """The mask state of the flat `cells` at the raw `entries`.
+
+        Entries past the history keep its last states, those before it have none.
+        """
+        cells, entries = np.broadcast_arrays(cells, entries)
+        # Out-of-range entries would reach into the keys of a neighbouring cell.
+        entries = np.clip(entries, -1, self.num_entries)
+        queries = cells * (self.num_entries + 1) + entries
+        i = np.searchsorted(self._keys, queries, side="right") - 1
+        i_valid = np.maximum(i, 0)
+        is_defined = (i >= 0) & (self.cells[i_valid] == cells)
+        return np.where(is_defined, self.states[i_valid], -1).astype(np.int8)
+
+    def values_at(self, entry: int) -> np.ndarray:
+        """The (x, y, z) mask at a raw entry."""
+        cells = np.arange(np.prod(self.shape))
+        return self.state(cells, np.full(len(cells), entry)).reshape(self.shape)
+
+    def first_values(self) -> np.ndarray:
+        """The first mask state seen per cell, as from `get_is_masked`."""
+        values = np.full(self.shape, -1, dtype=np.int8)
+        cells, first = np.unique(self.cells, return_index=True)
+        values.flat[cells] = self.states[first]
+        return values
+
+    def intervals(self, x_id: int, y_id: int, z_id: int) -> np.ndarray:
+        """A record array of (entry_start, entry_stop, bcid_start, state) per interval."""
+        cell = np.ravel_multi_index((x_id, y_id, z_id), self.shape)
+        start, stop = np.searchsorted(self.cells, [cell, cell + 1])
+        entry_starts = self.entry_starts[start:stop]
+        entry_stops = np.append(entry_starts[1:], self.num_entries)
+        return np.rec.fromarrays(
+            [
+                entry_starts,
+                entry_stops,
+                self.bcid_starts[start:stop],
+                self.states[start:stop],
+            ],
+            names=["entry_start", "entry_stop", "bcid_start", "state"],
+        )
+
+    def save(self, file_name: Union[str, Path]) -> None:
+        file_name = Path(file_name)
+        write_npz(
+            {
+                "shape": np.array(self.shape),
+                "num_entries": np.array(self.num_entries),
+                "cells": self.cells,
+                "entry_starts": self.entry_starts,
+                "states": self.states,
+                "bcid_starts": self.bcid_starts,
+            },
+            file_name,
+            compressed=True,
+        )
+
+    @classmethod
+    def load(cls, file_name: Union[str, Path]) -> "MaskHistory":
+        with np.load(file_name) as npz:
+            return cls(
+                tuple(npz["shape"]),
+                int(npz["num_entries"]),
+                npz["cells"],
+                npz["entry_starts"],
+                npz["states"],
+                npz["bcid_starts"],
+            )
+
+
+def get_mask_history(
+    tree,
+    pos: Dict[str, np.ndarray],
+    entry_stop: int = -1,
+    step_size: Union[str, int] = "250 MB",
+) -> MaskHistory:
+    """Record every change of a cell's mask state, in a single pass over the tree."""
+    shape = (len(pos["x"]), len(pos["y"]), len(pos["z"]))
+    keys = ["hit_x", "hit_y", "hit_z", "hit_isMasked"]
+    has_bcid = "bcid" in tree.keys()
+    if has_bcid:
+        keys.append("bcid")
+    n_raw = min(entry_stop, tree.num_entries) if entry_stop >= 0 else tree.num_entries
+    last_state = np.full(np.prod(shape), -1, dtype=np.int8)
+    changes: Dict[str, List[np.ndarray]] = {"cells": [], "entries": [], "states": []}
+    bcid_starts = []
+    step = AdaptiveStepSize(step_size)
+    with tqdm.tqdm(desc="Events", total=n_raw) as event_bar:
+        for batch, start, stop in iterate_adaptive(tree, keys, 0, n_raw, step):
+            cells, states, in_pos = _hit_cells(batch, pos)
+            n_hits = ak.to_numpy(ak.num(batch.hit_x))
+            entries = np.repeat(np.arange(start, stop), n_hits)[in_pos]
+            order = np.lexsort((entries, cells))
+            cells, entries, states = cells[order], entries[order], states[order]
+            # Compare each hit to the previous one of the cell (or earlier batches).
+            is_first = np.ones(len(cells), dtype=bool)
+            is_first[1:] = cells[1:] != cells[:-1]
+            previous = np.empty_like(states)
+            previous[1:] = states[:-1]
+            previous[is_first] = last_state[cells[is_first]]
+            is_change = states != previous
+            changes["cells"].append(cells[is_change])
+            changes["entries"].append(entries[is_change])
+            changes["states"].append(states[is_change])
+            if has_bcid:
+                bcid = ak.to_numpy(batch.bcid)
+                bcid_starts.append(bcid[entries[is_change] - start])
+            is_last = np.append(is_first[1:], True)[: len(cells)]
+            last_state[cells[is_last]] = states[is_last]
+            event_bar.update(stop - start)
+    return MaskHistory(
+        shape,
+        n_raw,
+        *[np.concatenate(v) for v in changes.values()],
+        np.concatenate(bcid_starts) if has_bcid else None,
+    )
+
+
 _shape_str = "# Array shape (z, y, x): "
 
 
@@ -62,10 +245,6 @@ def _write_3d_numpy(data: np.ndarray, file_name) -> None:
         for i, yx_data in enumerate(zyx_data):
             f.write(f"# New slice: {i}\n")
             np.savetxt(f, yx_data, fmt="%+i")
-    # Just to check that the written file can be recovered.
-    _loaded_data = _read_3d_numpy(file_name)
-    assert _loaded_data.shape == data.shape
-    assert np.all(_loaded_data == data)
 
 
 def _read_3d_numpy(file_name) -> np.ndarray:
@@ -81,13 +260,45 @@ def _read_3d_numpy(file_name) -> np.ndarray:
     return read_data
 
 
+def _checksum(values: np.ndarray, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> str:
+    sha = hashlib.sha256()
+    for array in [values, x, y, z]:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+def _memory_map_npz_member(file_name: Path, member: str) -> np.ndarray:
+    """A read-only memory map of an array within an (uncompressed) `.npz` file."""
+    with zipfile.ZipFile(file_name) as zf:
+        info = zf.getinfo(f"{member}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(file_name)[member]
+    with open(file_name, "rb") as f:
+        # The data follow the local file header (30 bytes), name and extra field.
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        if np.lib.format.read_magic(f) == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+    order = "F" if fortran_order else "C"
+    return np.memmap(file_name, dtype, "r", offset, shape, order)
+
+
 class Mask:
     def __init__(
         self,
         values: np.ndarray,
         pos: Optional[Dict[str, np.ndarray]] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        history: Optional[MaskHistory] = None,
     ) -> None:
         self.values = values
+        self.metadata = metadata or {}
+        self.history = history
         self.x, self.y, self.z = self._get_positions(pos)
         self.bins_x = self.bins(self.x)
         self.bins_y = self.bins(self.y)
@@ -115,6 +326,59 @@ class Mask:
             z = pos["z"]
         return x, y, z
 
+    def save(self, file_name: Union[str, Path]) -> None:
+        """Store the mask as an uncompressed `.npz`: int8 values, positions, metadata.
+
+        A checksum of the arrays is embedded, to verify the file when loading.
+        """
+        values = np.asarray(self.values, dtype=np.int8)
+        file_name = Path(file_name)
+        write_npz(
+            {
+                "values": values,
+                "x": self.x,
+                "y": self.y,
+                "z": self.z,
+                "metadata": np.array(json.dumps(self.metadata)),
+                "checksum": np.array(_checksum(values, self.x, self.y, self.z)),
+            },
+            file_name,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        file_name: Union[str, Path],
+        mmap: bool = True,
+        verify: bool = True,
+    ) -> "Mask":
+        """Load a mask stored with `save`. With `mmap`, the values are memory-mapped."""
+        with np.load(file_name) as npz:
+            pos = {axis: npz[axis] for axis in ["x", "y", "z"]}
+            metadata = json.loads(str(npz["metadata"]))
+            checksum = str(npz["checksum"])
+            if not mmap:
+                values = npz["values"]
+        if mmap:
+            values = _memory_map_npz_member(Path(file_name), "values")
+        if verify and _checksum(values, pos["x"], pos["y"], pos["z"]) != checksum:
+            raise ValueError(
+                f"The mask file is corrupted (checksum mismatch): {file_name}."
+            )
+        return cls(values, pos, metadata)
+
+    def at_entry(self, entry: int) -> "Mask":
+        """The mask that held at a raw entry (requires the history)."""
+        if self.history is None:
+            raise ValueError("The mask was created without its history.")
+        values = self.history.values_at(entry)
+        pos = {"x": self.x, "y": self.y, "z": self.z}
+        return Mask(values, pos, {**self.metadata, "entry": entry}, self.history)
+
+    def to_text(self, file_name: Union[str, Path]) -> None:
+        """A human-readable export of the values, one block per layer."""
+        _write_3d_numpy(self.values, file_name)
+
     def plot_layer(self, i, ax=None):
         if ax is None:
             _, ax = plt.subplots()
@@ -155,18 +419,51 @@ class Mask:
         root_tree: str,
         pos: Dict[str, np.ndarray],
         entry_stop: int = -1,
-        step_size: str = "100 MB",
+        step_size: Union[str, int] = "100 MB",
+        text_export: bool = False,
+        history: bool = False,
     ) -> "Mask":
-        mask_file = Path(mask_folder) / "mask.txt"
+        """The mask is cached as `mask.npz` in the `mask_folder`.
+
+        With `text_export`, a human-readable `mask.txt` is written as well.
+        With `history`, the mask states over the run are cached and attached
+        (`mask_history.npz`), which allows `at_entry` lookups.
+        """
+        mask_file = Path(mask_folder) / "mask.npz"
+        text_file = Path(mask_folder) / "mask.txt"
+        history_file = Path(mask_folder) / "mask_history.npz"
+        mask_history = None
+        if history and history_file.exists():
+            mask_history = MaskHistory.load(history_file)
+        elif history:
+            print("Mask history not found, will be created.")
+            tree = uproot.open(root_file)[root_tree]
+            mask_history = get_mask_history(tree, pos, entry_stop, step_size)
+            mask_history.save(history_file)
         if mask_file.exists():
-            values = _read_3d_numpy(mask_file)
-            mask = Mask(values, pos)
+            mask = Mask.load(mask_file)
+        elif text_file.exists():
+            # Masks from before the binary format: convert them once.
+            values = _read_3d_numpy(text_file).astype(np.int8)
+            mask = Mask(values, pos, {"converted_from": str(text_file)})
+            mask.save(mask_file)
         else:
             print("Mask file not found, will be created.")
             root_file_object = uproot.open(root_file)
             tree = root_file_object[root_tree]
-            values = get_is_masked(tree, pos, entry_stop, step_size)
-            _write_3d_numpy(values, mask_file)
-            mask = Mask(values, pos)
+            if mask_history is None:
+                values = get_is_masked(tree, pos, entry_stop, step_size)
+            else:
+                values = mask_history.first_values()
+            metadata = {
+                "source": source_fingerprint(tree, root_tree),
+                "entry_stop": entry_stop,
+                "build_time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            mask = Mask(values, pos, metadata)
+            mask.save(mask_file)
+            if text_export:
+                mask.to_text(text_file)
             mask.save_plots(mask_folder)
+        mask.history = mask_history
         return mask
@@ -0,0 +1,187 @@
+"""Memory-aware batch sizes for iterating over the events of a ROOT tree."""
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple, Union
+
+import awkward as ak
+import numpy as np
+import psutil
+
+# As in uproot: kB, MB, ... are powers of 1000, while KiB, MiB, ... are powers of 1024.
+_unit_factors = {
+    "": 1,
+    "k": 1000,
+    "m": 1000 ** 2,
+    "g": 1000 ** 3,
+    "t": 1000 ** 4,
+    "ki": 1024,
+    "mi": 1024 ** 2,
+    "gi": 1024 ** 3,
+    "ti": 1024 ** 4,
+}
+_memory_size_regex = re.compile(
+    r"\s*(\d+(?:\.\d*)?|\.\d+)(?:e([+-]?\d+))?\s*([kmgt]i?)?b\s*", re.IGNORECASE
+)
+
+
+def memory_size(size: Union[str, int, float]) -> int:
+    """The number of bytes of a memory size such as "100 MB", "100MB" or "1 GiB".
+
+    Plain numbers are taken as bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = _memory_size_regex.fullmatch(size)
+    if match is None:
+        raise ValueError(f"Not a memory size (e.g. '100 MB'): {size!r}.")
+    number = float(match.group(1)) * 10 ** int(match.group(2) or 0)
+    return int(number * _unit_factors[(match.group(3) or "").lower()])
+
+
+class AdaptiveStepSize:
+    """Choose the number of entries per batch from the memory that is free.
+
+    The first batch follows uproot's estimate for `step_size`. Afterwards, the
+    measured (decompressed) size per entry sets the number of entries.
+    The memory per batch never exceeds `step_size`, nor `memory_fraction` of the
+    memory that is available (minus a `reserve` fraction of the total memory).
+    It is halved as soon as swap usage grows, available memory falls below the
+    reserve, or the process' RSS exceeds `max_rss`. Otherwise it grows again by
+    `growth` per batch.
+    An integer `step_size` is a fixed number of entries, as in uproot.
+    """
+
+    def __init__(
+        self,
+        step_size: Union[str, int] = "100 MB",
+        memory_fraction: float = 1 / 20,
+        growth: float = 1.5,
+        reserve: float = 0.1,
+        max_rss: Optional[Union[str, int]] = None,
+    ) -> None:
+        self._fixed_entries = step_size if isinstance(step_size, int) else None
+        self._max_bytes = (
+            0 if self._fixed_entries is not None else memory_size(step_size)
+        )
+        self._memory_fraction = memory_fraction
+        self._growth = growth
+        self._reserve = reserve * psutil.virtual_memory().total
+        self._max_rss = None if max_rss is None else memory_size(max_rss)
+        self._swap_baseline = psutil.swap_memory().used
+        self._bytes_per_entry: Optional[float] = None
+        self.target_bytes = min(self._max_bytes, self._memory_limit())
+
+    def _memory_limit(self) -> int:
+        available = psutil.virtual_memory().available - self._reserve
+        return max(int(available * self._memory_fraction), 1)
+
+    def n_entries(self, tree, expressions: Optional[List[str]] = None) -> int:
+        """The number of entries of the next batch of `expressions` from `tree`."""
+        if self._fixed_entries is not None:
+            return self._fixed_entries
+        if self._bytes_per_entry is None:
+            return max(tree.num_entries_for(self.target_bytes, expressions), 1)
+        return max(int(self.target_bytes / self._bytes_per_entry), 1)
+
+    def expect(self, bytes_per_entry: float) -> None:
+        """Size the batches by `bytes_per_entry` until the first one is measured.
+
+        E.g. if a batch takes more memory than the expressions it is read with.
+        """
+        if self._bytes_per_entry is None and bytes_per_entry > 0:
+            self._bytes_per_entry = bytes_per_entry
+
+    def prefetch_depth(self, max_depth: int) -> int:
+        """How many batches may be read ahead, up to `max_depth`.
+
+        Together with the batch in use, the batches read ahead stay within the
+        memory limit that also bounds a single batch.
+        """
+        if self._bytes_per_entry is None or max_depth <= 0:
+            return 0  # The size of a batch is not known before the first one.
+        if self._fixed_entries is not None:
+            batch_bytes = self._bytes_per_entry * self._fixed_entries
+        else:
+            batch_bytes = self.target_bytes
+        n_batches = self._memory_limit() // max(int(batch_bytes), 1)
+        return int(min(max_depth, max(n_batches - 1, 0)))
+
+    def update(self, n_entries: int, n_bytes: int) -> None:
+        """Adapt to a finished batch of `n_entries` that took `n_bytes` in memory."""
+        if n_entries > 0:
+            self._bytes_per_entry = max(n_bytes, 1) / n_entries
+        if self._fixed_entries is not None:
+            return
+        swap_used = psutil.swap_memory().used
+        is_swapping = swap_used - self._swap_baseline > 64 * 1024 ** 2
+        is_low = psutil.virtual_memory().available < self._reserve
+        is_rss_high = (
+            self._max_rss is not None
+            and psutil.Process().memory_info().rss > self._max_rss
+        )
+        if is_swapping or is_low or is_rss_high:
+            self._swap_baseline = swap_used  # Only react to new swapping.
+            self.target_bytes = max(self.target_bytes // 2, 1)
+        else:
+            self.target_bytes = min(
+                int(self.target_bytes * self._growth),
+                self._max_bytes,
+                self._memory_limit(),
+            )
+
+
+def _snap_to_boundary(start: int, stop: int, boundaries: np.ndarray) -> int:
+    """The last basket boundary in (start, stop], or `stop` if there is none."""
+    i = np.searchsorted(boundaries, stop, side="right") - 1
+    if i >= 0 and boundaries[i] > start:
+        return int(boundaries[i])
+    return stop
+
+
+def iterate_adaptive(
+    tree,
+    expressions: Optional[List[str]],
+    entry_start: int,
+    entry_stop: int,
+    step: AdaptiveStepSize,
+    boundaries: Optional[np.ndarray] = None,
+    update: bool = True,
+    prefetch: int = 2,
+) -> Iterator[Tuple[ak.Array, int, int]]:
+    """Yield (batch, batch_entry_start, batch_entry_stop) with adaptive batch sizes.
+
+    If known, the batches end at the basket `boundaries`, so that no basket is
+    decompressed twice. This requires boundaries that the baskets of all
+    `expressions` share, otherwise the baskets that cross them are read twice.
+    With `update=False`, the caller measures the memory of a batch and updates
+    `step` itself (e.g. when reading more branches per batch).
+
+    While the caller works on a batch, up to `prefetch` upcoming batches are read
+    and decompressed in background threads (fewer if memory is short, see
+    `AdaptiveStepSize.prefetch_depth`). `prefetch=0` reads one batch at a time.
+    """
+    pending: deque = deque()  # (future, start, stop) of the batches being read.
+    start = entry_start
+    with ThreadPoolExecutor(max(prefetch, 1)) as executor:
+        try:
+            while start < entry_stop or pending:
+                while start < entry_stop and len(pending) <= step.prefetch_depth(
+                    prefetch
+                ):
+                    stop = min(start + step.n_entries(tree, expressions), entry_stop)
+                    if boundaries is not None and stop < entry_stop:
+                        stop = _snap_to_boundary(start, stop, boundaries)
+                    future = executor.submit(
+                        tree.arrays, expressions, entry_start=start, entry_stop=stop
+                    )
+                    pending.append((future, start, stop))
+                    start = stop
+                future, batch_start, batch_stop = pending.popleft()
+                batch = future.result()
+                yield batch, batch_start, batch_stop
+                if update:
+                    step.update(batch_stop - batch_start, batch.nbytes)
+        finally:
+            for future, _, _ in pending:
+                future.cancel()  # The caller stopped early.
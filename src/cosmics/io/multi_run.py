@@ -0,0 +1,145 @@
+"""Process many runs (ROOT files) in parallel, within a global memory budget."""
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Union,
+)
+
+import psutil
+
+from .memory import memory_size
+
+PathLike = Union[str, Path]
+Runs = Union[Mapping[str, PathLike], Sequence[PathLike]]
+
+
+def _as_run_dict(runs: Runs) -> Dict[str, Path]:
+    if isinstance(runs, Mapping):
+        return {run_id: Path(root_file) for run_id, root_file in runs.items()}
+    return {Path(root_file).stem: Path(root_file) for root_file in runs}
+
+
+def _file_size(root_file: Path) -> int:
+    return root_file.stat().st_size if root_file.exists() else 0
+
+
+def _run_task(
+    task: Callable[[Path], Any],
+    root_file: Path,
+    run_id: str = "",
+    busy_pids: Optional[MutableMapping[str, int]] = None,
+) -> Any:
+    """Worker function: Keep the traceback, which is lost on the way back.
+
+    While the task runs, the worker's PID is registered in the (shared)
+    `busy_pids`, so that the parent only measures the workers that are busy.
+    """
+    if busy_pids is not None:
+        busy_pids[run_id] = os.getpid()
+    try:
+        return task(root_file)
+    except Exception as e:
+        raise RuntimeError(f"{root_file}:\n{traceback.format_exc()}") from e
+    finally:
+        if busy_pids is not None:
+            busy_pids.pop(run_id, None)
+
+
+def _busy_workers_rss(busy_pids: Mapping[str, int]) -> int:
+    """The resident memory of the workers that process a run (not of idle ones)."""
+    rss = 0
+    for pid in set(busy_pids.values()):
+        try:
+            rss += psutil.Process(pid).memory_info().rss
+        except psutil.Error:  # The worker just exited.
+            pass
+    return rss
+
+
+def process_runs(
+    runs: Runs,
+    task: Callable[[Path], Any],
+    n_workers: Optional[int] = None,
+    memory_budget: Optional[Union[str, int]] = None,
+    memory_per_run: Union[str, int] = "2 GB",
+    poll_interval: float = 1.0,
+) -> Dict[str, Any]:
+    """Apply `task` to the ROOT file of each run, and collect the results per run.
+
+    `runs` maps run IDs to ROOT files (or is a list of files, named by their stem).
+    The `task` gets the file path. It must be picklable, e.g. a module-level
+    function or a `functools.partial` of one (trigger selection, mask building,
+    histogramming, ...).
+
+    Runs are started largest file first on up to `n_workers` processes (default:
+    one per CPU), as long as the workers stay within the `memory_budget` (default:
+    the memory available now, minus 10% of the total). A run is assumed to need
+    `memory_per_run` until its worker's measured memory says otherwise (idle
+    workers are not counted). At least one run is always in progress, so that a
+    small budget only serializes runs.
+    All runs are attempted; failed runs are reported at the end.
+    """
+    root_files = _as_run_dict(runs)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if memory_budget is None:
+        virtual_memory = psutil.virtual_memory()
+        budget = virtual_memory.available - virtual_memory.total // 10
+    else:
+        budget = memory_size(memory_budget)
+    per_run = memory_size(memory_per_run)
+    queue = sorted(root_files, key=lambda r: _file_size(root_files[r]), reverse=True)
+
+    results: Dict[str, Any] = {}
+    errors: Dict[str, BaseException] = {}
+    if n_workers <= 1:
+        for run_id in queue:
+            try:
+                results[run_id] = task(root_files[run_id])
+            except Exception as e:
+                print(f"Run {run_id} failed: {e!r}.")
+                errors[run_id] = e
+    else:
+        running: Dict[Future, str] = {}
+        start_times: Dict[str, float] = {}
+        with multiprocessing.Manager() as manager:
+            busy_pids = manager.dict()  # The PID of each run in progress.
+            with ProcessPoolExecutor(n_workers) as executor:
+                while queue or running:
+                    in_use = max(len(running) * per_run, _busy_workers_rss(busy_pids))
+                    while queue and len(running) < n_workers:
+                        if running and in_use + per_run > budget:
+                            break
+                        run_id = queue.pop(0)
+                        future = executor.submit(
+                            _run_task, task, root_files[run_id], run_id, busy_pids
+                        )
+                        running[future] = run_id
+                        start_times[run_id] = time.time()
+                        in_use += per_run
+                    done, _ = wait(running, poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        run_id = running.pop(future)
+                        duration = time.time() - start_times[run_id]
+                        try:
+                            results[run_id] = future.result()
+                            print(f"Run {run_id} done after {duration:.1f}s.")
+                        except Exception as e:
+                            print(f"Run {run_id} failed after {duration:.1f}s: {e}")
+                            errors[run_id] = e
+    if errors:
+        raise RuntimeError(
+            f"{len(errors)} of {len(root_files)} runs failed: {list(errors)}."
+        ) from next(iter(errors.values()))
+    return {run_id: results[run_id] for run_id in root_files}
@@ -0,0 +1,309 @@
+"""Stage the raw files of runs from their server into a local, size-bounded cache."""
+import abc
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+import tqdm.auto as tqdm
+
+from .memory import memory_size
+from .utils import write_json
+
+_hash_block = 16 * 1024 ** 2
+
+
+class RunSpec(NamedTuple):
+    """A run as in the `cosmics` section of a steering file."""
+
+    name: str
+    folder: str
+    server: Optional[str] = None  # None for local or NFS-mounted folders.
+    type: str = "v0-root"
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "RunSpec":
+        return cls(
+            config["name"],
+            config["folder"],
+            config.get("server"),
+            config.get("type", "v0-root"),
+        )
+
+    @property
+    def remote_path(self) -> str:
+        return f"{self.folder.rstrip('/')}/{self.name}.root"
+
+    @property
+    def key(self) -> str:
+        identity = [self.server, self.remote_path]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()[:16]
+
+
+def _sha256_file(file_name: Path) -> str:
+    sha = hashlib.sha256()
+    with file_name.open("rb") as f:
+        for block in iter(lambda: f.read(_hash_block), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Transport(abc.ABC):
+    """How the files of a server are reached."""
+
+    @abc.abstractmethod
+    def stat(self, path: str) -> Tuple[int, float]:
+        """The size and modification time of a remote file."""
+
+    @abc.abstractmethod
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        """`length` bytes of a remote file, starting at `offset`."""
+
+    @abc.abstractmethod
+    def checksum(self, path: str) -> Optional[str]:
+        """The sha256 of a remote file, or None if it can not be computed there."""
+
+
+class LocalTransport(Transport):
+    """Files on a local or NFS-mounted file system.
+
+    With a `root`, the (absolute) remote paths are taken relative to it. Such a
+    local directory can stand in for a server, e.g. in tests.
+    """
+
+    def __init__(self, root: Optional[Union[str, Path]] = None) -> None:
+        self._root = None if root is None else Path(root)
+
+    def _path(self, path: str) -> Path:
+        if self._root is None:
+            return Path(path)
+        return self._root / path.lstrip("/")
+
+    def stat(self, path: str) -> Tuple[int, float]:
+        stat = self._path(path).stat()
+        return stat.st_size, stat.st_mtime
+
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        with self._path(path).open("rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def checksum(self, path: str) -> Optional[str]:
+        return _sha256_file(self._path(path))
+
+
+class SshTransport(Transport):
+    """Files on a server that is reachable with (passwordless) ssh.
+
+    Each chunk is read with `dd` on the server, so that several chunks can be
+    transferred in parallel connections. The checksum is computed on the server.
+    """
+
+    def __init__(self, server: str, ssh_command: Sequence[str] = ("ssh",)) -> None:
+        self._server = server
+        self._ssh_command = list(ssh_command)
+
+    def _run(self, command: str) -> bytes:
+        result = subprocess.run(
+            self._ssh_command + [self._server, command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise OSError(f"{self._server}: {command}: {result.stderr.decode()}")
+        return result.stdout
+
+    def stat(self, path: str) -> Tuple[int, float]:
+        size, mtime = self._run(f"stat -L -c '%s %Y' {shlex.quote(path)}").split()
+        return int(size), float(mtime)
+
+    def read(self, path: str, offset: int, length: int) -> bytes:
+        return self._run(
+            f"dd if={shlex.quote(path)} bs=1M skip={offset} count={length} "
+            "iflag=skip_bytes,count_bytes status=none"
+        )
+
+    def checksum(self, path: str) -> Optional[str]:
+        return self._run(f"sha256sum {shlex.quote(path)}").split()[0].decode()
+
+
+def transport_for(spec: RunSpec) -> Transport:
+    if spec.server in [None, "", "localhost"]:
+        return LocalTransport()
+    return SshTransport(spec.server)
+
+
+class StagingCache:
+    """Local copies of the raw files of runs, at most `max_size` in total.
+
+    Files are copied in chunks of `chunk_size`, `n_workers` at a time. The chunks
+    that arrived are recorded, so that an interrupted copy continues where it
+    stopped. A complete copy is only used once its sha256 matches the remote one.
+    When space is needed, the least recently used files are removed.
+    The cache is meant to be used by one process at a time.
+    """
+
+    def __init__(
+        self,
+        folder: Union[str, Path],
+        max_size: Union[str, int] = "200 GB",
+        chunk_size: Union[str, int] = "64 MiB",
+        n_workers: int = 4,
+        transport: Optional[Transport] = None,
+    ) -> None:
+        self.folder = Path(folder)
+        self.max_size = memory_size(max_size)
+        self._chunk_size = memory_size(chunk_size)
+        self._n_workers = n_workers
+        self._transport = transport
+        self._index_file = self.folder / "index.json"
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self._index_file.exists():
+            with self._index_file.open() as f:
+                self.entries = json.load(f)
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def _file(self, spec: RunSpec) -> Path:
+        return self.folder / spec.key / f"{spec.name}.root"
+
+    def _save_index(self) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        write_json(self.entries, self._index_file)
+
+    def remove(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        file_name = Path(entry["file"])
+        file_name.unlink(missing_ok=True)
+        if file_name.parent.exists() and not any(file_name.parent.iterdir()):
+            file_name.parent.rmdir()
+        self._save_index()
+
+    def _make_space(self, n_bytes: int) -> None:
+        if n_bytes > self.max_size:
+            raise ValueError(f"A file of {n_bytes} B exceeds the cache size.")
+        by_last_use = sorted(self.entries, key=lambda k: self.entries[k]["last_used"])
+        for key in by_last_use:
+            if self.n_bytes + n_bytes <= self.max_size:
+                break
+            print(f"Removing the least recently used {self.entries[key]['file']}.")
+            self.remove(key)
+
+    def stage(self, spec: RunSpec) -> Path:
+        """The local path of the run's raw file, copied first if necessary.
+
+        If the server can not be reached, a cached copy is used as it is.
+        """
+        transport = self._transport or transport_for(spec)
+        file_name = self._file(spec)
+        entry = self.entries.get(spec.key)
+        try:
+            size, mtime = transport.stat(spec.remote_path)
+        except OSError:
+            if entry is None:
+                raise
+            print(f"WARNING: {spec.server} not reachable, using the cached copy.")
+            size, mtime = entry["size"], entry["mtime"]
+        if entry is not None and (entry["size"], entry["mtime"]) != (size, mtime):
+            print(f"{spec.remote_path} changed on {spec.server}, it is copied again.")
+            self.remove(spec.key)
+            entry = None
+        if entry is not None and not file_name.exists():
+            self.remove(spec.key)
+            entry = None
+        if entry is None:
+            self._make_space(size)
+            sha256 = self._copy(transport, spec, file_name, size, mtime)
+            entry = {
+                "file": str(file_name),
+                "source": [spec.server, spec.remote_path],
+                "size": size,
+                "mtime": mtime,
+                "sha256": sha256,
+            }
+        entry["last_used"] = time.time()
+        self.entries[spec.key] = entry
+        self._save_index()
+        return file_name
+
+    def _has_chunk(self, part_file: Path, offset: int, chunks: Dict[str, str]) -> bool:
+        """Whether the chunk was copied before, and is unchanged since."""
+        if str(offset) not in chunks:
+            return False
+        with part_file.open("rb") as f:
+            f.seek(offset)
+            data = f.read(self._chunk_size)
+        return hashlib.sha256(data).hexdigest() == chunks[str(offset)]
+
+    def _copy(
+        self,
+        transport: Transport,
+        spec: RunSpec,
+        file_name: Path,
+        size: int,
+        mtime: float,
+    ) -> str:
+        """Copy the missing chunks into a `.part` file, and verify the result."""
+        part_file = file_name.with_name(file_name.name + ".part")
+        progress_file = file_name.with_name(file_name.name + ".chunks.json")
+        file_name.parent.mkdir(parents=True, exist_ok=True)
+        progress: Dict[str, Any] = {}
+        if part_file.exists() and progress_file.exists():
+            with progress_file.open() as f:
+                progress = json.load(f)
+        identity = [size, mtime, self._chunk_size]
+        if progress.get("identity") != identity:
+            progress = {"identity": identity, "chunks": {}}
+        with part_file.open("ab") as f:
+            f.truncate(size)
+        missing = [
+            offset
+            for offset in range(0, size, self._chunk_size)
+            if not self._has_chunk(part_file, offset, progress["chunks"])
+        ]
+        lock = threading.Lock()
+
+        def copy_chunk(offset: int) -> int:
+            length = min(self._chunk_size, size - offset)
+            data = transport.read(spec.remote_path, offset, length)
+            if len(data) != length:
+                raise OSError(f"Got {len(data)} instead of {length} B at {offset}.")
+            fd = os.open(part_file, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+            with lock:
+                progress["chunks"][str(offset)] = hashlib.sha256(data).hexdigest()
+                write_json(progress, progress_file)
+            return length
+
+        if missing:
+            print(f"Copying {spec.remote_path} from {spec.server or 'local disk'}.")
+        with tqdm.tqdm(
+            desc="Staging",
+            total=size,
+            initial=size - sum(min(self._chunk_size, size - o) for o in missing),
+            unit="B",
+            unit_scale=True,
+        ) as p_bar, ThreadPoolExecutor(self._n_workers) as executor:
+            for length in executor.map(copy_chunk, missing):
+                p_bar.update(length)
+
+        sha256 = _sha256_file(part_file)
+        remote_sha256 = transport.checksum(spec.remote_path)
+        if remote_sha256 is not None and sha256 != remote_sha256:
+            part_file.unlink()
+            progress_file.unlink()
+            raise ValueError(f"Staging {spec.remote_path} failed: checksum mismatch.")
+        os.replace(part_file, file_name)
+        progress_file.unlink()
+        return sha256
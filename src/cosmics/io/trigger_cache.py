@@ -0,0 +1,523 @@
+"""The on-disk cache of triggered events, stored in chunks of raw entry ranges."""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import awkward as ak
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .trigger_expression import Comparison, trigger_branches
+from .utils import EntryRange, merge_ranges, missing_ranges, write_json
+
+
+def source_fingerprint(tree, root_tree: str) -> Dict[str, Any]:
+    """Identify the source of a cache: the file's UUID and the tree name.
+
+    Size, modification time and number of entries are recorded to notice changes.
+    """
+    path = Path(tree.file.file_path).resolve()
+    stat = path.stat()
+    return {
+        "file": str(path),
+        "tree": root_tree,
+        "uuid": str(tree.file.uuid),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "num_entries": tree.num_entries,
+    }
+
+
+def cache_key(canonical_trigger: str, fingerprint: Dict[str, Any]) -> str:
+    """The address of the triggered events of a source: trigger, file and tree.
+
+    A regenerated ROOT file (with a new UUID) keeps its key. Its cache is reused
+    as long as the processed entries are unchanged (see `TriggerCache`).
+    """
+    identity = [canonical_trigger, fingerprint["file"], fingerprint["tree"]]
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()[:16]
+
+
+def range_hash(values: ak.Array) -> Dict[str, Any]:
+    """A hash of the raw values (of all branches) over a range of entries."""
+    sha = hashlib.sha1()
+    branches = sorted(ak.fields(values))
+    for name in branches:
+        column = values[name]
+        if column.ndim > 1:
+            sha.update(ak.to_numpy(ak.num(column, axis=1)).astype(np.int64).tobytes())
+            column = ak.flatten(column, axis=None)
+        sha.update(ak.to_numpy(column).tobytes())
+    return {"branches": branches, "sha1": sha.hexdigest()}
+
+
+def _has_same_entries(
+    folder: Path,
+    chunks: List[Dict[str, Any]],
+    tree,
+    required: List[str],
+) -> bool:
+    """Whether the hashed raw values of the `chunks` are unchanged in the `tree`.
+
+    The hash of each chunk must cover the `required` (trigger) branches of all
+    its raw entries, and the stored events.
+    """
+    for chunk in chunks:
+        chunk_hash = chunk.get("hash")
+        if not isinstance(chunk_hash, dict) or "events" not in chunk_hash:
+            return False
+        trigger_hash = {k: chunk_hash[k] for k in ["branches", "sha1"]}
+        event_branches = chunk_hash["events"]["branches"]
+        names = trigger_hash["branches"] + event_branches
+        if set(required) - set(trigger_hash["branches"]) or any(
+            name not in tree.keys() for name in names
+        ):
+            return False
+        start, stop = chunk["entry_start"], chunk["entry_stop"]
+        values = tree.arrays(sorted(set(names)), entry_start=start, entry_stop=stop)
+        if range_hash(values[trigger_hash["branches"]]) != trigger_hash:
+            return False
+        entries = np.load((folder / chunk["file"]).with_suffix(".npy"))
+        events = values[event_branches][entries - start]
+        if range_hash(events) != chunk_hash["events"]:
+            return False
+    return True
+
+
+def _empty_events(schema: pa.Schema, branches: Optional[List[str]] = None) -> ak.Array:
+    """No events, but typed. (The array from an empty table can not be written.)"""
+    if branches is not None:
+        schema = pa.schema([schema.field(name) for name in branches])
+    columns = [pa.array([], type=field.type) for field in schema]
+    return ak.from_arrow(pa.RecordBatch.from_arrays(columns, schema=schema))
+
+
+def _is_hit_level(data_type: pa.DataType) -> bool:
+    """Jagged columns (such as the `hit_*` branches) hold one value per hit."""
+    return pa.types.is_list(data_type) or pa.types.is_large_list(data_type)
+
+
+def _join(parts: List[ak.Array], branches: Optional[List[str]] = None) -> ak.Array:
+    """The row-aligned event-level and hit-level parts as one record per event.
+
+    Lazy parts stay lazy: a column is only read once it is accessed.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    columns = {name: part[name] for part in parts for name in part.fields}
+    if branches is not None:
+        columns = {name: columns[name] for name in branches}
+    return ak.zip(columns, depth_limit=1)
+
+
+class TriggerCache:
+    """A folder with the parquet files of each processed range of raw entries.
+
+    The `manifest.json` records which raw entry ranges were already triggered.
+    A chunk is only registered in the manifest after its files were written
+    completely. Thus an interrupted build can be resumed from the manifest,
+    and events appended to the build file only require triggering the new entries.
+    This holds for a regenerated build file too, if the `tree` is given: it must
+    not be smaller, and the hashes of each chunk's trigger branches (and
+    `event`, `bcid`) and of its stored events must be unchanged.
+    Next to each parquet file, the raw entry numbers of the triggered events are
+    stored as `.npy`, so that a chunk can be cut at any raw entry.
+
+    The event-level columns of a chunk (`.parquet`) are stored apart from its
+    hit-level columns (`.hits.parquet`), with the same rows and row groups.
+    Queries on event-level branches never read the (much larger) hit data.
+    """
+
+    # Small row groups (a few MB for our events) allow to read single events.
+    row_group_size = 4096
+
+    def __init__(
+        self,
+        folder: Path,
+        trigger: str,
+        source: Optional[Dict[str, Any]] = None,
+        tree=None,
+    ) -> None:
+        self.folder = Path(folder)
+        self._manifest_file = self.folder / "manifest.json"
+        self._manifest = {"trigger": trigger, "source": source, "chunks": []}
+        if self._manifest_file.exists():
+            with self._manifest_file.open() as f:
+                manifest = json.load(f)
+            if source is None or not self._is_stale(manifest, source, tree):
+                self._manifest = manifest
+                self._manifest["source"] = source or manifest.get("source")
+            else:
+                print(f"The source changed, the cache is rebuilt: {self.folder}.")
+                self.clear()
+
+    def _is_stale(self, manifest: Dict[str, Any], source: Dict[str, Any], tree) -> bool:
+        """Events can be appended to a source, but existing ones must not change."""
+        processed_stop = max((c["entry_stop"] for c in manifest["chunks"]), default=0)
+        if processed_stop > source["num_entries"]:
+            return True
+        previous = manifest.get("source") or {}
+        if previous.get("size", 0) > source["size"]:
+            return True
+        if previous.get("uuid") == source["uuid"]:
+            return False
+        # A regenerated file: reused only if events were merely appended.
+        required = trigger_branches(manifest["trigger"])
+        return tree is None or not _has_same_entries(
+            self.folder, manifest["chunks"], tree, required
+        )
+
+    def _files(self, chunk: Dict[str, Any]) -> List[Path]:
+        """The chunk's files: event-level and hit-level parquet, raw entries."""
+        files = [self.folder / chunk["file"]]
+        if chunk.get("hit_file"):  # Chunks of older caches hold all columns.
+            files.append(self.folder / chunk["hit_file"])
+        return files + [(self.folder / chunk["file"]).with_suffix(".npy")]
+
+    def _columns(
+        self,
+        chunk: Dict[str, Any],
+        branches: Optional[List[str]] = None,
+    ) -> List[Tuple[Path, Optional[List[str]]]]:
+        """The parquet files that hold any of the `branches`, with those columns."""
+        filenames = self._files(chunk)[:-1]
+        if branches is None:
+            return [(filename, None) for filename in filenames]
+        selected = []
+        unknown = list(branches)
+        for filename in filenames:
+            if not unknown:
+                break  # E.g. the hit-level file is not needed.
+            names = pq.read_schema(filename, memory_map=True).names
+            columns = [branch for branch in unknown if branch in names]
+            if columns:
+                selected.append((filename, columns))
+            unknown = [branch for branch in unknown if branch not in names]
+        if unknown or not selected:  # Leave it to pyarrow to complain.
+            selected.insert(0, (filenames[0], unknown))
+        return selected
+
+    def event_branches(self) -> List[str]:
+        """The event-level (non-jagged) branches of the cached events."""
+        if not self.chunks:
+            return []
+        schema = pq.read_schema(self.folder / self.chunks[0]["file"])
+        return [field.name for field in schema if not _is_hit_level(field.type)]
+
+    def clear(self) -> None:
+        for chunk in self._manifest["chunks"]:
+            # Including files derived from the chunk, such as its event summaries.
+            for filename in self.folder.glob(f"{Path(chunk['file']).stem}.*"):
+                filename.unlink()
+        self._manifest["chunks"] = []
+        if self._manifest_file.exists():
+            self._manifest_file.unlink()
+
+    @property
+    def trigger(self) -> str:
+        return self._manifest["trigger"]
+
+    @property
+    def source(self) -> Optional[Dict[str, Any]]:
+        return self._manifest["source"]
+
+    @property
+    def chunks(self) -> List[Dict[str, Any]]:
+        return sorted(self._manifest["chunks"], key=lambda c: c["entry_start"])
+
+    @property
+    def n_triggered(self) -> int:
+        return sum(chunk["n_triggered"] for chunk in self.chunks)
+
+    def processed_ranges(self) -> List[EntryRange]:
+        ranges = [(c["entry_start"], c["entry_stop"]) for c in self.chunks]
+        return merge_ranges(ranges)
+
+    def missing_ranges(self, entry_stop: int) -> List[EntryRange]:
+        """The raw entry ranges below `entry_stop` that were not yet triggered."""
+        return missing_ranges(self.processed_ranges(), entry_stop)
+
+    def is_complete(self, num_entries: int) -> bool:
+        return not self.missing_ranges(num_entries)
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(
+            filename.stat().st_size
+            for chunk in self.chunks
+            for filename in self._files(chunk)
+        )
+
+    def _save_manifest(self) -> None:
+        write_json(self._manifest, self._manifest_file)
+
+    def add_chunk(
+        self,
+        entry_range: EntryRange,
+        events: ak.Array,
+        entries: np.ndarray,
+        chunk_hash: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Store the triggered `events` (at raw `entries`) of the `entry_range`.
+
+        The `chunk_hash` of the raw trigger branches (see `range_hash`) allows
+        to reuse the chunk for a regenerated source. The hash of the `events`
+        is added to it.
+        """
+        if chunk_hash is not None:
+            chunk_hash = {**chunk_hash, "events": range_hash(events)}
+        self.folder.mkdir(parents=True, exist_ok=True)
+        stem = f"{entry_range[0]:012}-{entry_range[1]:012}"
+        table = ak.to_arrow_table(events)
+        is_hit_level = [_is_hit_level(field.type) for field in table.schema]
+        tables = {f"{stem}.parquet": table}
+        if any(is_hit_level) and not all(is_hit_level):
+            names = np.array(table.schema.names)
+            tables = {
+                f"{stem}.parquet": table.select(names[~np.array(is_hit_level)]),
+                f"{stem}.hits.parquet": table.select(names[is_hit_level]),
+            }
+        for filename, part in tables.items():
+            tmp_file = self.folder / f"{filename}.part"
+            pq.write_table(part, tmp_file, row_group_size=self.row_group_size)
+            os.replace(tmp_file, self.folder / filename)
+        np.save(self.folder / f"{stem}.npy", np.asarray(entries, dtype=np.int64))
+        self._manifest["chunks"].append(
+            {
+                "entry_start": int(entry_range[0]),
+                "entry_stop": int(entry_range[1]),
+                "file": f"{stem}.parquet",
+                "hit_file": f"{stem}.hits.parquet" if len(tables) == 2 else None,
+                "n_triggered": len(events),
+                "hash": chunk_hash,
+            }
+        )
+        self._save_manifest()
+
+    def _n_triggered_below(self, chunk: Dict[str, Any], entry_stop: int) -> int:
+        if entry_stop >= chunk["entry_stop"]:
+            return chunk["n_triggered"]
+        entries = np.load((self.folder / chunk["file"]).with_suffix(".npy"))
+        return int(np.searchsorted(entries, entry_stop))
+
+    def lazy_chunk(
+        self,
+        chunk: Dict[str, Any],
+        entry_stop: int,
+        branches: Optional[List[str]] = None,
+    ) -> Optional[ak.Array]:
+        """A virtual array of the chunk's events with a raw entry below `entry_stop`.
+
+        Row groups and columns are only read (memory-mapped) once they are accessed.
+        """
+        n_triggered = self._n_triggered_below(chunk, entry_stop)
+        if n_triggered == 0:
+            return None
+        parts = [
+            ak.from_parquet(filename, columns=columns, lazy=True, memory_map=True)
+            for filename, columns in self._columns(chunk, branches)
+        ]
+        return _join([part[:n_triggered] for part in parts], branches)
+
+    def iterate_chunk(
+        self,
+        chunk: Dict[str, Any],
+        entry_stop: int,
+        branches: Optional[List[str]] = None,
+        batch_size: int = 65_536,
+    ) -> Iterator[ak.Array]:
+        """Stream the chunk's events with a raw entry number below `entry_stop`.
+
+        At least one (possibly empty) array is yielded, to provide the type.
+        """
+        n_left = self._n_triggered_below(chunk, entry_stop)
+        parts = [
+            (pq.ParquetFile(filename, memory_map=True), columns)
+            for filename, columns in self._columns(chunk, branches)
+        ]
+        if n_left == 0:
+            empty_parts = [_empty_events(f.schema_arrow, c) for f, c in parts]
+            yield _join(empty_parts, branches)
+            return
+        # Whole row groups, so that the parts stay aligned.
+        group_starts = _row_group_starts(parts[0][0])
+        n_groups = max(batch_size // self.row_group_size, 1)
+        for i in range(0, len(group_starts) - 1, n_groups):
+            groups = list(range(i, min(i + n_groups, len(group_starts) - 1)))
+            events = _join(
+                [
+                    ak.from_arrow(parquet_file.read_row_groups(groups, columns))
+                    for parquet_file, columns in parts
+                ],
+                branches,
+            )[:n_left]
+            n_left -= len(events)
+            yield events
+            if n_left <= 0:
+                break
+
+    def bitmap(self, num_entries: int) -> np.ndarray:
+        """Per raw entry, whether it is a cached (triggered) event."""
+        is_triggered = np.zeros(num_entries, dtype=bool)
+        for chunk in self.chunks:
+            entries = np.load((self.folder / chunk["file"]).with_suffix(".npy"))
+            is_triggered[entries[entries < num_entries]] = True
+        return is_triggered
+
+    def rows_of(self, entries: np.ndarray) -> List[Tuple[Dict[str, Any], np.ndarray]]:
+        """Per chunk, the rows of those raw `entries` that are cached (triggered)."""
+        entries = np.sort(entries)
+        located = []
+        for chunk in self.chunks:
+            in_chunk = entries[
+                (entries >= chunk["entry_start"]) & (entries < chunk["entry_stop"])
+            ]
+            if len(in_chunk) == 0:
+                continue
+            chunk_entries = np.load((self.folder / chunk["file"]).with_suffix(".npy"))
+            rows = np.searchsorted(chunk_entries, in_chunk)
+            rows = rows[rows < len(chunk_entries)]
+            rows = rows[np.isin(chunk_entries[rows], in_chunk)]
+            if len(rows):
+                located.append((chunk, rows))
+        return located
+
+    def read_rows(
+        self,
+        chunk: Dict[str, Any],
+        rows: np.ndarray,
+        branches: Optional[List[str]] = None,
+    ) -> ak.Array:
+        """The events at the (sorted) `rows` of a chunk, reading only their row groups."""
+        parts = [
+            (pq.ParquetFile(filename, memory_map=True), columns)
+            for filename, columns in self._columns(chunk, branches)
+        ]
+        group_starts = _row_group_starts(parts[0][0])
+        row_groups = np.searchsorted(group_starts, rows, side="right") - 1
+        groups = np.unique(row_groups)
+        events = _join(
+            [
+                ak.from_arrow(parquet_file.read_row_groups(groups.tolist(), columns))
+                for parquet_file, columns in parts
+            ],
+            branches,
+        )
+        # The positions of the rows within the concatenated row groups.
+        offsets = np.cumsum(np.append(0, np.diff(group_starts)[groups]))
+        rows_in_table = (
+            offsets[np.searchsorted(groups, row_groups)]
+            + rows
+            - group_starts[row_groups]
+        )
+        return ak.packed(events[rows_in_table])
+
+    def filter_chunk(
+        self,
+        chunk: Dict[str, Any],
+        trigger: str,
+        comparisons: List[Comparison],
+    ) -> Tuple[ak.Array, np.ndarray]:
+        """The events of the chunk that pass the (narrower) `trigger`, and entries.
+
+        Row groups are skipped if their statistics exclude any of the comparisons.
+        Then the trigger is evaluated on its branches only, and the full events
+        are read just for the row groups with passing events.
+        """
+        branches = sorted({c.branch for c in comparisons})
+        trigger_parts = [
+            (pq.ParquetFile(filename, memory_map=True), columns)
+            for filename, columns in self._columns(chunk, branches)
+        ]
+        group_starts = _row_group_starts(trigger_parts[0][0])
+        passing_rows = {}
+        for i in range(len(group_starts) - 1):
+            if group_starts[i + 1] == group_starts[i]:
+                continue  # E.g. the single row group of a chunk without events.
+            if not all(
+                _row_group_may_pass(parquet_file.metadata.row_group(i), comparisons)
+                for parquet_file, _ in trigger_parts
+            ):
+                continue
+            columns = _join(
+                [
+                    ak.from_arrow(parquet_file.read_row_group(i, columns))
+                    for parquet_file, columns in trigger_parts
+                ]
+            )
+            is_passing = np.asarray(ak.numexpr.evaluate(trigger, columns))
+            if is_passing.any():
+                passing_rows[i] = is_passing
+        parts = [
+            pq.ParquetFile(filename, memory_map=True)
+            for filename in self._files(chunk)[:-1]
+        ]
+        if not passing_rows:
+            events = _join([_empty_events(f.schema_arrow) for f in parts])
+            return events, np.zeros(0, dtype=np.int64)
+        events = _join(
+            [
+                ak.from_arrow(parquet_file.read_row_groups(list(passing_rows)))
+                for parquet_file in parts
+            ]
+        )
+        events = events[np.concatenate(list(passing_rows.values()))]
+        all_entries = np.load(self._files(chunk)[-1])
+        entries = [
+            all_entries[group_starts[i] : group_starts[i + 1]][is_passing]
+            for i, is_passing in passing_rows.items()
+        ]
+        return ak.packed(events), np.concatenate(entries)
+
+
+def _row_group_starts(parquet_file: pq.ParquetFile) -> np.ndarray:
+    """The first row of each row group, and the number of rows at the end."""
+    metadata = parquet_file.metadata
+    n_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    return np.cumsum([0] + n_rows)
+
+
+def _row_group_may_pass(row_group, comparisons: List[Comparison]) -> bool:
+    for i_column in range(row_group.num_columns):
+        column = row_group.column(i_column)
+        statistics = column.statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        for comparison in comparisons:
+            if comparison.branch != column.path_in_schema:
+                continue
+            if not comparison.may_pass(statistics.min, statistics.max):
+                return False
+    return True
+
+
+class CacheIndex:
+    """The `index.json` of a folder of trigger caches, keyed by `cache_key`.
+
+    For each cache, it records the canonical trigger, the source, the time of
+    the last build, the processed raw entries, the number of rows and the size.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self._index_file = Path(folder) / "index.json"
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if self._index_file.exists():
+            with self._index_file.open() as f:
+                self.entries = json.load(f)
+
+    def update(self, key: str, cache: TriggerCache, building_time: float) -> None:
+        self.entries[key] = {
+            "trigger": cache.trigger,
+            "source": cache.source,
+            "build_time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "building_seconds": building_time,
+            "processed_ranges": cache.processed_ranges(),
+            "n_triggered": cache.n_triggered,
+            "n_bytes": cache.n_bytes,
+        }
+        self._index_file.parent.mkdir(parents=True, exist_ok=True)
+        write_json(self.entries, self._index_file)
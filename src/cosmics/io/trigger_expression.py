@@ -0,0 +1,242 @@
+"""Canonical forms of numexpr trigger expressions.
+
+Two triggers that only differ in whitespace, redundant parentheses, the side of
+a comparison or the order of `&`/`|` operands get the same canonical form.
+For conjunctions of simple comparisons, it can be decided whether one trigger
+selects a subset of the events of another one.
+"""
+import ast
+import math
+from typing import List, NamedTuple, Optional, Tuple
+
+import numexpr
+
+
+def trigger_branches(trigger: str) -> List[str]:
+    """The branch names that a numexpr trigger expression depends on."""
+    context = numexpr.necompiler.getContext({})
+    names, _ = numexpr.necompiler.getExprNames(trigger, context)
+    return names
+
+
+_compare_symbols = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+}
+_mirrored_compare = {
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+_binary_symbols = {
+    ast.Add: "+",
+    ast.Sub: "-",
+    ast.Mult: "*",
+    ast.Div: "/",
+    ast.Mod: "%",
+    ast.Pow: "**",
+    ast.LShift: "<<",
+    ast.RShift: ">>",
+    ast.BitAnd: "&",
+    ast.BitOr: "|",
+    ast.BitXor: "^",
+}
+_unary_symbols = {ast.Invert: "~", ast.USub: "-", ast.UAdd: "+"}
+
+
+def _is_number(node: ast.AST) -> bool:
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        return _is_number(node.operand)
+    return isinstance(node, ast.Constant) and isinstance(node.value, (int, float))
+
+
+def _number(node: ast.AST) -> float:
+    if isinstance(node, ast.UnaryOp):
+        sign = -1 if isinstance(node.op, ast.USub) else 1
+        return sign * _number(node.operand)
+    return node.value  # type: ignore
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # In a comparison, `x > 7.0` is the same as `x > 7`.
+    return repr(value)
+
+
+def _is_atomic(node: ast.AST) -> bool:
+    return isinstance(node, (ast.Name, ast.Constant, ast.Call)) or _is_number(node)
+
+
+def _wrapped(node: ast.AST) -> str:
+    text = _unparse(node)
+    return text if _is_atomic(node) else f"({text})"
+
+
+def _flatten_binary(node: ast.AST, op_type: type) -> List[ast.AST]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, op_type):
+        return _flatten_binary(node.left, op_type) + _flatten_binary(
+            node.right, op_type
+        )
+    return [node]
+
+
+def _unparse_comparison(left: ast.AST, op: ast.cmpop, right: ast.AST) -> str:
+    op_type = type(op)
+    if _is_number(left) and not _is_number(right):
+        left, right, op_type = right, left, _mirrored_compare[op_type]
+    sides = []
+    for side in (left, right):
+        if _is_number(side):
+            sides.append(_format_number(_number(side)))
+        else:
+            sides.append(_wrapped(side))
+    return f"{sides[0]}{_compare_symbols[op_type]}{sides[1]}"
+
+
+def _comparisons(node: ast.Compare) -> List[str]:
+    """A chained comparison `a < x < b` is a conjunction of comparisons."""
+    operands = [node.left] + node.comparators
+    return [
+        _unparse_comparison(left, op, right)
+        for left, op, right in zip(operands[:-1], node.ops, operands[1:])
+    ]
+
+
+def _terms(node: ast.BinOp) -> List[str]:
+    """The sorted, unique operands of a chain of `&` (or `|`)."""
+    terms = set()
+    for operand in _flatten_binary(node, type(node.op)):
+        is_chained = isinstance(operand, ast.Compare) and len(operand.ops) > 1
+        if is_chained and isinstance(node.op, ast.BitAnd):
+            terms |= {f"({c})" for c in _comparisons(operand)}  # type: ignore
+        else:
+            terms.add(_wrapped(operand))
+    return sorted(terms)
+
+
+def _unparse(node: ast.AST) -> str:
+    if isinstance(node, ast.Name):
+        return node.id
+    if _is_number(node):
+        return repr(_number(node))
+    if isinstance(node, ast.Constant):
+        return repr(node.value)
+    if isinstance(node, ast.Compare):
+        comparisons = sorted(set(_comparisons(node)))
+        if len(comparisons) == 1:
+            return comparisons[0]
+        return "&".join(f"({c})" for c in comparisons)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        return _binary_symbols[type(node.op)].join(_terms(node))
+    if isinstance(node, ast.BinOp):
+        symbol = _binary_symbols[type(node.op)]
+        return f"{_wrapped(node.left)}{symbol}{_wrapped(node.right)}"
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _unary_symbols:
+        return f"{_unary_symbols[type(node.op)]}{_wrapped(node.operand)}"
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        return f"{node.func.id}({','.join(_unparse(arg) for arg in node.args)})"
+    raise ValueError(f"Unsupported element in trigger expression: {ast.dump(node)}")
+
+
+def canonical_trigger(trigger: str) -> str:
+    """A whitespace-free, normalised form of the numexpr `trigger` expression.
+
+    >>> canonical_trigger("7 < nhit_slab")
+    'nhit_slab>7'
+    >>> canonical_trigger("(sum_energy > 0) & (nhit_slab >= 5.0)")
+    '(nhit_slab>=5)&(sum_energy>0)'
+    """
+    try:
+        tree = ast.parse(trigger.strip(), mode="eval")
+        return _unparse(tree.body)
+    except (SyntaxError, ValueError, KeyError):
+        return "".join(trigger.split())  # Fall back to whitespace removal.
+
+
+class Comparison(NamedTuple):
+    """`branch op value`, e.g. `nhit_slab > 7`."""
+
+    branch: str
+    op: str
+    value: float
+
+    def may_pass(self, minimum: float, maximum: float) -> bool:
+        """Whether any value within [minimum, maximum] can pass the comparison."""
+        return {
+            "==": minimum <= self.value <= maximum,
+            "!=": not minimum == maximum == self.value,
+            "<": minimum < self.value,
+            "<=": minimum <= self.value,
+            ">": maximum > self.value,
+            ">=": maximum >= self.value,
+        }[self.op]
+
+
+def simple_conjunction(trigger: str) -> Optional[List[Comparison]]:
+    """The trigger as comparisons of branches to numbers, all joined by `&`.
+
+    None if the trigger has any other form.
+    """
+    try:
+        expression = ast.parse(trigger.strip(), mode="eval").body
+    except SyntaxError:
+        return None
+    comparisons = []
+    for operand in _flatten_binary(expression, ast.BitAnd):
+        if not isinstance(operand, ast.Compare):
+            return None
+        nodes = [operand.left] + operand.comparators
+        for left, op, right in zip(nodes[:-1], operand.ops, nodes[1:]):
+            op_type = type(op)
+            if _is_number(left) and isinstance(right, ast.Name):
+                left, right, op_type = right, left, _mirrored_compare[op_type]
+            if op_type not in _compare_symbols:
+                return None
+            if not isinstance(left, ast.Name) or not _is_number(right):
+                return None
+            comparisons.append(
+                Comparison(left.id, _compare_symbols[op_type], _number(right))
+            )
+    return comparisons
+
+
+def _bounds(comparisons: List[Comparison]) -> Tuple[Tuple[float, bool], ...]:
+    """The interval allowed by the comparisons: (lower, inclusive), (upper, ...)."""
+    lower, upper = (-math.inf, False), (math.inf, False)
+    for c in comparisons:
+        if c.op in [">", ">=", "=="]:
+            bound = (c.value, c.op != ">")
+            if bound[0] > lower[0] or (bound[0] == lower[0] and not bound[1]):
+                lower = bound
+        if c.op in ["<", "<=", "=="]:
+            bound = (c.value, c.op != "<")
+            if bound[0] < upper[0] or (bound[0] == upper[0] and not bound[1]):
+                upper = bound
+    return lower, upper
+
+
+def implies(requested: List[Comparison], superset: List[Comparison]) -> bool:
+    """Whether every event passing `requested` also passes `superset`."""
+    for c in superset:
+        on_branch = [r for r in requested if r.branch == c.branch]
+        (lo, lo_inclusive), (hi, hi_inclusive) = _bounds(on_branch)
+        above = lo > c.value or (lo == c.value and not lo_inclusive)
+        below = hi < c.value or (hi == c.value and not hi_inclusive)
+        is_implied = {
+            ">": above,
+            ">=": lo >= c.value,
+            "<": below,
+            "<=": hi <= c.value,
+            "==": lo == hi == c.value and lo_inclusive and hi_inclusive,
+            "!=": above or below or c in on_branch,
+        }[c.op]
+        if not is_implied:
+            return False
+    return True
@@ -0,0 +1,55 @@
+"""Small helpers shared by the caches of `cosmics.io` and `cosmics.analysis`."""
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+EntryRange = Tuple[int, int]
+
+
+def merge_ranges(ranges: List[EntryRange]) -> List[EntryRange]:
+    """The sorted ranges, with overlapping and adjacent ranges combined."""
+    merged: List[EntryRange] = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def missing_ranges(processed: List[EntryRange], entry_stop: int) -> List[EntryRange]:
+    """The entry ranges below `entry_stop` that are not covered by `processed`."""
+    missing = []
+    start = 0
+    for processed_start, processed_stop in merge_ranges(processed):
+        if processed_start >= entry_stop:
+            break
+        if start < processed_start:
+            missing.append((start, processed_start))
+        start = max(start, processed_stop)
+    if start < entry_stop:
+        missing.append((start, entry_stop))
+    return missing
+
+
+def write_json(data: Any, filename: Path) -> None:
+    """Write via a `.part` file, so that readers never see a partial file."""
+    tmp_file = filename.with_suffix(".json.part")
+    with tmp_file.open("w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, filename)
+
+
+def write_npz(
+    data: Dict[str, Any],
+    filename: Path,
+    compressed: bool = False,
+) -> None:
+    """Write the arrays of `data` as `.npz`, via a `.part` file as `write_json`."""
+    tmp_file = filename.with_name(filename.name + ".part")
+    with tmp_file.open("wb") as f:
+        (np.savez_compressed if compressed else np.savez)(f, **data)
+    os.replace(tmp_file, filename)
@@ -0,0 +1,5 @@
+"""Track reconstruction for cosmic muons crossing the ECAL layers."""
+from .line_fit import fit_lines
+from .track_finding import find_tracks, iterate_tracks
+
+__all__ = ["find_tracks", "fit_lines", "iterate_tracks"]
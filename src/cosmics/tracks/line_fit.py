@@ -0,0 +1,85 @@
+"""Straight-line fits to the hits of many events at once."""
+from typing import Optional
+
+import awkward as ak
+import numpy as np
+
+
+def _segment_sum(values: np.ndarray, event_ids: np.ndarray, n_events: int):
+    return np.bincount(event_ids, weights=values, minlength=n_events)
+
+
+def _weighted_line(
+    z: np.ndarray,
+    u: np.ndarray,
+    weights: np.ndarray,
+    event_ids: np.ndarray,
+    n_events: int,
+):
+    """Closed-form weighted least squares of u = m * z + c, for every event."""
+    s = _segment_sum(weights, event_ids, n_events)
+    s_z = _segment_sum(weights * z, event_ids, n_events)
+    s_zz = _segment_sum(weights * z * z, event_ids, n_events)
+    s_u = _segment_sum(weights * u, event_ids, n_events)
+    s_zu = _segment_sum(weights * z * u, event_ids, n_events)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        determinant = s * s_zz - s_z ** 2
+        m = (s * s_zu - s_z * s_u) / determinant
+        c = (s_zz * s_u - s_z * s_zu) / determinant
+    return m, c
+
+
+def fit_lines(
+    x: ak.Array,
+    y: ak.Array,
+    z: ak.Array,
+    weights: Optional[ak.Array] = None,
+    n_iterations: int = 5,
+    f_scale: float = 5.5,
+) -> ak.Array:
+    """Fit x = m_x * z + c_x and y = m_y * z + c_y to the hits of each event.
+
+    As in `LineFromPlanes`, z parametrises the line. The jagged hit coordinates
+    (e.g. `hit_x`, `hit_y`, `hit_z`) of all events are fitted at once by weighted
+    least squares. The optional `weights` (e.g. positive `hit_energy`) multiply
+    the robust weights. After the first fit, `n_iterations` reweighting steps
+    with the `soft_l1` weights 1 / sqrt(1 + (r / f_scale)^2) suppress outliers,
+    where r is the hit's transverse distance to the line (f_scale in mm).
+
+    Returns one record per event: m_x, c_x, m_y, c_y, n_hits, rms and the jagged
+    transverse residuals. Events with all hits in one layer yield NaN.
+    """
+    counts = ak.to_numpy(ak.num(z))
+    n_events = len(counts)
+    event_ids = np.repeat(np.arange(n_events), counts)
+    x, y, z = [ak.to_numpy(ak.flatten(v)).astype(np.float64) for v in [x, y, z]]
+    if weights is None:
+        hit_weights = np.ones(len(z))
+    else:
+        hit_weights = ak.to_numpy(ak.flatten(weights)).astype(np.float64)
+
+    robust_weights = np.ones(len(z))
+    for _ in range(n_iterations + 1):
+        w = hit_weights * robust_weights
+        m_x, c_x = _weighted_line(z, x, w, event_ids, n_events)
+        m_y, c_y = _weighted_line(z, y, w, event_ids, n_events)
+        residuals = np.hypot(
+            x - (m_x[event_ids] * z + c_x[event_ids]),
+            y - (m_y[event_ids] * z + c_y[event_ids]),
+        )
+        robust_weights = 1 / np.sqrt(1 + (residuals / f_scale) ** 2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rms = np.sqrt(_segment_sum(residuals ** 2, event_ids, n_events) / counts)
+    return ak.zip(
+        {
+            "m_x": m_x,
+            "c_x": c_x,
+            "m_y": m_y,
+            "c_y": c_y,
+            "n_hits": counts,
+            "rms": rms,
+            "residuals": ak.unflatten(residuals, counts),
+        },
+        depth_limit=1,
+    )
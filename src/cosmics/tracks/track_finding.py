@@ -0,0 +1,180 @@
+"""Find (possibly several) straight tracks per event among noise hits."""
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import awkward as ak
+import numpy as np
+
+from .line_fit import fit_lines
+
+# Per group of events, the (hits x samples) residual matrix stays below this size.
+_max_elements = 2 ** 22
+
+
+def _ransac(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    counts: np.ndarray,
+    rng: np.random.Generator,
+    n_samples: int,
+    tolerance: float,
+    min_hits: int,
+    max_tracks: int,
+) -> np.ndarray:
+    """The track number of each hit (-1 for noise), for all events at once.
+
+    Per round, each event proposes `n_samples` lines through pairs of unassigned
+    hits in different layers. The line with most unassigned hits within
+    `tolerance` becomes a track if it has at least `min_hits` of them.
+    """
+    n_events = len(counts)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    event_ids = np.repeat(np.arange(n_events), counts)
+    hit_track = np.full(len(x), -1, dtype=np.int32)
+    n_tracks = np.zeros(n_events, dtype=np.int32)
+    for i_track in range(max_tracks):
+        is_free = hit_track < 0
+        n_free = np.bincount(event_ids, weights=is_free, minlength=n_events)
+        # Events stop once a round did not find a new track.
+        is_active = (n_free >= min_hits) & (n_tracks == i_track)
+        if not is_active.any():
+            break
+        random = rng.random((2, n_events, n_samples))
+        pairs = offsets[:-1, None] + (random * counts[:, None]).astype(np.int64)
+        first, second = np.minimum(pairs, max(len(x) - 1, 0))
+        dz = z[second] - z[first]
+        is_valid = is_active[:, None] & is_free[first] & is_free[second] & (dz != 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            m_x = (x[second] - x[first]) / dz
+            m_y = (y[second] - y[first]) / dz
+            c_x = x[first] - m_x * z[first]
+            c_y = y[first] - m_y * z[first]
+            residuals = np.hypot(
+                x[:, None] - (m_x[event_ids] * z[:, None] + c_x[event_ids]),
+                y[:, None] - (m_y[event_ids] * z[:, None] + c_y[event_ids]),
+            )
+            is_inlier = (residuals < tolerance) & is_free[:, None]
+        cumulative = np.concatenate(
+            [np.zeros((1, n_samples), dtype=np.int64), np.cumsum(is_inlier, axis=0)]
+        )
+        n_inliers = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+        n_inliers[~is_valid] = 0
+        best = n_inliers.argmax(axis=1)
+        is_found = n_inliers[np.arange(n_events), best] >= min_hits
+        is_assigned = is_inlier[np.arange(len(x)), best[event_ids]]
+        hit_track[is_assigned & is_found[event_ids]] = i_track
+        n_tracks += is_found
+    return hit_track
+
+
+def find_tracks(
+    x: ak.Array,
+    y: ak.Array,
+    z: ak.Array,
+    n_samples: int = 64,
+    tolerance: float = 5.5,
+    min_hits: int = 4,
+    max_tracks: int = 4,
+    seed: Optional[int] = 0,
+) -> ak.Array:
+    """RANSAC track finding on the jagged hit coordinates of many events.
+
+    `tolerance` is the transverse distance (mm, default: one cell) within which a
+    hit belongs to a track. Per event, up to `max_tracks` tracks are found.
+    The assigned hits of each track are then refitted with `fit_lines`.
+
+    Returns one record per event: n_tracks, the jagged `hit_track` (the track
+    number of each hit, -1 for noise) and the jagged fitted `tracks`.
+    """
+    counts = ak.to_numpy(ak.num(z))
+    x_flat, y_flat, z_flat = [
+        ak.to_numpy(ak.flatten(v)).astype(np.float64) for v in [x, y, z]
+    ]
+    rng = np.random.default_rng(seed)
+    hit_track = np.full(len(z_flat), -1, dtype=np.int32)
+    # Groups of whole events, so that the residual matrix fits into memory.
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    group_size = max(_max_elements // n_samples, 1)
+    event_groups = offsets[:-1] // group_size
+    group_edges = np.concatenate(
+        [[0], np.flatnonzero(np.diff(event_groups)) + 1, [len(counts)]]
+    )
+    for i_start, i_stop in zip(group_edges[:-1], group_edges[1:]):
+        hits = slice(offsets[i_start], offsets[i_stop])
+        hit_track[hits] = _ransac(
+            x_flat[hits],
+            y_flat[hits],
+            z_flat[hits],
+            counts[i_start:i_stop],
+            rng,
+            n_samples,
+            tolerance,
+            min_hits,
+            max_tracks,
+        )
+
+    event_ids = np.repeat(np.arange(len(counts)), counts)
+    is_assigned = hit_track >= 0
+    n_tracks = np.zeros(len(counts), dtype=np.int64)
+    np.maximum.at(n_tracks, event_ids[is_assigned], hit_track[is_assigned] + 1)
+    # Tracks are numbered consecutively, so the non-empty groups are ordered.
+    track_ids = event_ids * max_tracks + hit_track
+    order = np.argsort(track_ids[is_assigned], kind="stable")
+    track_counts = np.bincount(track_ids[is_assigned], minlength=1)
+    track_counts = track_counts[track_counts > 0]
+    fits = fit_lines(
+        *[
+            ak.unflatten(v[is_assigned][order], track_counts)
+            for v in [x_flat, y_flat, z_flat]
+        ]
+    )
+    return ak.zip(
+        {
+            "n_tracks": n_tracks,
+            "hit_track": ak.unflatten(hit_track, counts),
+            "tracks": ak.unflatten(fits, n_tracks),
+        },
+        depth_limit=1,
+    )
+
+
+def _find_tracks_in_chunk(
+    events: ak.Array,
+    seed: Optional[int],
+    kwargs: Dict[str, Any],
+) -> ak.Array:
+    """Worker function: The tracks of a chunk of events with hit coordinates."""
+    return find_tracks(events.hit_x, events.hit_y, events.hit_z, seed=seed, **kwargs)
+
+
+def iterate_tracks(
+    chunks: Iterable[ak.Array],
+    n_workers: int = 1,
+    seed: Optional[int] = 0,
+    **kwargs,
+) -> Iterator[ak.Array]:
+    """Yield the `find_tracks` results for each chunk, e.g. of `LoadTriggered.iterate`.
+
+    With `n_workers > 1`, chunks are processed in parallel processes. Results are
+    yielded in the order of the chunks, and at most `2 * n_workers` chunks are in
+    flight at any time.
+    """
+    chunk_seeds = itertools.repeat(None) if seed is None else itertools.count(seed)
+    if n_workers <= 1:
+        for chunk, chunk_seed in zip(chunks, chunk_seeds):
+            yield _find_tracks_in_chunk(chunk, chunk_seed, kwargs)
+        return
+    with ProcessPoolExecutor(n_workers) as executor:
+        pending: deque = deque()
+        for chunk, chunk_seed in zip(chunks, chunk_seeds):
+            hits = chunk[["hit_x", "hit_y", "hit_z"]]
+            pending.append(
+                executor.submit(_find_tracks_in_chunk, hits, chunk_seed, kwargs)
+            )
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
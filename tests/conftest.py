@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+
+_pos_xy = np.arange(3.8, 87, 5.5)
+default_pos = dict(
+    x=np.concatenate([-_pos_xy[::-1], _pos_xy]),
+    y=np.concatenate([-_pos_xy[::-1], _pos_xy]),
+    z=np.arange(0, 15),
+)
+
+
+def _random_ecal_cluster(rng: np.random.Generator, first_event: int, n: int) -> dict:
+    n_hits = rng.integers(0, 25, n)
+    n_total = n_hits.sum()
+
+    def jagged(values):
+        return ak.unflatten(values, n_hits)
+
+    slab = rng.integers(0, len(default_pos["z"]), n_total).astype(np.int32)
+    hits = {
+        "slab": slab,
+        "x": rng.choice(default_pos["x"], n_total),
+        "y": rng.choice(default_pos["y"], n_total),
+        "z": default_pos["z"][slab].astype(np.float64),
+        "isHit": (rng.random(n_total) < 0.9).astype(np.int32),
+        "isMasked": (rng.random(n_total) < 0.1).astype(np.int32),
+        "energy": rng.normal(20, 30, n_total),
+    }
+    nhit_slab = [len(set(s)) for s in np.split(slab, np.cumsum(n_hits)[:-1])]
+    return {
+        "event": np.arange(first_event, first_event + n, dtype=np.int32),
+        "bcid": rng.integers(0, 4096, n).astype(np.int32),
+        "nhit_slab": np.array(nhit_slab, dtype=np.int32),
+        "sum_energy": rng.normal(1000, 4000, n),
+        "hit": ak.zip({k: jagged(v) for k, v in hits.items()}),
+    }
+
+
+def write_ecal_file(
+    path: Path,
+    n_clusters: int = 5,
+    cluster_size: int = 400,
+    seed: int = 42,
+) -> Path:
+    """A small stand-in for a build file, written in several baskets."""
+    rng = np.random.default_rng(seed)
+    with uproot.recreate(path) as f:
+        for i in range(n_clusters):
+            cluster = _random_ecal_cluster(rng, i * cluster_size, cluster_size)
+            if i == 0:
+                f["ecal"] = cluster
+            else:
+                f["ecal"].extend(cluster)
+    return path
+
+
+@pytest.fixture(scope="session")
+def ecal_file(tmp_path_factory) -> Path:
+    return write_ecal_file(tmp_path_factory.mktemp("raw") / "build.root")
+
+
+@pytest.fixture
+def pos():
+    return {k: v.copy() for k, v in default_pos.items()}
@@ -0,0 +1,194 @@
+from types import SimpleNamespace
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+from scipy.optimize import approx_fprime
+
+from cosmics.analysis import (
+    LayerHistograms,
+    MipSpectra,
+    SumEnergyFit,
+    event_summaries,
+    slab_statistics,
+)
+from cosmics.analysis.slab_quality import default_conditions, passes
+from cosmics.analysis.sum_energy_fit import double_gauss_binned_nll, double_gauss_nll
+from cosmics.io import LoadTriggered, Mask
+from cosmics.io.trigger_cache import TriggerCache
+
+
+def test_layer_histograms(ecal_file, pos):
+    tree = uproot.open(ecal_file)["ecal"]
+    selections = {"all": None, "is_hit": "hit_isHit == 1"}
+    histograms = LayerHistograms(pos, selections)
+    histograms.fill_tree(tree, step_size=500)
+
+    events = tree.arrays(["hit_x", "hit_y", "hit_z", "hit_isHit"])
+    bins = [Mask.bins(pos["x"]), Mask.bins(pos["y"])]
+    for i_z, z in enumerate(pos["z"]):
+        for name, selection in [("all", True), ("is_hit", events.hit_isHit == 1)]:
+            is_selected = (events.hit_z == z) & selection
+            expected, _, _ = np.histogram2d(
+                *[
+                    ak.to_numpy(ak.flatten(events[f"hit_{v}"][is_selected]))
+                    for v in ["x", "y"]
+                ],
+                bins=bins,
+            )
+            assert np.all(histograms[name][i_z] == expected)
+    assert histograms.n_entries == tree.num_entries
+
+
+def test_layer_histograms_merge_and_resume(tmp_path, ecal_file, pos):
+    tree = uproot.open(ecal_file)["ecal"]
+    whole = LayerHistograms(pos)
+    whole.fill_tree(tree)
+
+    parts = []
+    for start, stop in [(0, 700), (700, 2000)]:
+        part = LayerHistograms(pos)
+        batch = tree.arrays(
+            ["hit_x", "hit_y", "hit_z"], entry_start=start, entry_stop=stop
+        )
+        part.fill(batch, (start, stop))
+        parts.append(part)
+    assert np.all(sum(parts).counts == whole.counts)
+    with pytest.raises(ValueError, match="overlap"):
+        parts[0] + parts[0]
+
+    file_name = tmp_path / "hit_maps.npz"
+    first = LayerHistograms.from_tree(file_name, tree, pos, entry_stop=1000)
+    assert first.entry_ranges == [(0, 1000)]
+    resumed = LayerHistograms.from_tree(file_name, tree, pos)
+    assert resumed.entry_ranges == [(0, 2000)]
+    assert np.all(resumed.counts == whole.counts)
+
+    # Histograms of other selections are not continued.
+    selections = {"hits": "hit_isHit == 1"}
+    other = LayerHistograms.from_tree(file_name, tree, pos, selections, 1000)
+    assert other.selections == selections and other.entry_ranges == [(0, 1000)]
+    assert np.all(other["hits"] <= whole["all"])
+
+
+def _mip_events(rng, pos, mpv, n_events=4000, n_hits=20):
+    """Hits with a Gaussian energy peak at the `mpv` of their (x, y, z) cell."""
+    ids = [rng.integers(0, len(pos[a]), (n_events, n_hits)) for a in "xyz"]
+    energy = rng.normal(mpv[tuple(ids)], 0.15 * mpv[tuple(ids)])
+    hits = {f"hit_{a}": pos[a][i] for a, i in zip("xyz", ids)}
+    hits["hit_energy"] = energy
+    hits["hit_isHit"] = np.ones((n_events, n_hits), dtype=np.int32)
+    hits["hit_isMasked"] = (rng.random((n_events, n_hits)) < 0.05).astype(np.int32)
+    return ak.zip({k: ak.Array(v) for k, v in hits.items()})
+
+
+def test_mip_spectra(tmp_path):
+    rng = np.random.default_rng(7)
+    pos = {"x": np.array([-3.0, 3.0]), "y": np.array([-3.0, 3.0]), "z": np.arange(3)}
+    mpv = rng.uniform(40, 80, (2, 2, 3))
+    chunks = [_mip_events(rng, pos, mpv) for _ in range(3)]
+    spectra = sum(MipSpectra(pos).fill_chunks([chunk]) for chunk in chunks)
+    assert spectra.n_events == 12_000
+    spectra.save(tmp_path / "spectra.npz")
+    spectra = MipSpectra.load(tmp_path / "spectra.npz")
+
+    fitted = spectra.fit()
+    assert np.all(fitted["is_valid"])
+    assert np.allclose(fitted["mpv"], mpv, rtol=0.03)
+    file_name = spectra.save_calibration(tmp_path)
+    assert np.allclose(np.load(file_name)["mpv"], fitted["mpv"])
+
+
+def _sum_energy(rng, n_events):
+    n_noise = n_events // 3
+    noise = rng.normal(0, 3000, n_noise)
+    signal = rng.normal(15000, 4000, n_events - n_noise)
+    return np.concatenate([noise, signal, np.zeros(100)])
+
+
+@pytest.mark.parametrize("nll", [double_gauss_nll, double_gauss_binned_nll])
+def test_double_gauss_gradients(nll):
+    fit = SumEnergyFit(_sum_energy(np.random.default_rng(8), 2000))
+    args = (fit.x,) if nll is double_gauss_nll else (fit.bin_edges, fit.counts)
+    p = np.array([0.3, 200, 2500, 14000, 5000])
+    numeric = approx_fprime(p, lambda q: nll(q, *args)[0], [1e-7] + 4 * [1e-3])
+    assert np.allclose(nll(p, *args)[1], numeric, rtol=1e-4)
+
+
+def test_sum_energy_fit():
+    fit = SumEnergyFit(_sum_energy(np.random.default_rng(9), 200_000), n_bins=50)
+    assert fit.fit_noise() == pytest.approx(3000, rel=0.02)
+    expected = [1 / 3, 0, 3000, 15000, 4000]
+    for binned in [True, False]:
+        res = fit.fit_double_gauss(binned=binned)
+        assert res.success
+        assert np.allclose(res.x, expected, rtol=0.05, atol=[0.01, 150, 0, 0, 0])
+    signal = fit.fit_signal(fit.fit_noise())
+    assert signal.x[0] == pytest.approx(15000, rel=0.05)
+
+
+def test_slab_statistics(tmp_path, ecal_file):
+    statistics = slab_statistics(ecal_file, cache_folder=tmp_path)
+    a = uproot.open(ecal_file)["ecal"].arrays(["hit_slab", "nhit_slab"])
+    first_four = sum(ak.any(a.hit_slab == k, axis=1) for k in range(4))
+    last_two = sum(ak.any(a.hit_slab == k, axis=1) for k in [13, 14])
+    selections = {
+        "standard": np.ones(len(a), dtype=bool),
+        "first3": first_four >= 3,
+        "first2": first_four >= 2,
+        "first2last1": (first_four >= 2) & (last_two >= 1),
+    }
+    for tag, is_selected in selections.items():
+        expected = np.bincount(ak.to_numpy(a.nhit_slab[is_selected]), minlength=16)
+        assert np.all(statistics.nhit_slab[tag] == expected)
+    expected = np.bincount(ak.to_numpy(ak.flatten(a.hit_slab)), minlength=15)
+    assert np.all(statistics.hit_slab == expected)
+
+    cached = slab_statistics(ecal_file, cache_folder=tmp_path)
+    assert all(
+        np.all(cached.nhit_slab[t] == statistics.nhit_slab[t]) for t in selections
+    )
+    assert cached.labels["first3"] == default_conditions["first3"].label
+
+
+def test_event_summaries(tmp_path, ecal_file):
+    a = uproot.open(ecal_file)["ecal"].arrays()
+    a = a[a.nhit_slab > 5]
+    load = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    summaries = event_summaries(load, "nhit_slab > 5")
+    is_valid = (a.hit_isHit == 1) & (a.hit_isMasked == 0)
+    assert np.all(summaries["n_valid"] == ak.sum(is_valid, axis=1))
+    for k in [0, 7, 14]:
+        n_valid_k = ak.sum(is_valid & (a.hit_slab == k), axis=1)
+        assert np.all(summaries["nhit_valid_slab"][:, k] == n_valid_k)
+        is_hit_k = ak.to_numpy(ak.any(a.hit_slab == k, axis=1))
+        assert np.all((summaries["slab_bitmask"] >> k & 1).astype(bool) == is_hit_k)
+    positive = ak.sum(a.hit_energy[a.hit_energy > 0], axis=1)
+    assert np.allclose(summaries["sum_energy_positive"], positive, rtol=1e-6)
+    assert summaries["nhit_valid_slab"].dtype == np.uint8
+
+    # Cuts are scalar filters, the events that pass are read by entry.
+    is_selected = (summaries["n_valid"] >= 10) & passes(
+        summaries["slab_bitmask"], default_conditions["first3"]
+    )
+    events = load.events_at(summaries["entry"][is_selected], "nhit_slab > 5")
+    first_four = sum(ak.any(a.hit_slab == k, axis=1) for k in range(4))
+    expected = a[(ak.sum(is_valid, axis=1) >= 10) & (first_four >= 3)]
+    assert ak.to_list(events.event) == ak.to_list(expected.event)
+
+    summary_files = sorted(load.cache("nhit_slab > 5").folder.glob("*.summaries.npz"))
+    assert summary_files
+    mtimes = [f.stat().st_mtime_ns for f in summary_files]
+    again = event_summaries(load, "nhit_slab > 5")
+    assert [f.stat().st_mtime_ns for f in summary_files] == mtimes
+    assert np.all(again["entry"] == summaries["entry"])
+
+    empty_cache = SimpleNamespace(
+        cache=lambda trigger: TriggerCache(tmp_path / "none", trigger)
+    )
+    empty = event_summaries(empty_cache, "nhit_slab > 5")
+    assert empty.keys() == summaries.keys()
+    for name, values in empty.items():
+        assert values.shape == (0,) + summaries[name].shape[1:]
+        assert values.dtype == summaries[name].dtype
@@ -0,0 +1,41 @@
+import json
+import shutil
+
+import yaml
+
+from cosmics.cli.cli import main
+from cosmics.cli.pipeline import load_config, run_pipeline
+
+
+def _write_config(tmp_path, ecal_file, pos, **pipeline):
+    raw_folder = tmp_path / "data" / "raw"
+    raw_folder.mkdir(parents=True)
+    shutil.copy(ecal_file, raw_folder / "test_run.root")
+    pipeline["pos"] = {axis: values.tolist() for axis, values in pos.items()}
+    config = {"cosmics": {"name": "test_run"}, "pipeline": pipeline}
+    config_file = tmp_path / "cosmics.yaml"
+    with config_file.open("w") as f:
+        yaml.safe_dump(config, f)
+    return config_file
+
+
+def test_pipeline_skips_up_to_date_stages(tmp_path, ecal_file, pos, capsys):
+    config_file = _write_config(tmp_path, ecal_file, pos, trigger="nhit_slab > 5")
+    assert main([str(config_file), "--n-workers", "2"]) == 0
+    run, _ = load_config(config_file)
+    assert (run.folders["mask"] / "mask.npz").is_file()
+    assert (run.folders["mask"] / "mip_calibration.npz").is_file()
+    with (run.folders["analysis"] / "sum_energy_fit.json").open() as f:
+        assert set(json.load(f)) >= {"mip_mean", "mip_width"}
+    capsys.readouterr()
+
+    results = run_pipeline(run, ["sum_energy_fit"])
+    assert list(results) == ["triggered", "sum_energy_fit"]
+    assert capsys.readouterr().out.count("is up to date") == 2
+
+    # A changed trigger invalidates the stages that depend on it.
+    run = run._replace(trigger="nhit_slab > 6")
+    run_pipeline(run, ["sum_energy_fit", "slab_statistics"])
+    out = capsys.readouterr().out
+    assert "Stage triggered started" in out and "Stage sum_energy_fit started" in out
+    assert "Stage slab_statistics is up to date" in out
@@ -1,8 +1,569 @@
+import concurrent.futures
+import os
+import threading
+from types import SimpleNamespace
+
+import awkward as ak
 import numpy as np
+import pytest
+import uproot
+from conftest import write_ecal_file
 
-from cosmics.io.mask_from_build_file import _write_3d_numpy
+from cosmics.io import LoadTriggered, Mask, event_selection, multi_run, process_runs
+from cosmics.io.event_index import EventIndex
+from cosmics.io.mask_from_build_file import (
+    MaskHistory,
+    _read_3d_numpy,
+    _write_3d_numpy,
+    fill_batch_is_masked,
+    get_is_masked,
+    get_mask_history,
+)
+from cosmics.io.memory import AdaptiveStepSize, iterate_adaptive, memory_size
+from cosmics.io.staging import LocalTransport, RunSpec, StagingCache, Transport
+from cosmics.io.trigger_cache import CacheIndex, TriggerCache
+from cosmics.io.trigger_expression import canonical_trigger
 
 
 def test_mask_read_write(tmp_path):
-    array_3d = np.empty((10, 9, 5), dtype=int)
+    array_3d = np.random.default_rng(0).integers(-1, 2, (10, 9, 5))
     _write_3d_numpy(array_3d, tmp_path / "mask.txt")
+    assert np.all(_read_3d_numpy(tmp_path / "mask.txt") == array_3d)
+
+
+def test_mask_binary_round_trip(tmp_path, pos):
+    rng = np.random.default_rng(1)
+    values = rng.integers(-1, 2, (len(pos["x"]), len(pos["y"]), len(pos["z"])))
+    Mask(values, pos, {"run": "test"}).save(tmp_path / "mask.npz")
+    for mmap in [True, False]:
+        mask = Mask.load(tmp_path / "mask.npz", mmap=mmap)
+        assert mask.values.dtype == np.int8
+        assert np.all(mask.values == values)
+        assert np.all(mask.x == pos["x"]) and mask.metadata == {"run": "test"}
+    assert isinstance(Mask.load(tmp_path / "mask.npz").values, np.memmap)
+
+    mask_file = tmp_path / "mask.npz"
+    content = bytearray(mask_file.read_bytes())
+    i_values = content.find(values.astype(np.int8).tobytes()[:64])
+    content[i_values] = (content[i_values] + 1) % 3
+    mask_file.write_bytes(bytes(content))
+    with pytest.raises(ValueError, match="checksum"):
+        Mask.load(mask_file)
+
+
+def test_parallel_trigger_matches_serial(tmp_path, ecal_file):
+    kw = dict(root_file=ecal_file, root_tree="ecal", step_size="10 kB")
+    serial = LoadTriggered(tmp_path / "serial", **kw)
+    parallel = LoadTriggered(tmp_path / "parallel", n_workers=3, **kw)
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    expected = serial("nhit_slab > 7")
+    assert len(expected) > 0
+    assert ak.to_list(parallel("nhit_slab > 7")) == ak.to_list(expected)
+
+
+def test_parallel_trigger_holds_few_ranges(tmp_path, ecal_file, monkeypatch):
+    n_held = []
+
+    class InlineExecutor(concurrent.futures.Executor):
+        """Runs each range on submission, and counts the unconsumed results."""
+
+        def __init__(self, n_workers):
+            self.n_unconsumed = 0
+
+        def submit(self, function, *args):
+            future = concurrent.futures.Future()
+            future.set_result(function(*args))
+            self.n_unconsumed += 1
+            n_held.append(self.n_unconsumed)
+            result = future.result
+
+            def consume():
+                self.n_unconsumed -= 1
+                return result()
+
+            future.result = consume
+            return future
+
+    monkeypatch.setattr(event_selection, "ProcessPoolExecutor", InlineExecutor)
+    load = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB", n_workers=2)
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    assert ak.to_list(load("nhit_slab > 7")) == ak.to_list(full[full.nhit_slab > 7])
+    assert len(n_held) > 2 and max(n_held) == 2
+
+
+def test_common_basket_boundaries():
+    offsets = {"event": [0, 100, 200, 300], "hit_x": [0, 150, 300]}
+    tree = {name: SimpleNamespace(entry_offsets=o) for name, o in offsets.items()}
+    assert list(event_selection._common_boundaries(tree, None)) == [0, 300]
+    assert list(event_selection._common_boundaries(tree, ["event"])) == offsets["event"]
+    assert list(event_selection._basket_boundaries(tree, None)) == [
+        0,
+        100,
+        150,
+        200,
+        300,
+    ]
+
+
+def test_first_triggered_batch_within_step_size(ecal_file):
+    tree = uproot.open(ecal_file)["ecal"]
+    batches = event_selection._iterate_triggered(
+        tree, ["nhit_slab > 7"], 0, tree.num_entries, "10 kB"
+    )
+    first = next(batches)
+    batches.close()
+    # The step size refers to all output branches, not only the trigger ones.
+    assert first.entry_stop - first.entry_start <= tree.num_entries_for("10 kB")
+
+
+def test_trigger_with_branch_subset(tmp_path, ecal_file):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    expected = full[["event", "hit_energy"]][full.nhit_slab > 7]
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    events = load_triggered("nhit_slab > 7", branches=["event", "hit_energy"])
+    assert events.fields == ["event", "hit_energy"]
+    assert ak.to_list(events) == ak.to_list(expected)
+    assert not list(tmp_path.iterdir())
+
+
+def test_iterate_writes_cache(tmp_path, ecal_file):
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    chunks = list(load_triggered.iterate("nhit_slab > 7", chunk_size=100))
+    assert all(len(chunk) == 100 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 100
+    from_cache = load_triggered("nhit_slab > 7")
+    assert ak.to_list(ak.concatenate(chunks)) == ak.to_list(from_cache)
+    cached_chunks = list(load_triggered.iterate("nhit_slab > 7", 250, chunk_size=100))
+    assert [len(chunk) for chunk in cached_chunks] == [100, 100, 50]
+
+
+def test_cache_is_extended(tmp_path, ecal_file):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    partial = load_triggered("nhit_slab > 7", entry_stop=1000)
+    assert ak.to_list(partial) == ak.to_list(full[:1000][full[:1000].nhit_slab > 7])
+    for _ in load_triggered.iterate("nhit_slab > 7", chunk_size=10):
+        break  # Simulate an interruption.
+    cache = TriggerCache(tmp_path / load_triggered.cache_key("7 < nhit_slab"), "")
+    assert cache.missing_ranges(len(full))[0][0] >= 1000
+    events = load_triggered("nhit_slab > 7")
+    assert ak.to_list(events) == ak.to_list(full[full.nhit_slab > 7])
+    assert TriggerCache(cache.folder, "").is_complete(len(full))
+    index = CacheIndex(tmp_path).entries[cache.folder.name]
+    assert index["trigger"] == "nhit_slab>7"
+    assert index["n_triggered"] == len(events)
+
+
+def test_cache_reused_for_regenerated_file(tmp_path, monkeypatch):
+    raw_file = write_ecal_file(tmp_path / "raw.root", n_clusters=3)
+    load_triggered = LoadTriggered(tmp_path / "cache", raw_file, "ecal", "10 kB")
+    load_triggered("nhit_slab > 7")
+    # Same path, new UUID, the first events unchanged and new ones appended.
+    write_ecal_file(raw_file, n_clusters=5)
+    full = uproot.open(raw_file)["ecal"].arrays()
+    triggered_ranges = []
+    iterate_triggered = event_selection._iterate_triggered
+
+    def record_ranges(tree, triggers, entry_start, entry_stop, *args, **kwargs):
+        triggered_ranges.append((entry_start, entry_stop))
+        return iterate_triggered(tree, triggers, entry_start, entry_stop, *args)
+
+    monkeypatch.setattr(event_selection, "_iterate_triggered", record_ranges)
+    events = load_triggered("nhit_slab > 7")
+    assert triggered_ranges == [(1200, 2000)]
+    assert ak.to_list(events) == ak.to_list(full[full.nhit_slab > 7])
+
+    # Changed events invalidate the cache.
+    write_ecal_file(raw_file, n_clusters=5, seed=1)
+    full = uproot.open(raw_file)["ecal"].arrays()
+    triggered_ranges.clear()
+    events = load_triggered("nhit_slab > 7")
+    assert triggered_ranges == [(0, 2000)]
+    assert ak.to_list(events) == ak.to_list(full[full.nhit_slab > 7])
+
+    # Only the hits changed (same `event`, `bcid` and trigger branch), and
+    # events were appended: the cache is invalidated too.
+    size = raw_file.stat().st_size
+    other = write_ecal_file(tmp_path / "other.root", n_clusters=6, seed=1)
+    other = uproot.open(other)["ecal"].arrays()
+    hit_fields = [name for name in other.fields if name.startswith("hit_")]
+    with uproot.recreate(raw_file) as f:
+        for start in range(0, len(other), 400):
+            cluster = other[start : start + 400]
+            hits = {name[4:]: cluster[name] for name in hit_fields}
+            hits["energy"] = hits["energy"] + 1
+            columns = ["event", "bcid", "nhit_slab", "sum_energy"]
+            cluster = {**{k: cluster[k] for k in columns}, "hit": ak.zip(hits)}
+            if start == 0:
+                f["ecal"] = cluster
+            else:
+                f["ecal"].extend(cluster)
+    assert raw_file.stat().st_size >= size
+    full = uproot.open(raw_file)["ecal"].arrays()
+    triggered_ranges.clear()
+    events = load_triggered("nhit_slab > 7")
+    assert triggered_ranges == [(0, 2400)]
+    assert ak.to_list(events) == ak.to_list(full[full.nhit_slab > 7])
+
+
+def test_canonical_trigger():
+    assert canonical_trigger("nhit_slab>7") == canonical_trigger(" 7 < nhit_slab")
+    assert canonical_trigger("(a == 1) & (b > 2.0)") == canonical_trigger(
+        "(2<b)&(a==1)"
+    )
+    assert canonical_trigger("1 < a < 3") == canonical_trigger("(a<3) & (a>1)")
+    assert canonical_trigger("a > 1") != canonical_trigger("a >= 1")
+
+
+def test_derive_from_cached_superset(tmp_path, ecal_file, monkeypatch):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    load_triggered("nhit_slab > 5")
+
+    def no_raw_reading(*args, **kwargs):
+        raise AssertionError("The raw tree should not be triggered.")
+
+    monkeypatch.setattr(event_selection, "_iterate_triggered", no_raw_reading)
+    trigger = "(nhit_slab > 10) & (sum_energy > 0)"
+    events = load_triggered(trigger)
+    expected = full[(full.nhit_slab > 10) & (full.sum_energy > 0)]
+    assert ak.to_list(events) == ak.to_list(expected)
+    assert len(CacheIndex(tmp_path).entries) == 2
+
+
+def test_derive_from_superset_with_empty_chunks(tmp_path, ecal_file, monkeypatch):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    load_triggered("nhit_slab == 8")
+    superset = TriggerCache(tmp_path / load_triggered.cache_key("nhit_slab == 8"), "")
+    assert any(chunk["n_triggered"] == 0 for chunk in superset.chunks)
+
+    def no_raw_reading(*args, **kwargs):
+        raise AssertionError("The raw tree should not be triggered.")
+
+    monkeypatch.setattr(event_selection, "_iterate_triggered", no_raw_reading)
+    events = load_triggered("(nhit_slab >= 8) & (nhit_slab <= 8)")
+    assert ak.to_list(events) == ak.to_list(full[full.nhit_slab == 8])
+
+
+def test_lazy_cached_events(tmp_path, ecal_file, monkeypatch):
+    monkeypatch.setattr(TriggerCache, "row_group_size", 50)
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    expected = load_triggered("nhit_slab > 7")
+    events = load_triggered("nhit_slab > 7", entry_stop=120, lazy=True)
+    assert len(ak.partitions(events)) > 2
+    assert ak.to_list(events.hit_energy) == ak.to_list(expected.hit_energy[:120])
+    events = load_triggered("nhit_slab > 7", branches=["event"], lazy=True)
+    assert events.fields == ["event"]
+    assert ak.to_list(events.event) == ak.to_list(expected.event)
+
+
+def test_event_and_hit_level_files(tmp_path, ecal_file, monkeypatch):
+    monkeypatch.setattr(TriggerCache, "row_group_size", 50)
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    expected = full[full.nhit_slab > 7]
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    chunks = list(load_triggered.iterate("nhit_slab > 7", chunk_size=100))
+    cache = TriggerCache(tmp_path / load_triggered.cache_key("nhit_slab > 7"), "")
+    chunk = cache.chunks[0]
+    assert chunk["hit_file"] == chunk["file"].replace(".parquet", ".hits.parquet")
+    assert cache.event_branches() == [
+        f for f in full.fields if not f.startswith("hit_")
+    ]
+    from_cache = load_triggered("nhit_slab > 7")
+    for events in [ak.concatenate(chunks), from_cache]:
+        assert sorted(events.fields) == sorted(full.fields)
+        assert ak.to_list(events[full.fields]) == ak.to_list(expected)
+
+    # Event-level queries do not touch the hit-level files.
+    for chunk in cache.chunks:
+        (cache.folder / chunk["hit_file"]).unlink()
+    event_level = load_triggered.event_level("nhit_slab > 7")
+    assert event_level.fields == cache.event_branches()
+    assert ak.to_list(event_level) == ak.to_list(expected[event_level.fields])
+    lazy = load_triggered.event_level("nhit_slab > 7", lazy=True)
+    assert ak.to_list(lazy.sum_energy) == ak.to_list(expected.sum_energy)
+
+
+def test_memory_size():
+    assert memory_size("100 MB") == memory_size("100MB") == 100_000_000
+    assert memory_size("1 GiB") == 1024 ** 3
+    assert memory_size("0.5kB") == 500
+    with pytest.raises(ValueError):
+        memory_size("100 entries")
+
+
+def test_adaptive_step_size_covers_entries(ecal_file):
+    tree = uproot.open(ecal_file)["ecal"]
+    step = AdaptiveStepSize("20 kB")
+    ranges = [
+        (start, stop)
+        for _, start, stop in iterate_adaptive(tree, None, 0, tree.num_entries, step)
+    ]
+    assert ranges[0][0] == 0 and ranges[-1][1] == tree.num_entries
+    assert all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+    # The measured size per entry keeps the batches below the memory ceiling.
+    n_bytes_per_entry = tree.arrays().nbytes / tree.num_entries
+    assert all(
+        (stop - start - 1) * n_bytes_per_entry < 40_000 for start, stop in ranges[1:]
+    )
+
+
+def test_expected_bytes_per_entry(ecal_file):
+    tree = uproot.open(ecal_file)["ecal"]
+    step = AdaptiveStepSize("10 kB")
+    step.expect(step.target_bytes / 20)
+    batches = iterate_adaptive(tree, ["event"], 0, tree.num_entries, step)
+    assert next(batches)[1:] == (0, 20)
+    batches.close()
+    # Measured batches take over.
+    step.update(100, step.target_bytes)
+    step.expect(1)
+    assert step.n_entries(tree, ["event"]) < step.target_bytes
+
+
+def test_prefetched_batches(ecal_file):
+    tree = uproot.open(ecal_file)["ecal"]
+    keys = ["event", "nhit_slab"]
+    sequential = list(
+        iterate_adaptive(
+            tree, keys, 0, tree.num_entries, AdaptiveStepSize(300), prefetch=0
+        )
+    )
+    step = AdaptiveStepSize(300)
+    batches = iterate_adaptive(tree, keys, 0, tree.num_entries, step, prefetch=3)
+    prefetched = list(batches)
+    assert [b[1:] for b in prefetched] == [b[1:] for b in sequential]
+    for (batch, _, _), (expected, _, _) in zip(prefetched, sequential):
+        assert ak.to_list(batch) == ak.to_list(expected)
+    assert 1 <= step.prefetch_depth(3) <= 3
+    # Stopping early leaves no reads behind.
+    batches = iterate_adaptive(tree, keys, 0, tree.num_entries, step, prefetch=3)
+    assert next(batches)[1:] == (0, 300)
+    batches.close()
+
+
+def test_fill_batch_is_masked(ecal_file, pos):
+    keys = ["hit_x", "hit_y", "hit_z", "hit_isMasked"]
+    batch = uproot.open(ecal_file)["ecal"].arrays(keys, entry_stop=300)
+    pos["x"] = pos["x"][::2]  # Hits outside of the positions are ignored.
+    shape = (len(pos["x"]), len(pos["y"]), len(pos["z"]))
+    expected = np.full(shape, -1)
+    expected[0, 0, 0] = 1  # Known cells are kept.
+    is_masked = fill_batch_is_masked(batch, expected.copy(), pos)
+    for x, y, z, m in zip(*[ak.flatten(batch[k]) for k in keys]):
+        if x in pos["x"]:
+            cell = tuple(
+                np.flatnonzero(pos[k] == v)[0] for k, v in zip("xyz", [x, y, z])
+            )
+            if expected[cell] == -1:
+                expected[cell] = m
+    assert np.all(is_masked == expected)
+
+
+def test_mask_history(tmp_path, ecal_file, pos):
+    tree = uproot.open(ecal_file)["ecal"]
+    history = get_mask_history(tree, pos, step_size=300)
+    history.save(tmp_path / "history.npz")
+    history = MaskHistory.load(tmp_path / "history.npz")
+    assert np.all(history.first_values() == get_is_masked(tree, pos))
+
+    keys = ["hit_x", "hit_y", "hit_z", "hit_isMasked"]
+    hits = tree.arrays(keys)
+    entries = np.repeat(np.arange(len(hits)), ak.num(hits.hit_x))
+    ids = [
+        np.searchsorted(pos[k], ak.to_numpy(ak.flatten(hits[f"hit_{k}"])))
+        for k in "xyz"
+    ]
+    cells = np.ravel_multi_index(ids, history.shape)
+    states = ak.to_numpy(ak.flatten(hits.hit_isMasked))
+    for entry in [0, 299, 300, 1234, len(hits) - 1]:
+        expected = np.full(np.prod(history.shape), -1)
+        is_before = entries <= entry
+        # The last state seen before the entry.
+        last_cells, i_last = np.unique(cells[is_before][::-1], return_index=True)
+        expected[last_cells] = states[is_before][::-1][i_last]
+        assert np.all(history.values_at(entry).ravel() == expected)
+    last = history.values_at(len(hits) - 1)
+    assert np.all(history.values_at(len(hits) + 10 ** 6) == last)
+    assert np.all(history.values_at(-1) == -1)
+
+    mask = Mask(history.first_values(), pos, history=history)
+    assert np.all(mask.at_entry(1234).values == history.values_at(1234))
+    intervals = history.intervals(*np.unravel_index(cells[0], history.shape))
+    assert np.all(intervals.entry_start[1:] == intervals.entry_stop[:-1])
+    assert intervals.entry_stop[-1] == len(hits)
+
+
+def _n_entries(root_file):
+    return uproot.open(root_file)["ecal"].num_entries
+
+
+def test_process_runs(tmp_path):
+    runs = {
+        f"run{i}": write_ecal_file(tmp_path / f"run{i}.root", n_clusters=i, seed=i)
+        for i in [1, 3, 2]
+    }
+    expected = {"run1": 400, "run3": 1200, "run2": 800}
+    results = process_runs(runs, _n_entries, n_workers=2, memory_budget="1 MB")
+    assert results == expected and list(results) == list(expected)
+    assert process_runs(list(runs.values()), _n_entries, n_workers=1) == expected
+
+    # Only the workers that process a run count towards the memory budget.
+    busy_pids = {}
+
+    def busy_runs(root_file):
+        return dict(busy_pids)
+
+    busy = multi_run._run_task(busy_runs, runs["run1"], "run1", busy_pids)
+    assert busy == {"run1": os.getpid()}
+    assert busy_pids == {}
+
+    runs["broken"] = tmp_path / "missing.root"
+    with pytest.raises(RuntimeError, match="broken"):
+        process_runs(runs, _n_entries, n_workers=2, poll_interval=0.1)
+
+
+class _CountingTransport(LocalTransport):
+    def __init__(self, root, fail_after=None):
+        super().__init__(root)
+        self.n_reads = 0
+        self.fail_after = fail_after
+        self._lock = threading.Lock()
+
+    def read(self, path, offset, length):
+        with self._lock:
+            if self.fail_after is not None and self.n_reads >= self.fail_after:
+                raise OSError("Connection lost.")
+            self.n_reads += 1
+        return super().read(path, offset, length)
+
+
+class _CorruptingTransport(LocalTransport):
+    def read(self, path, offset, length):
+        return bytes(length)
+
+
+def test_staging_cache(tmp_path):
+    rng = np.random.default_rng(0)
+    server_folder = tmp_path / "server" / "data_ilc"
+    server_folder.mkdir(parents=True)
+    specs = []
+    for name in ["run_a", "run_b", "run_c"]:
+        (server_folder / f"{name}.root").write_bytes(rng.bytes(1000_000))
+        specs.append(RunSpec(name, "/data_ilc", "server"))
+    kwargs = dict(max_size="2.5 MB", chunk_size="100 kB", n_workers=3)
+
+    transport = _CountingTransport(tmp_path / "server", fail_after=4)
+    cache = StagingCache(tmp_path / "cache", transport=transport, **kwargs)
+    with pytest.raises(OSError):
+        cache.stage(specs[0])
+    # The interrupted copy is continued, and verified against the source.
+    transport = _CountingTransport(tmp_path / "server")
+    cache = StagingCache(tmp_path / "cache", transport=transport, **kwargs)
+    staged = cache.stage(specs[0])
+    assert transport.n_reads == 10 - 4
+    assert staged.read_bytes() == (server_folder / "run_a.root").read_bytes()
+    cache.stage(specs[0])
+    assert transport.n_reads == 10 - 4
+
+    # The least recently used file makes room.
+    cache.stage(specs[1])
+    cache.stage(specs[0])
+    cache.stage(specs[2])
+    assert {spec.key for spec in [specs[0], specs[2]]} == set(cache.entries)
+    assert not cache._file(specs[1]).exists()
+    assert cache.n_bytes <= cache.max_size
+
+    cache = StagingCache(
+        tmp_path / "other",
+        transport=_CorruptingTransport(tmp_path / "server"),
+        **kwargs,
+    )
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        cache.stage(specs[0])
+
+    class _NoChecksumTransport(Transport):
+        def stat(self, path):
+            return 0, 0.0
+
+        def read(self, path, offset, length):
+            return b""
+
+    with pytest.raises(TypeError):
+        _NoChecksumTransport()  # Incomplete transports fail early.
+
+
+def test_event_index(tmp_path, ecal_file):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    load_triggered("nhit_slab > 5")
+    # The trigger pass indexed all raw entries on the way.
+    assert len(list((tmp_path / "event_index").iterdir())) == 1
+    index = load_triggered.event_index()
+    assert not index.missing_ranges()
+    assert list(index.entries(full.event[1234], full.bcid[1234])) == [1234]
+
+    for trigger in [None, "nhit_slab > 5"]:
+        is_expected = (full.event == full.event[1234]) | (full.event == 17)
+        if trigger is not None:
+            is_expected = is_expected & (full.nhit_slab > 5)
+        found = [
+            load_triggered.find(e, trigger=trigger) for e in [17, full.event[1234]]
+        ]
+        assert ak.to_list(ak.concatenate(found)) == ak.to_list(full[is_expected])
+
+    rng = np.random.default_rng(1)
+    source = {"num_entries": 1000}
+    values = {"event": np.repeat(np.arange(100), 10), "bcid": rng.integers(0, 50, 1000)}
+    index = EventIndex(source)
+    index.add((500, 1000), {k: v[500:] for k, v in values.items()})
+    index.add((0, 500), {k: v[:500] for k, v in values.items()})
+    is_window = (values["event"] == 42) & (np.abs(values["bcid"] - 20) <= 5)
+    assert list(index.entries(42, 20, delta=5)) == list(np.flatnonzero(is_window))
+    assert list(index.entries(42)) == list(range(420, 430))
+    index.save(tmp_path / "index.npz")
+    loaded = EventIndex.load(tmp_path / "index.npz", {"num_entries": 1100})
+    assert loaded.missing_ranges() == [(1000, 1100)]
+    assert list(loaded.entries(42, 20, delta=5)) == list(np.flatnonzero(is_window))
+
+
+def test_build_several_triggers(tmp_path, ecal_file, monkeypatch):
+    full = uproot.open(ecal_file)["ecal"].arrays()
+    load_triggered = LoadTriggered(tmp_path, ecal_file, "ecal", step_size="10 kB")
+    load_triggered.build(["nhit_slab > 5"], entry_stop=1000)
+    passes = {
+        "nhit_slab > 5": full.nhit_slab > 5,
+        "sum_energy > 0": full.sum_energy > 0,
+        "nhit > 100": full.nhit > 100,
+    }
+
+    calls = []
+    iterate_triggered = event_selection._iterate_triggered
+
+    def counting(tree, triggers, *args, **kwargs):
+        calls.append((triggers, args[:2]))
+        return iterate_triggered(tree, triggers, *args, **kwargs)
+
+    monkeypatch.setattr(event_selection, "_iterate_triggered", counting)
+    n_triggered = load_triggered.build(list(passes))
+    assert calls == [
+        (["sum_energy>0", "nhit>100"], (0, 1000)),
+        (["nhit_slab>5", "sum_energy>0", "nhit>100"], (1000, 2000)),
+    ]
+    assert list(n_triggered.values()) == [ak.sum(p) for p in passes.values()]
+    for trigger, is_passing in passes.items():
+        assert ak.to_list(load_triggered(trigger)) == ak.to_list(full[is_passing])
+    assert len(calls) == 2
+
+    bitmaps = {trigger: load_triggered.bitmap(trigger) for trigger in passes}
+    assert all(np.all(bitmaps[t] == passes[t]) for t in passes)
+    selection = bitmaps["nhit_slab > 5"] & ~bitmaps["sum_energy > 0"]
+    events = load_triggered.events_at(selection, trigger="nhit_slab > 5")
+    expected = full[passes["nhit_slab > 5"] & ~passes["sum_energy > 0"]]
+    assert ak.to_list(events) == ak.to_list(expected)
+    selection = bitmaps["sum_energy > 0"] | bitmaps["nhit > 100"]
+    events = load_triggered.events_at(selection, branches=["event"])
+    expected = full.event[passes["sum_energy > 0"] | passes["nhit > 100"]]
+    assert ak.to_list(events.event) == ak.to_list(expected)
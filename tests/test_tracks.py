@@ -0,0 +1,85 @@
+import awkward as ak
+import numpy as np
+
+from cosmics.tracks import find_tracks, fit_lines, iterate_tracks
+
+
+def _random_tracks(rng, n_events, noise=0.5, n_outliers=0):
+    n_layers = rng.integers(3, 15, n_events)
+    z = ak.unflatten(
+        np.concatenate([rng.permutation(15)[:n] for n in n_layers]), n_layers
+    )
+    truth = {k: rng.normal(0, s, n_events) for k, s in [("m", 2), ("c", 40)]}
+    truth_y = {k: rng.normal(0, s, n_events) for k, s in [("m", 2), ("c", 40)]}
+    n_total = ak.sum(n_layers)
+    x = (
+        truth["m"] * z
+        + truth["c"]
+        + ak.unflatten(rng.normal(0, noise, n_total), n_layers)
+    )
+    y = (
+        truth_y["m"] * z
+        + truth_y["c"]
+        + ak.unflatten(rng.normal(0, noise, n_total), n_layers)
+    )
+    if n_outliers:
+        x = ak.concatenate([x, rng.uniform(-90, 90, (n_events, n_outliers))], axis=1)
+        y = ak.concatenate([y, rng.uniform(-90, 90, (n_events, n_outliers))], axis=1)
+        z = ak.concatenate([z, rng.integers(0, 15, (n_events, n_outliers))], axis=1)
+    return x, y, z, truth["m"], truth_y["m"]
+
+
+def test_fit_lines_matches_least_squares():
+    rng = np.random.default_rng(3)
+    x, y, z, _, _ = _random_tracks(rng, 50)
+    fits = fit_lines(x, y, z, n_iterations=0)
+    for i in range(len(z)):
+        m_x, c_x = np.polyfit(ak.to_numpy(z[i]), ak.to_numpy(x[i]), 1)
+        assert np.isclose(fits.m_x[i], m_x) and np.isclose(fits.c_x[i], c_x)
+    assert ak.all(ak.num(fits.residuals) == ak.num(z))
+
+
+def test_fit_lines_is_robust():
+    rng = np.random.default_rng(4)
+    x, y, z, m_x, m_y = _random_tracks(rng, 2000, n_outliers=1)
+    plain = fit_lines(x, y, z, n_iterations=0)
+    robust = fit_lines(x, y, z)
+    is_long = ak.to_numpy(robust.n_hits) >= 9
+    error = np.abs(ak.to_numpy(robust.m_x) - m_x)[is_long]
+    assert np.median(error) < np.median(np.abs(ak.to_numpy(plain.m_x) - m_x)[is_long])
+    assert np.median(error) < 0.1
+
+
+def test_fit_lines_single_layer():
+    fits = fit_lines(ak.Array([[1.0, 2.0]]), ak.Array([[0.0, 0.0]]), ak.Array([[3, 3]]))
+    assert np.isnan(fits.m_x[0])
+
+
+def _two_track_events(seed, n_events):
+    rng = np.random.default_rng(seed)
+    tracks = [_random_tracks(rng, n_events)[:3] for _ in range(2)]
+    noise = [rng.uniform(-90, 90, (n_events, 2)) for _ in range(2)]
+    noise.append(rng.integers(0, 15, (n_events, 2)))
+    x, y, z = [
+        ak.concatenate([t1, t2, n], axis=1)
+        for t1, t2, n in zip(tracks[0], tracks[1], noise)
+    ]
+    return ak.zip({"hit_x": x, "hit_y": y, "hit_z": z})
+
+
+def test_find_tracks():
+    events = _two_track_events(5, 500)
+    found = find_tracks(events.hit_x, events.hit_y, events.hit_z)
+    assert np.mean(ak.to_numpy(found.n_tracks) == 2) > 0.7
+    assert ak.all(ak.num(found.tracks) == found.n_tracks)
+    assert ak.all(ak.num(found.hit_track) == ak.num(events.hit_z))
+    is_noise = found.hit_track[:, -2:] == -1
+    assert np.mean(ak.to_numpy(ak.flatten(is_noise))) > 0.8
+
+
+def test_iterate_tracks_in_parallel():
+    events = _two_track_events(6, 300)
+    chunks = [events[i : i + 100] for i in range(0, len(events), 100)]
+    serial = list(iterate_tracks(chunks))
+    parallel = list(iterate_tracks(chunks, n_workers=2))
+    assert ak.to_list(ak.concatenate(parallel)) == ak.to_list(ak.concatenate(serial))